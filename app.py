@@ -1,9 +1,64 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
+import hashlib
+import math
 import random
-from typing import Dict, List, Optional
+import threading
+import asyncio
+import httpx
+from collections import deque
+from dataclasses import asdict, dataclass, fields
+from story_cache import StoryCache
+import metrics
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Seconds to wait on the leading provider before hedging to the next one,
+# used until the provider has a latency history. After that the hedge waits
+# for its HEDGE_LATENCY_PERCENTILE latency, so only the slowest calls hedge.
+# Set to None to walk the provider chain strictly in order.
+HEDGE_DELAY_SECONDS = 3.0
+HEDGE_LATENCY_PERCENTILE = 0.95
+
+# Minimum seconds between re-renders of a streaming story
+STREAM_RENDER_INTERVAL = 0.05
+
+# Response cache for repeated story requests
+STORY_CACHE_MAX_ENTRIES = 256     # stories kept in memory
+STORY_CACHE_TTL_SECONDS = 6 * 3600
+STORY_CACHE_MAX_DISK_ENTRIES = 10000
+
+# Concurrent in-flight requests allowed per provider across all sessions
+PROVIDER_MAX_CONCURRENCY = 32
+PROVIDER_TIMEOUT_SECONDS = 30.0
+
+# Secrets read by AnimeStoryGenerator._update_api_tokens
+API_SECRET_KEYS = [
+    "HUGGINGFACE_TOKEN", "REPLICATE_TOKEN", "TOGETHER_TOKEN",
+    "OPENAI_API_KEY", "ANTHROPIC_API_KEY", "LOCAL_MODEL_URL"
+]
+
+# Circuit breaker settings for the provider health registry
+CIRCUIT_WINDOW_SIZE = 20          # calls kept in each provider's rolling window
+CIRCUIT_MIN_CALLS = 5             # calls needed before the error rate is trusted
+CIRCUIT_ERROR_THRESHOLD = 0.5     # error rate that opens the circuit
+CIRCUIT_COOLDOWN_SECONDS = 60.0   # time an open circuit waits before a probe
+
+# Connection pooling for provider calls
+HTTP_POOL_HOSTS = 8               # per-host pools kept alive (one per provider host)
+HTTP_POOL_MAXSIZE = 16            # keep-alive connections per host
+HTTP_RETRIES = 2                  # retries for connect errors and 429/502/503/504
+HTTP_BACKOFF_FACTOR = 0.3         # exponential backoff between retries
+HTTP_RETRY_STATUSES = frozenset([429, 502, 503, 504])
+HTTP_MAX_RETRY_AFTER = 10.0       # longest Retry-After honoured by the async client
+
+# Streaming calls are not retried; a stalled stream falls through to the
+# next streaming provider once one of these expires
+STREAM_CONNECT_TIMEOUT_SECONDS = 3.0
+STREAM_READ_TIMEOUT_SECONDS = 10.0    # wait for the first chunk, and between chunks
 
 # Page configuration
 st.set_page_config(
@@ -461,8 +516,315 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@dataclass(frozen=True)
+class GenerationParams:
+    """Sampling settings shared by every provider call
+    
+    Each provider maps these onto its own request schema, so the sidebar
+    settings reach the API and short stories stay short (and cheap).
+    """
+    
+    max_new_tokens: int = 500
+    temperature: float = 0.8
+    top_p: float = 0.95
+    stop: Tuple[str, ...] = ()
+    
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+@dataclass
+class GenerationResult:
+    """Outcome of one story generation with real usage and timing
+    
+    Token counts come from the provider's usage report and are None when
+    the provider does not report them. Times are in seconds; queue_wait is
+    the time spent waiting for the event loop and the provider semaphore.
+    """
+    
+    success: bool = False
+    text: str = ""
+    provider: str = ""
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    configured: bool = True
+    cached: bool = False
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    time_to_first_token: Optional[float] = None
+    latency: Optional[float] = None
+    queue_wait: float = 0.0
+    
+    @property
+    def tokens_per_sec(self) -> Optional[float]:
+        # Cached stories were not generated, so they have no throughput
+        if self.cached or not self.completion_tokens or not self.latency:
+            return None
+        return self.completion_tokens / self.latency
+    
+    def update(self, other: "GenerationResult"):
+        """Copy every field from another result into this one"""
+        for field in fields(self):
+            setattr(self, field.name, getattr(other, field.name))
+    
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class ProviderError(Exception):
+    """Raised by streaming provider calls that fail"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ProviderHealthRegistry:
+    """Process-wide health registry and circuit breaker for the API providers
+    
+    Each provider (keyed by its api_configs name) keeps a rolling window of
+    recent calls. When the error rate in that window crosses the threshold
+    the circuit opens and the provider is skipped until the cooldown passes,
+    after which a single half-open probe decides whether it closes again.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self,
+                 window_size: int = CIRCUIT_WINDOW_SIZE,
+                 min_calls: int = CIRCUIT_MIN_CALLS,
+                 error_threshold: float = CIRCUIT_ERROR_THRESHOLD,
+                 cooldown: float = CIRCUIT_COOLDOWN_SECONDS):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self._providers = {}
+        self._lock = threading.Lock()
+    
+    def _get(self, api_name: str) -> Dict:
+        if api_name not in self._providers:
+            self._providers[api_name] = {
+                "state": self.CLOSED,
+                "calls": deque(maxlen=self.window_size),
+                "last_status_code": None,
+                "last_error": None,
+                "opened_at": None,
+                "probe_in_flight": False
+            }
+        return self._providers[api_name]
+    
+    def allow_request(self, api_name: str) -> bool:
+        """Return True if the provider may be called right now"""
+        with self._lock:
+            health = self._get(api_name)
+            
+            if health["state"] == self.CLOSED:
+                return True
+            
+            if health["state"] == self.OPEN:
+                if time.time() - health["opened_at"] < self.cooldown:
+                    return False
+                # Cooldown elapsed - let exactly one probe through
+                health["state"] = self.HALF_OPEN
+                health["probe_in_flight"] = True
+                return True
+            
+            # Half-open: only the probe already in flight is allowed
+            if health["probe_in_flight"]:
+                return False
+            health["probe_in_flight"] = True
+            return True
+    
+    def release(self, api_name: str):
+        """Hand back a call slot without recording an outcome"""
+        with self._lock:
+            health = self._get(api_name)
+            health["probe_in_flight"] = False
+    
+    def record(self, api_name: str, success: bool, latency: float,
+               status_code: Optional[int] = None, error: Optional[str] = None):
+        """Record the outcome of a provider call and update its circuit"""
+        with self._lock:
+            health = self._get(api_name)
+            health["calls"].append((success, latency))
+            health["last_status_code"] = status_code
+            health["last_error"] = None if success else error
+            health["probe_in_flight"] = False
+            
+            if health["state"] == self.HALF_OPEN:
+                if success:
+                    health["state"] = self.CLOSED
+                    health["calls"].clear()
+                    health["calls"].append((success, latency))
+                    health["opened_at"] = None
+                else:
+                    health["state"] = self.OPEN
+                    health["opened_at"] = time.time()
+                return
+            
+            calls = health["calls"]
+            if health["state"] == self.CLOSED and len(calls) >= self.min_calls:
+                error_rate = sum(1 for ok, _ in calls if not ok) / len(calls)
+                if error_rate >= self.error_threshold:
+                    health["state"] = self.OPEN
+                    health["opened_at"] = time.time()
+    
+    def latency_percentile(self, api_name: str, percentile: float) -> Optional[float]:
+        """Latency of the provider's successful calls at the given percentile
+        
+        Returns None until the window holds min_calls successful calls.
+        """
+        with self._lock:
+            latencies = sorted(latency for ok, latency in self._get(api_name)["calls"] if ok)
+        if len(latencies) < self.min_calls:
+            return None
+        return latencies[math.ceil(len(latencies) * percentile) - 1]
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        """Return a copy of every provider's health for display"""
+        with self._lock:
+            snapshot = {}
+            for api_name, health in self._providers.items():
+                calls = list(health["calls"])
+                latencies = sorted(latency for _, latency in calls)
+                snapshot[api_name] = {
+                    "state": health["state"],
+                    "calls": len(calls),
+                    "error_rate": sum(1 for ok, _ in calls if not ok) / len(calls) if calls else 0.0,
+                    "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+                    "p95_latency": latencies[math.ceil(len(latencies) * 0.95) - 1] if latencies else None,
+                    "last_status_code": health["last_status_code"],
+                    "last_error": health["last_error"]
+                }
+            return snapshot
+
+
+@st.cache_resource
+def get_provider_health() -> ProviderHealthRegistry:
+    """Shared health registry for every session in this process"""
+    return ProviderHealthRegistry()
+
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Shared keep-alive HTTP session for the streaming provider calls
+    
+    urllib3 keeps a separate connection pool per host, so the TCP and TLS
+    handshake to each provider is paid once and reused across reruns.
+    Nothing is retried: a stream that cannot connect or answers with an
+    error moves on to the next streaming provider straight away.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=Retry(total=0, raise_on_status=False)
+    )
+    
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class AsyncProviderRuntime:
+    """One asyncio event loop per process, running on a daemon thread
+    
+    Provider calls from every session are scheduled on this loop, so many
+    generations can be in flight without holding a thread each. Each
+    provider gets a semaphore bounding its concurrent requests.
+    """
+    
+    def __init__(self, max_concurrency: int = PROVIDER_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._client = None
+        self._semaphores = {}
+        self._thread = threading.Thread(target=self.loop.run_forever, name="provider-loop", daemon=True)
+        self._thread.start()
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Pooled keep-alive client; only use it from the runtime loop"""
+        if self._client is None:
+            limits = httpx.Limits(
+                max_connections=HTTP_POOL_HOSTS * HTTP_POOL_MAXSIZE,
+                max_keepalive_connections=HTTP_POOL_HOSTS * HTTP_POOL_MAXSIZE
+            )
+            # A client given a transport ignores its own limits=, so the pool
+            # limits go on the transport. Transport retries cover connect
+            # errors only; 429/5xx are retried in _acall_provider.
+            self._client = httpx.AsyncClient(
+                timeout=PROVIDER_TIMEOUT_SECONDS,
+                transport=httpx.AsyncHTTPTransport(limits=limits, retries=HTTP_RETRIES)
+            )
+        return self._client
+    
+    def semaphore(self, api_name: str) -> asyncio.Semaphore:
+        """Concurrency limit for one provider; only use it from the runtime loop"""
+        if api_name not in self._semaphores:
+            self._semaphores[api_name] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[api_name]
+    
+    def run(self, coro: Awaitable):
+        """Run a coroutine on the runtime loop and block until it finishes"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+@st.cache_resource
+def get_async_runtime() -> AsyncProviderRuntime:
+    """Shared event loop for every provider call in this process"""
+    return AsyncProviderRuntime()
+
+
+@st.cache_resource
+def start_metrics_exporter() -> Optional[str]:
+    """Expose provider metrics once per process
+    
+    METRICS_PORT in secrets serves /metrics on a side HTTP port and
+    METRICS_TEXTFILE writes a scrape file after every story. Returns the
+    scrape file path, if any.
+    """
+    try:
+        port = st.secrets.get("METRICS_PORT")
+        textfile = st.secrets.get("METRICS_TEXTFILE")
+    except Exception:
+        # Secrets not available
+        port, textfile = None, None
+    
+    if port:
+        metrics.start_metrics_server(int(port))
+    return textfile
+
+
+@st.cache_resource
+def get_story_cache() -> StoryCache:
+    """Shared story cache; set STORY_CACHE_PATH in secrets to add a disk tier"""
+    try:
+        disk_path = st.secrets.get("STORY_CACHE_PATH")
+    except Exception:
+        # Secrets not available
+        disk_path = None
+    
+    return StoryCache(
+        max_entries=STORY_CACHE_MAX_ENTRIES,
+        ttl=STORY_CACHE_TTL_SECONDS,
+        disk_path=disk_path,
+        max_disk_entries=STORY_CACHE_MAX_DISK_ENTRIES
+    )
+
+
 class AnimeStoryGenerator:
-    def __init__(self):
+    def __init__(self, hedge_delay: Optional[float] = HEDGE_DELAY_SECONDS):
+        self.hedge_delay = hedge_delay
+        self.health = get_provider_health()
+        self.session = get_http_session()
+        self.cache = get_story_cache()
+        self.runtime = get_async_runtime()
+        self.metrics_textfile = start_metrics_exporter()
+        
         # Initialize with default tokens - will be updated when secrets are available
         self.api_configs = {
             # Free APIs
@@ -502,6 +864,13 @@ class AnimeStoryGenerator:
                 "headers": {"Authorization": "Bearer demo"},
                 "free": False,
                 "model": "Claude-3.5-Sonnet"
+            },
+            # Self-hosted fine-tuned model (inference_server.py)
+            "local_model": {
+                "url": "http://127.0.0.1:8765/generate",
+                "headers": {"Authorization": "Bearer demo"},
+                "free": True,
+                "model": "Fine-tuned GPT-2"
             }
         }
         
@@ -553,6 +922,9 @@ class AnimeStoryGenerator:
             openai_token = st.secrets.get('OPENAI_API_KEY', 'demo')
             anthropic_token = st.secrets.get('ANTHROPIC_API_KEY', 'demo')
             
+            # Local inference server
+            local_model_url = st.secrets.get('LOCAL_MODEL_URL', '')
+            
             # Update free API tokens
             if hf_token != 'hf_demo':
                 self.api_configs["huggingface"]["headers"]["Authorization"] = f"Bearer {hf_token}"
@@ -567,202 +939,222 @@ class AnimeStoryGenerator:
                 self.api_configs["openai"]["headers"]["Authorization"] = f"Bearer {openai_token}"
             if anthropic_token != 'demo':
                 self.api_configs["anthropic"]["headers"]["Authorization"] = f"Bearer {anthropic_token}"
+            
+            # The local server needs no token; setting its URL enables it
+            if local_model_url:
+                self.api_configs["local_model"]["url"] = local_model_url
+                self.api_configs["local_model"]["headers"]["Authorization"] = "Bearer local"
                 
         except:
             # Secrets not available, use default tokens
             pass
 
-    def generate_with_huggingface(self, prompt: str, max_length: int = 200) -> Dict:
-        """Generate story using Hugging Face Inference API"""
-        try:
-            # Check if using demo token
-            if "hf_demo" in self.api_configs["huggingface"]["headers"]["Authorization"]:
-                return {"success": False, "error": "Demo token - get real token from huggingface.co/settings/tokens"}
-            
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_length": max_length + 200,
-                    "temperature": 0.8,
-                    "top_p": 0.95,
-                    "do_sample": True,
-                    "return_full_text": False
-                }
-            }
-            
-            response = requests.post(
-                self.api_configs["huggingface"]["url"],
-                headers=self.api_configs["huggingface"]["headers"],
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if isinstance(result, list) and len(result) > 0:
-                    return {
-                        "success": True,
-                        "text": result[0].get("generated_text", ""),
-                        "provider": "Hugging Face"
-                    }
-            
-            return {"success": False, "error": f"API Error: {response.status_code}"}
-            
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+    def _huggingface_parameters(self, params: GenerationParams) -> Dict:
+        """Map generation params onto the Hugging Face text-generation schema"""
+        parameters = {
+            "max_new_tokens": params.max_new_tokens,
+            "temperature": params.temperature,
+            "top_p": params.top_p,
+            "do_sample": True,
+            "return_full_text": False,
+            "details": True
+        }
+        if params.stop:
+            parameters["stop"] = list(params.stop)
+        return parameters
 
-    def generate_with_replicate(self, prompt: str) -> Dict:
-        """Generate story using Replicate API"""
-        try:
-            # Check if using demo token
-            if "demo" in self.api_configs["replicate"]["headers"]["Authorization"]:
-                return {"success": False, "error": "Demo token - get real token from replicate.com/account/api-tokens"}
-            
-            payload = {
-                "version": "replicate/gpt-2:latest",
-                "input": {
-                    "prompt": prompt,
-                    "max_length": 200,
-                    "temperature": 0.8
-                }
-            }
-            
-            response = requests.post(
-                self.api_configs["replicate"]["url"],
-                headers=self.api_configs["replicate"]["headers"],
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "text": result.get("output", ""),
-                    "provider": "Replicate"
-                }
-            
-            return {"success": False, "error": f"API Error: {response.status_code}"}
-            
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+    def _local_model_payload(self, prompt: str, genre: str, params: GenerationParams) -> Dict:
+        return {
+            "prompt": prompt,
+            "genre": genre,
+            "max_new_tokens": params.max_new_tokens,
+            "temperature": params.temperature,
+            "top_p": params.top_p
+        }
 
-    def generate_with_openai(self, prompt: str, genre: str) -> Dict:
-        """Generate story using OpenAI GPT-4o-mini"""
-        try:
-            if "demo" in self.api_configs["openai"]["headers"]["Authorization"]:
-                return {"success": False, "error": "Demo token - get real token from platform.openai.com/api-keys"}
-            
-            payload = {
-                "model": "gpt-4o-mini",
-                "messages": [
-                    {
-                        "role": "system", 
-                        "content": f"You are an expert anime storyteller specializing in {genre} genre. Create engaging, authentic anime stories with proper pacing, character development, and genre-appropriate elements."
-                    },
-                    {
-                        "role": "user", 
-                        "content": f"Write an anime {genre} story based on this prompt: {prompt}. Make it engaging and authentic to the genre."
-                    }
-                ],
-                "max_tokens": 800,
-                "temperature": 0.8
-            }
-            
-            response = requests.post(
-                self.api_configs["openai"]["url"],
-                headers=self.api_configs["openai"]["headers"],
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "text": result["choices"][0]["message"]["content"],
-                    "provider": "OpenAI GPT-4o-mini"
-                }
-            
-            return {"success": False, "error": f"API Error: {response.status_code}"}
-            
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+    def _huggingface_payload(self, prompt: str, params: GenerationParams) -> Dict:
+        """Build the Hugging Face Inference API request body"""
+        return {
+            "inputs": prompt,
+            "parameters": self._huggingface_parameters(params)
+        }
 
-    def generate_with_claude(self, prompt: str, genre: str) -> Dict:
-        """Generate story using Anthropic Claude"""
-        try:
-            if "demo" in self.api_configs["anthropic"]["headers"]["Authorization"]:
-                return {"success": False, "error": "Demo token - get real token from console.anthropic.com"}
-            
-            payload = {
-                "model": "claude-3-5-sonnet-20241022",
-                "max_tokens": 800,
-                "messages": [
-                    {
-                        "role": "user", 
-                        "content": f"Write an engaging anime {genre} story based on this prompt: {prompt}. Make it authentic to the genre with proper pacing and character development."
-                    }
-                ]
+    def _llama_payload(self, prompt: str, genre: str, params: GenerationParams) -> Dict:
+        """Build the Llama-2 chat request body for the Hugging Face Inference API"""
+        return {
+            "inputs": f"<s>[INST] Write an anime {genre} story based on: {prompt} [/INST]",
+            "parameters": self._huggingface_parameters(params)
+        }
+
+    def _replicate_payload(self, prompt: str, params: GenerationParams) -> Dict:
+        """Build the Replicate prediction request body"""
+        return {
+            "version": "replicate/gpt-2:latest",
+            "input": {
+                "prompt": prompt,
+                "max_length": params.max_new_tokens,
+                "temperature": params.temperature,
+                "top_p": params.top_p
             }
-            
-            response = requests.post(
-                self.api_configs["anthropic"]["url"],
-                headers=self.api_configs["anthropic"]["headers"],
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "text": result["content"][0]["text"],
-                    "provider": "Claude-3.5-Sonnet"
+        }
+
+    def _openai_payload(self, prompt: str, genre: str, params: GenerationParams) -> Dict:
+        """Build the OpenAI chat completion request body"""
+        payload = {
+            "model": "gpt-4o-mini",
+            "messages": [
+                {
+                    "role": "system", 
+                    "content": f"You are an expert anime storyteller specializing in {genre} genre. Create engaging, authentic anime stories with proper pacing, character development, and genre-appropriate elements."
+                },
+                {
+                    "role": "user", 
+                    "content": f"Write an anime {genre} story based on this prompt: {prompt}. Make it engaging and authentic to the genre."
                 }
-            
-            return {"success": False, "error": f"API Error: {response.status_code}"}
-            
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+            ],
+            "max_tokens": params.max_new_tokens,
+            "temperature": params.temperature,
+            "top_p": params.top_p
+        }
+        if params.stop:
+            # OpenAI accepts at most four stop sequences
+            payload["stop"] = list(params.stop[:4])
+        return payload
 
-    def generate_with_llama(self, prompt: str, genre: str) -> Dict:
-        """Generate story using Llama-2 via Hugging Face"""
-        try:
-            if "hf_demo" in self.api_configs["huggingface_llama"]["headers"]["Authorization"]:
-                return {"success": False, "error": "Demo token - get real token from huggingface.co/settings/tokens"}
-            
-            payload = {
-                "inputs": f"<s>[INST] Write an anime {genre} story based on: {prompt} [/INST]",
-                "parameters": {
-                    "max_length": 500,
-                    "temperature": 0.8,
-                    "top_p": 0.95,
-                    "do_sample": True,
-                    "return_full_text": False
+    def _claude_payload(self, prompt: str, genre: str, params: GenerationParams) -> Dict:
+        """Build the Anthropic messages request body"""
+        payload = {
+            "model": "claude-3-5-sonnet-20241022",
+            "max_tokens": params.max_new_tokens,
+            "temperature": params.temperature,
+            "top_p": params.top_p,
+            "messages": [
+                {
+                    "role": "user", 
+                    "content": f"Write an engaging anime {genre} story based on this prompt: {prompt}. Make it authentic to the genre with proper pacing and character development."
                 }
-            }
-            
-            response = requests.post(
-                self.api_configs["huggingface_llama"]["url"],
-                headers=self.api_configs["huggingface_llama"]["headers"],
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if isinstance(result, list) and len(result) > 0:
-                    return {
-                        "success": True,
-                        "text": result[0].get("generated_text", ""),
-                        "provider": "Llama-2"
-                    }
+            ]
+        }
+        if params.stop:
+            payload["stop_sequences"] = list(params.stop)
+        return payload
+
+    def _record_call(self, api_name: str, success: bool, latency: float,
+                     status_code: Optional[int] = None, error: Optional[str] = None):
+        """Record a provider call in the health registry and the metrics"""
+        self.health.record(api_name, success, latency, status_code=status_code, error=error)
+        metrics.record_provider_call(api_name, success, latency, status_code=status_code)
+
+    def _record_story(self, result: GenerationResult):
+        """Record which provider served a story and refresh the scrape file"""
+        metrics.record_story(
+            result.provider,
+            cached=result.cached,
+            latency=result.latency,
+            time_to_first_token=result.time_to_first_token,
+            prompt_tokens=result.prompt_tokens,
+            completion_tokens=result.completion_tokens
+        )
+        if self.metrics_textfile:
+            try:
+                metrics.write_metrics_file(self.metrics_textfile)
+            except OSError:
+                # Metrics must never break generation
+                pass
+
+    def _usage(self, api_name: str, body) -> Tuple[Optional[int], Optional[int]]:
+        """Return (prompt_tokens, completion_tokens) from a provider response body"""
+        if api_name == "openai":
+            usage = body.get("usage") or {}
+            return usage.get("prompt_tokens"), usage.get("completion_tokens")
+        if api_name == "anthropic":
+            usage = body.get("usage") or {}
+            return usage.get("input_tokens"), usage.get("output_tokens")
+        if api_name == "local_model":
+            return body.get("prompt_tokens"), body.get("completion_tokens")
+        if api_name in ("huggingface", "huggingface_llama") and isinstance(body, list) and body:
+            details = body[0].get("details") or {}
+            return None, details.get("generated_tokens")
+        
+        # Replicate does not report usage
+        return None, None
+
+    def _is_configured(self, api_name: str) -> bool:
+        """Return True if the provider has a real (non-demo) token"""
+        return "demo" not in self.api_configs[api_name]["headers"]["Authorization"]
+
+    def _iter_sse_data(self, response: requests.Response) -> Iterator[Dict]:
+        """Yield the JSON payload of each server-sent event in a response"""
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                return
+            yield json.loads(data)
+
+    def stream_with_openai(self, prompt: str, genre: str, params: Optional[GenerationParams] = None,
+                           usage: Optional[Dict] = None) -> Iterator[str]:
+        """Stream story chunks from OpenAI GPT-4o-mini
+        
+        If usage is given it receives prompt_tokens and completion_tokens
+        from the final usage chunk.
+        """
+        usage = usage if usage is not None else {}
+        payload = self._openai_payload(prompt, genre, params or GenerationParams())
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
+        
+        with self.session.post(
+            self.api_configs["openai"]["url"],
+            headers=self.api_configs["openai"]["headers"],
+            json=payload,
+            timeout=(STREAM_CONNECT_TIMEOUT_SECONDS, STREAM_READ_TIMEOUT_SECONDS),
+            stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise ProviderError(f"API Error: {response.status_code}", response.status_code)
             
-            return {"success": False, "error": f"API Error: {response.status_code}"}
+            for event in self._iter_sse_data(response):
+                if event.get("usage"):
+                    usage["prompt_tokens"], usage["completion_tokens"] = self._usage("openai", event)
+                choices = event.get("choices") or [{}]
+                text = choices[0].get("delta", {}).get("content")
+                if text:
+                    yield text
+
+    def stream_with_claude(self, prompt: str, genre: str, params: Optional[GenerationParams] = None,
+                           usage: Optional[Dict] = None) -> Iterator[str]:
+        """Stream story chunks from Anthropic Claude
+        
+        If usage is given it receives prompt_tokens from message_start and
+        completion_tokens from message_delta.
+        """
+        usage = usage if usage is not None else {}
+        payload = self._claude_payload(prompt, genre, params or GenerationParams())
+        payload["stream"] = True
+        
+        with self.session.post(
+            self.api_configs["anthropic"]["url"],
+            headers=self.api_configs["anthropic"]["headers"],
+            json=payload,
+            timeout=(STREAM_CONNECT_TIMEOUT_SECONDS, STREAM_READ_TIMEOUT_SECONDS),
+            stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise ProviderError(f"API Error: {response.status_code}", response.status_code)
             
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+            for event in self._iter_sse_data(response):
+                if event.get("type") == "error":
+                    raise ProviderError(event.get("error", {}).get("message", "Stream error"))
+                if event.get("type") == "message_start":
+                    usage["prompt_tokens"] = event.get("message", {}).get("usage", {}).get("input_tokens")
+                if event.get("type") == "message_delta":
+                    usage["completion_tokens"] = event.get("usage", {}).get("output_tokens")
+                if event.get("type") == "content_block_delta":
+                    text = event.get("delta", {}).get("text")
+                    if text:
+                        yield text
 
     def generate_fallback_story(self, prompt: str, genre: str) -> str:
         """Generate a fallback story using templates when APIs fail"""
@@ -821,39 +1213,392 @@ class AnimeStoryGenerator:
         
         return f"Based on your idea: \"{prompt}\"\n\n{story}"
 
-    def generate_story(self, prompt: str, genre: str, max_length: int = 500) -> Dict:
-        """Generate story with multiple API fallbacks - upgraded models"""
+    def _provider_chain(self, prompt: str, genre: str, params: GenerationParams) -> List[Tuple[str, Callable[[], Awaitable[GenerationResult]]]]:
+        """Build the async provider chain in order of quality (best first)
+        
+        Each entry is keyed by its api_configs name and runs through the
+        circuit breaker, so providers with an open circuit fail instantly.
+        """
         genre_info = self.genres.get(genre, self.genres["shonen"])
+        tagged_prompt = f"{genre_info['prompt_prefix']} {prompt}"
         
-        # Try APIs in order of quality (best first)
-        apis_to_try = [
-            ("openai", lambda p, g: self.generate_with_openai(prompt, genre)),
-            ("claude", lambda p, g: self.generate_with_claude(prompt, genre)),
-            ("llama", lambda p, g: self.generate_with_llama(prompt, genre)),
-            ("huggingface", lambda p, g: self.generate_with_huggingface(f"{genre_info['prompt_prefix']} {prompt}", max_length)),
-            ("replicate", lambda p, g: self.generate_with_replicate(f"{genre_info['prompt_prefix']} {prompt}")),
+        def huggingface_text(result) -> Optional[str]:
+            if isinstance(result, list) and len(result) > 0:
+                return result[0].get("generated_text", "")
+            return None
+        
+        chain = [
+            ("openai", "OpenAI GPT-4o-mini", self._openai_payload(prompt, genre, params),
+             lambda result: result["choices"][0]["message"]["content"]),
+            ("anthropic", "Claude-3.5-Sonnet", self._claude_payload(prompt, genre, params),
+             lambda result: result["content"][0]["text"]),
+            ("local_model", "Fine-tuned Anime Model", self._local_model_payload(prompt, genre, params),
+             lambda result: result.get("generated_text")),
+            ("huggingface_llama", "Llama-2", self._llama_payload(prompt, genre, params), huggingface_text),
+            ("huggingface", "Hugging Face", self._huggingface_payload(tagged_prompt, params), huggingface_text),
+            ("replicate", "Replicate", self._replicate_payload(tagged_prompt, params),
+             lambda result: result.get("output", "")),
         ]
         
-        for api_name, api_func in apis_to_try:
+        return [
+            (api_name, lambda spec=(api_name, provider, payload, extract_text): self._acall_provider(*spec))
+            for api_name, provider, payload, extract_text in chain
+        ]
+
+    def _retry_delay(self, response: httpx.Response, attempt: int) -> float:
+        """Backoff before retrying a 429/5xx, honouring a numeric Retry-After"""
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), HTTP_MAX_RETRY_AFTER)
+        return HTTP_BACKOFF_FACTOR * (2 ** attempt)
+
+    async def _acall_provider(self, api_name: str, provider: str, payload: Dict,
+                              extract_text: Callable[[object], Optional[str]]) -> GenerationResult:
+        """Call one provider on the shared event loop
+        
+        The call waits for the provider's semaphore, goes through its
+        circuit breaker and records the outcome in the health registry.
+        429 and 502/503/504 responses are retried with exponential backoff.
+        A call cancelled because it lost the hedge race records nothing,
+        unless it had already run for the full provider timeout.
+        """
+        if not self._is_configured(api_name):
+            return GenerationResult(error=f"Demo token - {api_name} not configured", configured=False)
+        
+        wait_start = time.time()
+        async with self.runtime.semaphore(api_name):
+            queue_wait = time.time() - wait_start
+            if not self.health.allow_request(api_name):
+                return GenerationResult(error="Circuit open - provider temporarily skipped")
+            
+            start_time = time.time()
             try:
-                result = api_func(prompt, genre)
-                if result["success"]:
-                    return result
+                for attempt in range(HTTP_RETRIES + 1):
+                    response = await self.runtime.client.post(
+                        self.api_configs[api_name]["url"],
+                        headers=self.api_configs[api_name]["headers"],
+                        json=payload
+                    )
+                    if response.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRIES:
+                        break
+                    await asyncio.sleep(self._retry_delay(response, attempt))
+                body = response.json() if response.status_code == 200 else None
+                text = extract_text(body) if body is not None else None
+            except asyncio.CancelledError:
+                elapsed = time.time() - start_time
+                if elapsed >= PROVIDER_TIMEOUT_SECONDS:
+                    self._record_call(api_name, False, elapsed, error=f"Timed out after {elapsed:.1f}s")
+                else:
+                    # Lost the hedge race - the outcome says nothing about health
+                    self.health.release(api_name)
+                raise
             except Exception as e:
-                st.warning(f"API {api_name} failed: {str(e)}")
+                self._record_call(api_name, False, time.time() - start_time, error=str(e))
+                return GenerationResult(error=str(e), queue_wait=queue_wait)
+        
+        latency = time.time() - start_time
+        if text is None:
+            error = f"API Error: {response.status_code}"
+            self._record_call(api_name, False, latency, status_code=response.status_code, error=error)
+            return GenerationResult(error=error, status_code=response.status_code, queue_wait=queue_wait)
+        
+        self._record_call(api_name, True, latency, status_code=response.status_code)
+        prompt_tokens, completion_tokens = self._usage(api_name, body)
+        return GenerationResult(
+            success=True,
+            text=text,
+            provider=provider,
+            status_code=response.status_code,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            queue_wait=queue_wait
+        )
+
+    async def _agenerate_sequential(self, apis_to_try: List[Tuple[str, Callable[[], Awaitable[GenerationResult]]]]) -> Optional[GenerationResult]:
+        """Try each provider in turn until one succeeds"""
+        for api_name, api_call in apis_to_try:
+            result = await api_call()
+            if result.success:
+                return result
+        
+        return None
+
+    async def _agenerate_hedged(self, apis_to_try: List[Tuple[str, Callable[[], Awaitable[GenerationResult]]]],
+                                hedge_delay: float) -> Optional[GenerationResult]:
+        """Race providers, starting the next one whenever the in-flight calls
+        fail or the latest one has not answered within its hedge delay
+        
+        The hedge delay is the provider's observed latency percentile
+        (HEDGE_LATENCY_PERCENTILE), or hedge_delay while it has too few
+        successful calls to measure.
+        """
+        remaining = list(apis_to_try)
+        pending = set()
+        delay = hedge_delay
+        
+        try:
+            while remaining or pending:
+                # Start the next provider: either nothing is in flight, the
+                # last round only produced failures, or the hedge delay expired
+                if remaining:
+                    api_name, api_call = remaining.pop(0)
+                    pending.add(asyncio.ensure_future(api_call()))
+                    observed = self.health.latency_percentile(api_name, HEDGE_LATENCY_PERCENTILE)
+                    delay = observed if observed is not None else hedge_delay
+                
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=delay if remaining else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                
+                for task in done:
+                    result = task.result()
+                    if result.success:
+                        return result
+            
+            return None
+        
+        finally:
+            # Cancel the losers; their HTTP requests are aborted
+            for task in pending:
+                task.cancel()
+
+    def _cache_key(self, prompt: str, genre: str, params: GenerationParams) -> str:
+        """Cache key for a story request"""
+        return self.cache.make_key(prompt=prompt, genre=genre, **params.to_dict())
+
+    def _cache_result(self, cache_key: str, result: GenerationResult):
+        """Cache a provider result; template stories are free and meant to vary"""
+        if result.success and result.provider != "Template Fallback":
+            self.cache.set(cache_key, {
+                "success": True,
+                "text": result.text,
+                "provider": result.provider,
+                "prompt_tokens": result.prompt_tokens,
+                "completion_tokens": result.completion_tokens
+            })
+
+    def _cached_result(self, cache_key: str) -> Optional[GenerationResult]:
+        """Look up a cached story, timing the lookup as its latency"""
+        start_time = time.time()
+        cached = self.cache.get(cache_key)
+        metrics.record_cache_lookup(cached is not None)
+        if cached is None:
+            return None
+        
+        latency = time.time() - start_time
+        return GenerationResult(cached=True, time_to_first_token=latency, latency=latency, **cached)
+
+    async def agenerate_story(self, prompt: str, genre: str, max_length: int = 500,
+                              hedge_delay: Optional[float] = None, use_cache: bool = True,
+                              params: Optional[GenerationParams] = None) -> GenerationResult:
+        """Generate story with multiple API fallbacks - upgraded models
+        
+        Providers are raced with a hedged fallback chain unless the hedge
+        delay is None, in which case they are tried strictly in order.
+        Identical requests are served from the story cache; use_cache=False
+        skips the lookup for a fresh sample (which then replaces the entry).
+        params carries the sampling settings; without it max_length is used
+        as the token budget with default sampling.
+        
+        Provider calls always run on the shared event loop; awaiting this
+        from another loop hands the work over to it.
+        """
+        coro = self._agenerate_story(prompt, genre, max_length, hedge_delay, use_cache, params, time.time())
+        
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        
+        if running_loop is self.runtime.loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.runtime.loop))
+
+    async def _agenerate_story(self, prompt: str, genre: str, max_length: int,
+                               hedge_delay: Optional[float], use_cache: bool,
+                               params: Optional[GenerationParams], queued_at: float,
+                               skip: Tuple[str, ...] = ()) -> GenerationResult:
+        loop_wait = time.time() - queued_at
+        params = params or GenerationParams(max_new_tokens=max_length)
+        cache_key = self._cache_key(prompt, genre, params)
+        if use_cache:
+            cached = self._cached_result(cache_key)
+            if cached is not None:
+                cached.queue_wait = loop_wait
+                self._record_story(cached)
+                return cached
+        
+        # Providers in skip were already tried by the caller (e.g. the stream)
+        apis_to_try = [
+            (api_name, api_call) for api_name, api_call in self._provider_chain(prompt, genre, params)
+            if api_name not in skip
+        ]
+        
+        if hedge_delay is None:
+            hedge_delay = self.hedge_delay
+        
+        if hedge_delay is None:
+            result = await self._agenerate_sequential(apis_to_try)
+        else:
+            result = await self._agenerate_hedged(apis_to_try, hedge_delay)
+        
+        if result is not None:
+            self._cache_result(cache_key, result)
+        else:
+            # Fallback to template-based generation
+            result = GenerationResult(
+                success=True,
+                text=self.generate_fallback_story(prompt, genre),
+                provider="Template Fallback"
+            )
+        
+        # The whole story arrives at once, so the first token comes at the end
+        result.queue_wait += loop_wait
+        result.latency = time.time() - queued_at
+        result.time_to_first_token = result.latency
+        self._record_story(result)
+        return result
+
+    def generate_story(self, prompt: str, genre: str, max_length: int = 500,
+                       hedge_delay: Optional[float] = None, use_cache: bool = True,
+                       params: Optional[GenerationParams] = None) -> GenerationResult:
+        """Blocking wrapper around agenerate_story for the Streamlit script"""
+        return self.runtime.run(
+            self._agenerate_story(prompt, genre, max_length, hedge_delay, use_cache, params, time.time())
+        )
+
+    def generate_story_stream(self, prompt: str, genre: str, max_length: int = 500,
+                              result: Optional[GenerationResult] = None, use_cache: bool = True,
+                              params: Optional[GenerationParams] = None) -> Iterator[str]:
+        """Generate story chunk by chunk as the provider produces it
+        
+        Streaming providers are tried in order and one that fails before its
+        first chunk is skipped. When none of them can stream, the rest of
+        the provider chain (the local model, then the free APIs) runs
+        without them and its text, or a template story, is yielded in one
+        piece. If result
+        is given it is filled in with the outcome, usage and timing once the
+        stream ends. Cache hits are yielded in one piece.
+        """
+        if result is None:
+            result = GenerationResult()
+        
+        request_start = time.time()
+        params = params or GenerationParams(max_new_tokens=max_length)
+        cache_key = self._cache_key(prompt, genre, params)
+        if use_cache:
+            cached = self._cached_result(cache_key)
+            if cached is not None:
+                result.update(cached)
+                self._record_story(result)
+                yield cached.text
+                return
+        
+        streaming_chain = [
+            ("openai", "OpenAI GPT-4o-mini", lambda usage: self.stream_with_openai(prompt, genre, params, usage)),
+            ("anthropic", "Claude-3.5-Sonnet", lambda usage: self.stream_with_claude(prompt, genre, params, usage)),
+        ]
+        
+        for api_name, provider, stream_func in streaming_chain:
+            if not self._is_configured(api_name) or not self.health.allow_request(api_name):
                 continue
+            
+            start_time = time.time()
+            first_token_time = None
+            usage = {}
+            parts = []
+            recorded = False
+            complete = False
+            try:
+                for chunk in stream_func(usage):
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    parts.append(chunk)
+                    yield chunk
+                
+                if not parts:
+                    raise ProviderError("Empty response", 200)
+                
+                self._record_call(api_name, True, time.time() - start_time, status_code=200)
+                recorded = True
+                complete = True
+            except Exception as e:
+                self._record_call(
+                    api_name, False, time.time() - start_time,
+                    status_code=getattr(e, "status_code", None), error=str(e)
+                )
+                recorded = True
+                # Once text has reached the reader, keep what was streamed
+                if not parts:
+                    continue
+            finally:
+                # The reader stopped consuming the stream early
+                if not recorded:
+                    self.health.release(api_name)
+            
+            result.update(GenerationResult(
+                success=True,
+                text="".join(parts),
+                provider=provider,
+                status_code=200,
+                prompt_tokens=usage.get("prompt_tokens"),
+                completion_tokens=usage.get("completion_tokens"),
+                time_to_first_token=first_token_time - request_start,
+                latency=time.time() - request_start
+            ))
+            # A stream cut short is shown but never cached
+            if complete:
+                self._cache_result(cache_key, result)
+            self._record_story(result)
+            return
         
-        # Fallback to template-based generation
-        fallback_story = self.generate_fallback_story(prompt, genre)
-        return {
-            "success": True,
-            "text": fallback_story,
-            "provider": "Template Fallback"
-        }
+        # The cache was already checked above, and the streaming providers
+        # were just tried (_agenerate_story records the fallback story in the metrics)
+        fallback = self.runtime.run(self._agenerate_story(
+            prompt, genre, max_length, None, False, params, time.time(),
+            skip=tuple(api_name for api_name, _, _ in streaming_chain)
+        ))
+        fallback.latency = time.time() - request_start
+        fallback.time_to_first_token = fallback.latency
+        result.update(fallback)
+        if fallback.success:
+            yield fallback.text
+
+
+def render_story(placeholder, text: str):
+    """Render story text inside the styled story-output block"""
+    placeholder.markdown(f"""
+    <div class="story-output">
+        <div class="story-text">{text}</div>
+    </div>
+    """, unsafe_allow_html=True)
+
+
+def _secrets_fingerprint() -> str:
+    """Hash the API secrets so the cached generator is rebuilt when they change"""
+    try:
+        values = [str(st.secrets.get(key, "")) for key in API_SECRET_KEYS]
+    except Exception:
+        # Secrets not available
+        values = []
+    return hashlib.sha256("\0".join(values).encode("utf-8")).hexdigest()
+
+
+@st.cache_resource(max_entries=1)
+def get_story_generator(secrets_fingerprint: str) -> AnimeStoryGenerator:
+    """Process-wide story generator, rebuilt only when the secrets change
+    
+    The fingerprint is only used as the cache key; max_entries=1 drops the
+    generator built for the previous secrets.
+    """
+    return AnimeStoryGenerator()
+
 
 def main():
-    # Initialize generator
-    generator = AnimeStoryGenerator()
+    # Reuse the generator across reruns and sessions
+    generator = get_story_generator(_secrets_fingerprint())
     
     # Beautiful Header
     st.markdown("""
@@ -871,10 +1616,21 @@ def main():
         st.markdown("#### 🔌 API Status")
         st.info("Using free APIs: Hugging Face, Replicate")
         
+        for api_name, health in generator.health.snapshot().items():
+            status = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}[health["state"]]
+            latency = f"{health['p50_latency']:.1f}s" if health["p50_latency"] is not None else "-"
+            st.caption(
+                f"{status} {api_name}: {health['error_rate']:.0%} errors, "
+                f"p50 {latency}, last status {health['last_status_code'] or '-'}"
+            )
+        
         # Generation Settings
         st.markdown("#### 🎛️ Generation Settings")
-        max_length = st.slider("Max Length", 100, 1000, 500)
+        max_length = st.slider("Max Length", 100, 1000, 500,
+                               help="Maximum number of tokens to generate")
         temperature = st.slider("Creativity", 0.1, 1.0, 0.8)
+        fresh_sample = st.checkbox("🎲 Fresh sample", value=False,
+                                   help="Skip the story cache and generate a new version")
         
         # About section
         st.markdown("#### 📖 About")
@@ -972,27 +1728,33 @@ def main():
         if st.button("🚀 GENERATE EPIC STORY", type="primary", use_container_width=True):
             if prompt.strip():
                 with st.spinner("✨ AI is crafting your anime masterpiece..."):
-                    start_time = time.time()
-                    
-                    # Generate story
-                    result = generator.generate_story(prompt, selected_genre, max_length)
+                    # Stream the story into the page as it is generated
+                    result = GenerationResult()
+                    story_text = ""
+                    story_placeholder = None
+                    last_render = 0.0
+                    params = GenerationParams(max_new_tokens=max_length, temperature=temperature)
+                    for chunk in generator.generate_story_stream(
+                            prompt, selected_genre, result=result, use_cache=not fresh_sample, params=params
+                    ):
+                        if story_placeholder is None:
+                            st.markdown("### 📖 Generated Story")
+                            story_placeholder = st.empty()
+                        story_text += chunk
+                        if time.time() - last_render >= STREAM_RENDER_INTERVAL:
+                            render_story(story_placeholder, story_text)
+                            last_render = time.time()
                     
-                    end_time = time.time()
-                    generation_time = end_time - start_time
-                    
-                    if result["success"]:
-                        # Display story with beautiful styling
-                        st.markdown("### 📖 Generated Story")
-                        st.markdown(f"""
-                        <div class="story-output">
-                            <div class="story-text">{result['text']}</div>
-                        </div>
-                        """, unsafe_allow_html=True)
+                    if result.success:
+                        if story_placeholder is None:
+                            st.markdown("### 📖 Generated Story")
+                            story_placeholder = st.empty()
+                        render_story(story_placeholder, result.text)
                         
-                        # Display metrics with beautiful styling
-                        word_count = len(result['text'].split())
-                        token_count = int(word_count * 1.3)
-                        tokens_per_sec = int(token_count / generation_time) if generation_time > 0 else 0
+                        # Display metrics with beautiful styling; providers
+                        # that don't report usage show a dash
+                        token_count = result.completion_tokens if result.completion_tokens is not None else "—"
+                        tokens_per_sec = f"{result.tokens_per_sec:.0f}" if result.tokens_per_sec else "—"
                         
                         st.markdown(f"""
                         <div class="metrics">
@@ -1001,7 +1763,11 @@ def main():
                                 <div class="metric-label">📊 Tokens</div>
                             </div>
                             <div class="metric-card">
-                                <div class="metric-value">{generation_time:.2f}s</div>
+                                <div class="metric-value">{result.time_to_first_token:.2f}s</div>
+                                <div class="metric-label">⚡ First Token</div>
+                            </div>
+                            <div class="metric-card">
+                                <div class="metric-value">{result.latency:.2f}s</div>
                                 <div class="metric-label">⏱️ Time</div>
                             </div>
                             <div class="metric-card">
@@ -1009,17 +1775,18 @@ def main():
                                 <div class="metric-label">🚀 Tokens/sec</div>
                             </div>
                             <div class="metric-card">
-                                <div class="metric-value">{result['provider'][:10]}...</div>
+                                <div class="metric-value">{result.provider[:10]}...</div>
                                 <div class="metric-label">🤖 Provider</div>
                             </div>
                         </div>
                         """, unsafe_allow_html=True)
                         
                         # Success message
-                        st.success(f"✅ Story generated successfully using {result['provider']}!")
+                        source = " (cached)" if result.cached else ""
+                        st.success(f"✅ Story generated successfully using {result.provider}{source}!")
                         
                     else:
-                        st.error(f"❌ Generation failed: {result['error']}")
+                        st.error(f"❌ Generation failed: {result.error or 'No provider returned a story'}")
             else:
                 st.warning("⚠️ Please enter a story prompt!")
     
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Resumable Training Checkpoints
+Helpers that let the training scripts pick up where a preempted job
+stopped. latest_checkpoint finds the newest complete checkpoint in an
+output directory, and Trainer's resume_from_checkpoint restores the
+optimizer, scheduler, RNG and data-loader position from it.
+
+AsyncCheckpointTrainer copies the training state to CPU memory at each
+save and writes it (weights as safetensors) in a background thread, so
+training continues while the checkpoint goes to disk. Each checkpoint is
+written to a hidden temporary directory and renamed into place once
+every file is synced, so a crash mid-write never leaves a partial
+checkpoint-N behind.
+"""
+
+import copy
+import dataclasses
+import json
+import os
+import random
+import re
+import shutil
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from safetensors.torch import save_file
+from transformers import Trainer
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.utils import is_peft_available
+
+try:
+    from transformers.trainer_callback import ExportableState
+except ImportError:  # transformers < 4.42 has no stateful callbacks
+    ExportableState = None
+
+TRAINER_STATE_NAME = "trainer_state.json"
+OPTIMIZER_NAME = "optimizer.pt"
+SCHEDULER_NAME = "scheduler.pt"
+RNG_STATE_NAME = "rng_state.pth"
+ADAPTER_WEIGHTS_NAME = "adapter_model.safetensors"
+WEIGHTS_NAMES = ("model.safetensors", "model.safetensors.index.json", "pytorch_model.bin", ADAPTER_WEIGHTS_NAME)
+
+_CHECKPOINT_RE = re.compile(rf"^{PREFIX_CHECKPOINT_DIR}-(\d+)$")
+
+def is_valid_checkpoint(path: str) -> bool:
+    """Check that a checkpoint has weights, optimizer state and a readable trainer state"""
+    if not any(os.path.exists(os.path.join(path, name)) for name in WEIGHTS_NAMES):
+        return False
+    if not os.path.exists(os.path.join(path, OPTIMIZER_NAME)):
+        return False
+    try:
+        with open(os.path.join(path, TRAINER_STATE_NAME)) as f:
+            json.load(f)
+    except (OSError, ValueError):
+        return False
+    return True
+
+def latest_checkpoint(output_dir: str) -> Optional[str]:
+    """Return the newest valid checkpoint-N directory in output_dir, or None"""
+    if not os.path.isdir(output_dir):
+        return None
+
+    steps = []
+    for name in os.listdir(output_dir):
+        match = _CHECKPOINT_RE.match(name)
+        if match and os.path.isdir(os.path.join(output_dir, name)):
+            steps.append((int(match.group(1)), name))
+
+    for _, name in sorted(steps, reverse=True):
+        path = os.path.join(output_dir, name)
+        if is_valid_checkpoint(path):
+            return path
+        print(f"Skipping incomplete checkpoint {path}")
+    return None
+
+def _cpu_copy(value):
+    """Deep copy of a (nested) state dict with every tensor cloned to the CPU"""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: _cpu_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_cpu_copy(item) for item in value)
+    return copy.deepcopy(value)
+
+def _is_peft_model(model) -> bool:
+    if not is_peft_available():
+        return False
+    from peft import PeftModel
+    return isinstance(model, PeftModel)
+
+def _fsync_dir(path: str):
+    """Flush a directory's entries (e.g. a rename into it) to disk"""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+def _fsync_tree(path: str):
+    """Flush every file under path, and the directory entries, to disk"""
+    for root, _, files in os.walk(path):
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as f:
+                os.fsync(f.fileno())
+        _fsync_dir(root)
+
+class AsyncCheckpointTrainer(Trainer):
+    """Trainer that writes checkpoints in a background thread, atomically
+
+    Only one checkpoint is written at a time; a save that comes while the
+    previous one is still being written waits for it first.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkpoint_thread: Optional[threading.Thread] = None
+        self._checkpoint_error: Optional[BaseException] = None
+
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            self.wait_for_checkpoint()
+
+    def wait_for_checkpoint(self):
+        """Block until the checkpoint being written is on disk"""
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+        if self._checkpoint_error is not None:
+            error, self._checkpoint_error = self._checkpoint_error, None
+            raise RuntimeError("Writing the checkpoint failed") from error
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+
+        # Record callback state in the trainer state, as Trainer does
+        if ExportableState is not None:
+            for callback in self.callback_handler.callbacks + [self.control]:
+                if isinstance(callback, ExportableState):
+                    name = callback.__class__.__name__
+                    if isinstance(self.state.stateful_callbacks.get(name), list):
+                        self.state.stateful_callbacks[name].append(callback.state())
+                    else:
+                        self.state.stateful_callbacks[name] = callback.state()
+
+        snapshot = self._snapshot()
+        self.wait_for_checkpoint()
+        if not self.args.should_save:
+            return
+
+        self._checkpoint_thread = threading.Thread(
+            target=self._write_checkpoint, args=(snapshot, run_dir, output_dir), daemon=False
+        )
+        self._checkpoint_thread.start()
+
+    def _snapshot(self) -> Dict:
+        """Copy everything a checkpoint needs, so training can go on changing it"""
+        model = self.accelerator.unwrap_model(self.model)
+        if _is_peft_model(model):
+            # LoRA training: the adapter is all that changes
+            from peft import get_peft_model_state_dict
+            state_dict = get_peft_model_state_dict(model)
+        else:
+            state_dict = model.state_dict()
+
+        # Tied weights (e.g. lm_head and wte) are saved once, as save_pretrained does
+        weights = {}
+        seen = set()
+        for name, tensor in state_dict.items():
+            if tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            weights[name] = tensor.detach().to('cpu', copy=True).contiguous()
+
+        snapshot = {
+            "weights": weights,
+            "trainer_state": json.dumps(dataclasses.asdict(self.state), indent=2, sort_keys=True) + "\n"
+        }
+        if not self.args.save_only_model:
+            # The numpy key array is stored as a list so torch.load(weights_only=True) accepts it
+            numpy_state = np.random.get_state()
+            rng_state = {
+                "python": random.getstate(),
+                "numpy": (numpy_state[0], numpy_state[1].tolist(), *numpy_state[2:]),
+                "cpu": torch.random.get_rng_state()
+            }
+            if torch.cuda.is_available():
+                rng_state["cuda"] = torch.cuda.random.get_rng_state()
+            snapshot.update({
+                "optimizer": _cpu_copy(self.optimizer.state_dict()),
+                "scheduler": copy.deepcopy(self.lr_scheduler.state_dict()),
+                "rng_state": rng_state
+            })
+        return snapshot
+
+    def _write_checkpoint(self, snapshot: Dict, run_dir: str, output_dir: str):
+        # The hidden name keeps Trainer's checkpoint-* globbing away from partial writes
+        tmp_dir = os.path.join(run_dir, f".tmp-{os.path.basename(output_dir)}")
+        try:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+
+            model = self.accelerator.unwrap_model(self.model)
+            if _is_peft_model(model):
+                save_file(snapshot["weights"], os.path.join(tmp_dir, ADAPTER_WEIGHTS_NAME), metadata={"format": "pt"})
+                model.peft_config[model.active_adapter].save_pretrained(tmp_dir)
+            else:
+                save_file(snapshot["weights"], os.path.join(tmp_dir, "model.safetensors"), metadata={"format": "pt"})
+                model.config.save_pretrained(tmp_dir)
+                if getattr(model, "generation_config", None) is not None:
+                    model.generation_config.save_pretrained(tmp_dir)
+            processing_class = getattr(self, "processing_class", None)
+            if processing_class is not None:
+                processing_class.save_pretrained(tmp_dir)
+            torch.save(self.args, os.path.join(tmp_dir, "training_args.bin"))
+
+            if "optimizer" in snapshot:
+                torch.save(snapshot["optimizer"], os.path.join(tmp_dir, OPTIMIZER_NAME))
+                torch.save(snapshot["scheduler"], os.path.join(tmp_dir, SCHEDULER_NAME))
+                torch.save(snapshot["rng_state"], os.path.join(tmp_dir, RNG_STATE_NAME))
+
+            # The trainer state goes last; it is what marks a checkpoint as complete
+            with open(os.path.join(tmp_dir, TRAINER_STATE_NAME), 'w', encoding='utf-8') as f:
+                f.write(snapshot["trainer_state"])
+            _fsync_tree(tmp_dir)
+
+            if os.path.exists(output_dir):
+                # Same step saved again: move the old copy aside before swapping in the new one
+                old_dir = os.path.join(run_dir, f".old-{os.path.basename(output_dir)}")
+                shutil.rmtree(old_dir, ignore_errors=True)
+                os.replace(output_dir, old_dir)
+                os.replace(tmp_dir, output_dir)
+                shutil.rmtree(old_dir, ignore_errors=True)
+            else:
+                os.replace(tmp_dir, output_dir)
+            _fsync_dir(run_dir)
+
+            # Delete older checkpoints beyond save_total_limit
+            self._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
+        except BaseException as error:
+            self._checkpoint_error = error
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,37 @@
+"""Shared fixtures: a tiny byte-level GPT-2 built on the fly, so tests need no downloads"""
+
+import json
+
+import pytest
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from token_shards import SPECIAL_TOKENS
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    """Directory with a tiny GPT-2 and its tokenizer, special tokens included"""
+    path = tmp_path_factory.mktemp("tiny_gpt2")
+    vocab = {char: i for i, char in enumerate(bytes_to_unicode().values())}
+    vocab["<|endoftext|>"] = len(vocab)
+    (path / "vocab.json").write_text(json.dumps(vocab))
+    (path / "merges.txt").write_text("#version: 0.2\n")
+
+    tokenizer = GPT2Tokenizer(str(path / "vocab.json"), str(path / "merges.txt"))
+    tokenizer.add_special_tokens({'additional_special_tokens': SPECIAL_TOKENS})
+    tokenizer.save_pretrained(path)
+
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=256, n_embd=32, n_layer=2, n_head=2,
+                        bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id)
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return str(path)
+
+@pytest.fixture
+def tokenizer(tiny_model_dir):
+    tokenizer = GPT2Tokenizer.from_pretrained(tiny_model_dir)
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+@pytest.fixture
+def model(tiny_model_dir):
+    return GPT2LMHeadModel.from_pretrained(tiny_model_dir).eval()
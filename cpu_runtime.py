@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+CPU Inference Runtime
+Runs the fine-tuned model on a fixed pool of worker processes, each pinned
+to its own cores with a bounded PyTorch thread budget, so concurrent
+sessions stop oversubscribing the CPU. Requests are routed to the workers
+through a shared queue. Workers load the model through the model registry,
+so the memory-mapped weights are shared between them by the OS. If a
+worker dies (e.g. killed for running out of memory), the request it was
+serving fails instead of waiting forever; queued requests go to the
+workers still alive, and once none are left every request fails.
+
+Run with --benchmark to find the best worker/thread split for a machine.
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+# Seconds between checks that the worker processes are still alive
+WORKER_CHECK_INTERVAL = 1.0
+
+def available_cores() -> List[int]:
+    """Return the CPU cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def candidate_splits(num_cores: int) -> List[Tuple[int, int]]:
+    """Return every (workers, threads_per_worker) split that fills the cores exactly"""
+    return [
+        (workers, num_cores // workers)
+        for workers in range(1, num_cores + 1)
+        if num_cores % workers == 0
+    ]
+
+def _worker_main(worker_id: int, cores: List[int], num_threads: int, model_path: str,
+                 quantized: bool, requests, results):
+    """Worker process: pin to cores, bound the thread pools and serve requests"""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    from integrate_finetuned_model import FineTunedAnimeGenerator
+
+    generator = FineTunedAnimeGenerator(model_path, quantized=quantized)
+    results.put((None, worker_id, {"ready": generator.is_loaded}))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        request_id, submitted_at, prompt, genre, max_length = request
+        # Tell the runtime which request this worker holds, in case it dies
+        results.put((request_id, worker_id, None))
+        queue_wait = time.time() - submitted_at
+        start_time = time.time()
+        with torch.inference_mode():
+            result = generator.generate_story(prompt, genre, max_length)
+        result.update({
+            "worker": worker_id,
+            "queue_wait": queue_wait,
+            "latency": time.time() - start_time
+        })
+        results.put((request_id, worker_id, result))
+
+class CPUInferenceRuntime:
+    def __init__(self, model_path: str = "./anime_model", num_workers: int = 1,
+                 threads_per_worker: Optional[int] = None, pin_cores: bool = True,
+                 quantized: bool = False):
+        """
+        Initialize the worker pool
+
+        Args:
+            model_path: Fine-tuned model served by every worker
+            num_workers: Worker processes, each with its own copy of the activations
+            threads_per_worker: Intra-op threads per worker (defaults to an even share of the cores)
+            pin_cores: Pin each worker to a disjoint set of cores
+            quantized: Run the workers on the int8 model
+        """
+        cores = available_cores()
+        self.model_path = model_path
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(len(cores) // num_workers, 1)
+        self.quantized = quantized
+
+        # Give each worker its own slice of cores; without pinning they share all of them
+        self.worker_cores = [
+            cores[i * self.threads_per_worker:(i + 1) * self.threads_per_worker] or cores
+            if pin_cores else cores
+            for i in range(num_workers)
+        ]
+
+        context = multiprocessing.get_context("spawn")
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        self._workers = [
+            context.Process(
+                target=_worker_main,
+                args=(worker_id, self.worker_cores[worker_id], self.threads_per_worker,
+                      model_path, quantized, self._requests, self._results),
+                daemon=True
+            )
+            for worker_id in range(num_workers)
+        ]
+
+        self._futures: Dict[int, Future] = {}
+        self._running: Dict[int, int] = {}
+        self._loaded = set()
+        self._exited = set()
+        self._error: Optional[str] = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Semaphore(0)
+        self._stopping = threading.Event()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+
+    def start(self, timeout: Optional[float] = None) -> "CPUInferenceRuntime":
+        """Start the workers and wait until each has loaded the model"""
+        for worker in self._workers:
+            worker.start()
+        self._dispatcher.start()
+        for _ in self._workers:
+            if not self._ready.acquire(timeout=timeout):
+                raise TimeoutError("Workers did not load the model in time")
+            if self._error is not None:
+                self.stop()
+                raise RuntimeError(self._error)
+        return self
+
+    def submit(self, prompt: str, genre: str, max_length: int = 200) -> Future:
+        """Queue a request for the next free worker"""
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError(self._error)
+            request_id = next(self._ids)
+            self._futures[request_id] = future
+        self._requests.put((request_id, time.time(), prompt, genre, max_length))
+        return future
+
+    def generate_story(self, prompt: str, genre: str, max_length: int = 200) -> Dict:
+        """Generate a story on the worker pool, blocking until it is done"""
+        return self.submit(prompt, genre, max_length).result()
+
+    def stop(self):
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._stopping.set()
+        if all(worker.exitcode == 0 for worker in self._workers):
+            # Wake the dispatcher now. A killed worker may have left the
+            # results queue locked; then it stops at its next check instead.
+            self._results.put(None)
+        self._dispatcher.join()
+
+    def _dispatch(self):
+        """Hand results from the workers back to their futures, and fail the
+        requests of workers that die"""
+        while True:
+            try:
+                message = self._results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                message = ()
+            if message is None:
+                return
+            if message:
+                self._handle(message)
+            self._check_workers()
+
+    def _handle(self, message: Tuple):
+        request_id, worker_id, result = message
+        if request_id is None:
+            with self._lock:
+                self._loaded.add(worker_id)
+                if not result["ready"] and self._error is None:
+                    self._error = f"Worker {worker_id} failed to load the model from {self.model_path}"
+            self._ready.release()
+            return
+
+        with self._lock:
+            if result is not None:
+                self._running.pop(worker_id, None)
+                future = self._futures.pop(request_id)
+            elif worker_id in self._exited:
+                # Picked up just before the worker died
+                future = self._futures.pop(request_id)
+                result = RuntimeError(f"Worker {worker_id} exited while serving the request")
+            else:
+                self._running[worker_id] = request_id
+                return
+
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def _check_workers(self):
+        """Fail the requests of workers that have exited"""
+        failed = []
+        with self._lock:
+            for worker_id, worker in enumerate(self._workers):
+                if worker_id in self._exited or worker.is_alive():
+                    continue
+                self._exited.add(worker_id)
+                error = f"Worker {worker_id} exited with code {worker.exitcode}"
+
+                request_id = self._running.pop(worker_id, None)
+                if request_id is not None:
+                    failed.append((self._futures.pop(request_id), error))
+                if worker_id not in self._loaded and self._error is None:
+                    # start() is waiting for this worker to load the model
+                    self._error = f"{error} while loading the model"
+                    self._ready.release()
+
+            if len(self._exited) == len(self._workers):
+                # Nothing is left to serve the queued requests
+                self._error = self._error or "Every worker has exited"
+                failed.extend((future, self._error) for future in self._futures.values())
+                self._futures.clear()
+
+        for future, error in failed:
+            future.set_exception(RuntimeError(error))
+
+def benchmark(model_path: str, splits: List[Tuple[int, int]], num_requests: int = 16,
+              max_length: int = 100, quantized: bool = False) -> List[Dict]:
+    """Measure throughput and latency of each worker/thread split under concurrent load"""
+    reports = []
+    for num_workers, threads_per_worker in splits:
+        runtime = CPUInferenceRuntime(model_path, num_workers, threads_per_worker,
+                                      quantized=quantized).start()
+        try:
+            # Warm up every worker before timing
+            for future in [runtime.submit("A hero appears", "shonen", 8) for _ in range(num_workers)]:
+                future.result()
+
+            start_time = time.time()
+            futures = [
+                runtime.submit("A young warrior discovers a legendary sword", "shonen", max_length)
+                for _ in range(num_requests)
+            ]
+            results = [future.result() for future in futures]
+            wall_time = time.time() - start_time
+        finally:
+            runtime.stop()
+
+        completion_tokens = sum(result.get("completion_tokens", 0) for result in results)
+        latencies = sorted(result["queue_wait"] + result["latency"] for result in results)
+        reports.append({
+            "workers": num_workers,
+            "threads_per_worker": threads_per_worker,
+            "tokens_per_sec": completion_tokens / wall_time,
+            "mean_latency": sum(latencies) / len(latencies),
+            "p95_latency": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        })
+    return reports
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU inference worker pool for the fine-tuned anime model")
+    parser.add_argument("--model_path", type=str, default="./anime_model",
+                       help="Path to the fine-tuned model")
+    parser.add_argument("--benchmark", action="store_true",
+                       help="Benchmark every worker/thread split for this machine")
+    parser.add_argument("--workers", type=int, default=1,
+                       help="Worker processes")
+    parser.add_argument("--threads", type=int, default=None,
+                       help="Threads per worker (defaults to an even share of the cores)")
+    parser.add_argument("--requests", type=int, default=16,
+                       help="Concurrent requests per benchmark run")
+    parser.add_argument("--max_length", type=int, default=100,
+                       help="New tokens per request")
+    parser.add_argument("--quantized", action="store_true",
+                       help="Run the workers on the int8 model")
+    args = parser.parse_args()
+
+    cores = available_cores()
+    print(f"🎌 CPU Inference Runtime ({len(cores)} cores) 🎌")
+    print("=" * 60)
+
+    if args.benchmark:
+        reports = benchmark(args.model_path, candidate_splits(len(cores)),
+                            args.requests, args.max_length, args.quantized)
+        print(f"{'Workers':>8} {'Threads':>8} {'Tokens/sec':>11} {'Mean (s)':>9} {'p95 (s)':>8}")
+        for report in reports:
+            print(f"{report['workers']:>8} {report['threads_per_worker']:>8} "
+                  f"{report['tokens_per_sec']:>11.1f} {report['mean_latency']:>9.2f} "
+                  f"{report['p95_latency']:>8.2f}")
+        best = max(reports, key=lambda report: report["tokens_per_sec"])
+        print("=" * 60)
+        print(f"Best split: {best['workers']} workers x {best['threads_per_worker']} threads")
+        return
+
+    runtime = CPUInferenceRuntime(args.model_path, args.workers, args.threads,
+                                  quantized=args.quantized).start()
+    try:
+        result = runtime.generate_story("A young warrior discovers a legendary sword", "shonen", args.max_length)
+        print(f"Worker {result['worker']}: {result.get('text', result.get('error'))}")
+    finally:
+        runtime.stop()
+
+if __name__ == "__main__":
+    main()
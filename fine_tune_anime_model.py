@@ -7,13 +7,39 @@ Fine-tune your own anime story generation model using anime datasets.
 import torch
 from transformers import (
     AutoTokenizer, AutoModelForCausalLM, 
-    TrainingArguments, Trainer, DataCollatorForLanguageModeling
+    TrainingArguments
 )
 from datasets import Dataset
 import json
 import os
-from typing import List, Dict
+import random
+from typing import List, Dict, Optional, Union
 import argparse
+from model_registry import get_model
+from token_shards import SPECIAL_TOKENS, TokenShardDataset, pack_blocks
+from checkpointing import AsyncCheckpointTrainer, latest_checkpoint
+from lora_adapters import add_lora, is_adapter
+
+class CausalLMCollator:
+    """Pad each batch to its own longest example and keep padding out of the loss
+
+    DataCollatorForLanguageModeling masks labels equal to pad_token_id,
+    which is EOS here, so it would also hide the end of every story from
+    the loss. This collator masks by attention_mask instead.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def __call__(self, features: List[Dict]) -> Dict[str, torch.Tensor]:
+        batch = self.tokenizer.pad(
+            [{"input_ids": f["input_ids"], "attention_mask": f["attention_mask"]} for f in features],
+            return_tensors="pt"
+        )
+        labels = batch["input_ids"].clone()
+        labels[batch["attention_mask"] == 0] = -100
+        batch["labels"] = labels
+        return batch
 
 class AnimeModelFineTuner:
     def __init__(self, base_model: str = "microsoft/DialoGPT-medium"):
@@ -37,22 +63,21 @@ class AnimeModelFineTuner:
             self.tokenizer.pad_token = self.tokenizer.eos_token
         
         # Add special tokens for anime storytelling
-        special_tokens = {
-            'additional_special_tokens': [
-                '[SCENE]', '[CHARACTER]', '[DIALOGUE]', '[ACTION]',
-                '[SHONEN]', '[SHOJO]', '[ISEKAI]', '[MECHA]', 
-                '[SLICE_OF_LIFE]', '[ROMANCE]', '[ACTION]'
-            ]
-        }
-        self.tokenizer.add_special_tokens(special_tokens)
+        self.tokenizer.add_special_tokens({'additional_special_tokens': SPECIAL_TOKENS})
         self.model.resize_token_embeddings(len(self.tokenizer))
         
         print(f"Model loaded successfully!")
         print(f"Vocabulary size: {len(self.tokenizer)}")
         print(f"Model parameters: {self.model.num_parameters():,}")
 
-    def create_anime_dataset(self, data_path: str = "data/anime_stories.json") -> Dataset:
-        """Create anime story dataset"""
+    def create_anime_dataset(self, data_path: str = "data/anime_stories.json",
+                             eval_fraction: float = 0.0, eval_path: Optional[str] = None) -> Dataset:
+        """Create anime story dataset
+        
+        With eval_fraction, a fixed random sample of the stories is held out
+        of training and saved to eval_path (default: data_path with an
+        _eval suffix) in the same format, e.g. for quantize_model.py.
+        """
         
         # Create sample anime stories if data doesn't exist
         if not os.path.exists(data_path):
@@ -63,6 +88,18 @@ class AnimeModelFineTuner:
         with open(data_path, 'r', encoding='utf-8') as f:
             stories = json.load(f)
         
+        if eval_fraction > 0:
+            # Seeded, so reruns hold out the same stories
+            num_eval = int(len(stories) * eval_fraction)
+            eval_indices = set(random.Random(42).sample(range(len(stories)), num_eval))
+            eval_stories = [story for i, story in enumerate(stories) if i in eval_indices]
+            stories = [story for i, story in enumerate(stories) if i not in eval_indices]
+            
+            eval_path = eval_path or f"{os.path.splitext(data_path)[0]}_eval.json"
+            with open(eval_path, 'w', encoding='utf-8') as f:
+                json.dump(eval_stories, f, indent=2, ensure_ascii=False)
+            print(f"Held out {len(eval_stories)} stories for evaluation in {eval_path}")
+        
         # Format stories for training
         formatted_stories = []
         for story in stories:
@@ -136,17 +173,29 @@ class AnimeModelFineTuner:
         
         print(f"Created {len(expanded_stories)} anime stories")
 
-    def prepare_dataset_for_training(self, dataset: Dataset) -> Dataset:
-        """Prepare dataset for training"""
+    def prepare_dataset_for_training(self, dataset: Dataset, packing: bool = True,
+                                     max_length: int = 512) -> Dataset:
+        """Prepare dataset for training
+        
+        With packing, stories are joined with EOS and cut into full
+        max_length blocks, so batches need no padding; the tokens left
+        after the last full block are dropped. Without it, every
+        story stays on its own and its length is kept for group_by_length,
+        which batches stories of similar length together.
+        """
+        eos_token_id = self.tokenizer.eos_token_id
         
         def tokenize_function(examples):
-            return self.tokenizer(
+            tokenized = self.tokenizer(
                 examples["text"],
-                truncation=True,
-                padding=True,
-                max_length=512,
-                return_tensors="pt"
+                truncation=not packing,
+                max_length=max_length
             )
+            if packing:
+                # End every story with EOS so the model learns where stories stop
+                return {"input_ids": [ids + [eos_token_id] for ids in tokenized["input_ids"]]}
+            tokenized["length"] = [len(ids) for ids in tokenized["input_ids"]]
+            return tokenized
         
         tokenized_dataset = dataset.map(
             tokenize_function,
@@ -154,24 +203,58 @@ class AnimeModelFineTuner:
             remove_columns=dataset.column_names
         )
         
+        if packing:
+            # One pass over the whole corpus, so blocks run on across map batches
+            tokenized_dataset = pack_blocks(tokenized_dataset, max_length, attention_mask=True)
+        
+        num_tokens = sum(len(ids) for ids in tokenized_dataset["input_ids"])
+        print(f"Prepared {len(tokenized_dataset)} training sequences with {num_tokens:,} tokens "
+              f"({'packed' if packing else 'grouped by length'})")
         return tokenized_dataset
 
+    def load_token_shards(self, shards_dir: str, packing: bool = True,
+                          max_length: int = 512) -> TokenShardDataset:
+        """Open a token shard corpus (see token_shards.py) for training
+        
+        The shards are read through memory maps, so this is instant and
+        uses constant memory however large the corpus is.
+        """
+        shards = TokenShardDataset(shards_dir, block_size=max_length if packing else None,
+                                   max_length=max_length, tokenizer=self.tokenizer)
+        print(f"Opened {len(shards):,} training sequences with {shards.num_tokens:,} tokens "
+              f"from {len(shards.metadata['shards'])} shards")
+        return shards
+
     def fine_tune(self, 
-                  dataset: Dataset,
+                  dataset: Union[Dataset, TokenShardDataset],
                   output_dir: str = "./anime_model",
                   num_epochs: int = 3,
                   batch_size: int = 4,
-                  learning_rate: float = 5e-5):
-        """Fine-tune the model"""
+                  learning_rate: float = 5e-5,
+                  packing: bool = True,
+                  resume: bool = True,
+                  lora: bool = False,
+                  lora_rank: int = 8):
+        """Fine-tune the model (dataset is raw stories, or token shards that are already tokenized)
+        
+        With resume, training continues from the newest complete checkpoint
+        in output_dir, if there is one. With lora, only LoRA adapters and the
+        special token embeddings are trained, and output_dir gets a small
+        adapter instead of a full model.
+        """
         
-        print("Preparing dataset for training...")
-        tokenized_dataset = self.prepare_dataset_for_training(dataset)
+        if lora:
+            self.model = add_lora(self.model, self.tokenizer.additional_special_tokens_ids, rank=lora_rank)
         
-        # Data collator
-        data_collator = DataCollatorForLanguageModeling(
-            tokenizer=self.tokenizer,
-            mlm=False
-        )
+        if isinstance(dataset, TokenShardDataset):
+            tokenized_dataset = dataset
+            packing = dataset.block_size is not None
+        else:
+            print("Preparing dataset for training...")
+            tokenized_dataset = self.prepare_dataset_for_training(dataset, packing=packing)
+        
+        # Data collator (pads only what is left unpacked and masks it out of the loss)
+        data_collator = CausalLMCollator(self.tokenizer)
         
         # Training arguments
         training_args = TrainingArguments(
@@ -189,10 +272,12 @@ class AnimeModelFineTuner:
             evaluation_strategy="no",
             report_to="none",
             dataloader_drop_last=True,
+            # Shards would have to read every story to sort them by length
+            group_by_length=not packing and isinstance(tokenized_dataset, Dataset),
         )
         
-        # Initialize trainer
-        trainer = Trainer(
+        # Initialize trainer (checkpoints are written in the background)
+        trainer = AsyncCheckpointTrainer(
             model=self.model,
             args=training_args,
             data_collator=data_collator,
@@ -203,8 +288,20 @@ class AnimeModelFineTuner:
         print(f"Training for {num_epochs} epochs with batch size {batch_size}")
         print(f"Learning rate: {learning_rate}")
         
-        # Train
-        trainer.train()
+        # Train, picking up from the last checkpoint of an interrupted run
+        checkpoint = latest_checkpoint(output_dir) if resume else None
+        if checkpoint:
+            print(f"Resuming from {checkpoint}")
+        train_output = trainer.train(resume_from_checkpoint=checkpoint)
+        
+        # Throughput in tokens that count towards the loss
+        if isinstance(tokenized_dataset, TokenShardDataset):
+            num_tokens = tokenized_dataset.num_tokens
+        else:
+            num_tokens = sum(len(ids) for ids in tokenized_dataset["input_ids"])
+        runtime = train_output.metrics.get("train_runtime")
+        if runtime:
+            print(f"Useful tokens/sec: {num_tokens * num_epochs / runtime:,.0f}")
         
         # Save model
         print(f"Saving fine-tuned model to {output_dir}")
@@ -217,9 +314,12 @@ class AnimeModelFineTuner:
     def test_model(self, model_path: str, prompt: str, genre: str = "[SHONEN]"):
         """Test the fine-tuned model"""
         
-        # Load fine-tuned model
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-        model = AutoModelForCausalLM.from_pretrained(model_path)
+        # Shared fine-tuned model, loaded once (and again only if it is retrained)
+        if is_adapter(model_path):
+            handle = get_model(self.base_model, adapters={"default": model_path}, merge_adapters=True)
+        else:
+            handle = get_model(model_path)
+        tokenizer, model = handle.tokenizer, handle.model
         
         # Prepare input
         full_prompt = f"{genre} [SCENE] {prompt}"
@@ -255,6 +355,12 @@ def main():
                        help="Base model to fine-tune")
     parser.add_argument("--data_path", default="data/anime_stories.json",
                        help="Path to anime stories dataset")
+    parser.add_argument("--eval_fraction", type=float, default=0.1,
+                       help="Fraction of the stories held out of training for evaluation")
+    parser.add_argument("--eval_path", default=None,
+                       help="Where to save the held-out stories (default: data_path with an _eval suffix)")
+    parser.add_argument("--shards_dir", default=None,
+                       help="Train on token shards written by token_shards.py instead of data_path")
     parser.add_argument("--output_dir", default="./anime_model",
                        help="Output directory for fine-tuned model")
     parser.add_argument("--epochs", type=int, default=3,
@@ -263,6 +369,14 @@ def main():
                        help="Training batch size")
     parser.add_argument("--learning_rate", type=float, default=5e-5,
                        help="Learning rate")
+    parser.add_argument("--no_packing", action="store_true",
+                       help="Keep stories unpacked and batch them by length instead")
+    parser.add_argument("--lora", action="store_true",
+                       help="Train LoRA adapters (and the special token embeddings) instead of every weight")
+    parser.add_argument("--lora_rank", type=int, default=8,
+                       help="Rank of the LoRA adapters")
+    parser.add_argument("--no_resume", action="store_true",
+                       help="Start from scratch instead of resuming from the last checkpoint")
     parser.add_argument("--test_only", action="store_true",
                        help="Only test existing model")
     
@@ -279,7 +393,10 @@ def main():
         fine_tuner = AnimeModelFineTuner(args.base_model)
         
         # Create dataset
-        dataset = fine_tuner.create_anime_dataset(args.data_path)
+        if args.shards_dir:
+            dataset = fine_tuner.load_token_shards(args.shards_dir, packing=not args.no_packing)
+        else:
+            dataset = fine_tuner.create_anime_dataset(args.data_path, args.eval_fraction, args.eval_path)
         
         # Fine-tune
         model_path = fine_tuner.fine_tune(
@@ -287,7 +404,11 @@ def main():
             output_dir=args.output_dir,
             num_epochs=args.epochs,
             batch_size=args.batch_size,
-            learning_rate=args.learning_rate
+            learning_rate=args.learning_rate,
+            packing=not args.no_packing,
+            resume=not args.no_resume,
+            lora=args.lora,
+            lora_rank=args.lora_rank
         )
         
         # Test the model
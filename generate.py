@@ -1,79 +1,318 @@
 import torch
 from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from threading import Thread
 import time
+from genres import GENRE_TAGS, genre_prefix
+from prefix_cache import PrefixKVCache
+from model_registry import get_model
+from speculative_decoding import AcceptanceCounter, load_draft_model
+from streaming import TokenStreamer
 
 class AnimeStoryGenerator:
-    def __init__(self, model_path='./models'):
-        self.device = torch.device('mps' if torch.backends.mps.is_available() else 'cpu')
+    def __init__(self, model_path='./models', quantized=False, draft_model=None):
+        device = torch.device('mps' if torch.backends.mps.is_available() else 'cpu')
         
-        print(f"Loading model from {model_path}...")
-        self.tokenizer = GPT2Tokenizer.from_pretrained(model_path)
-        self.model = GPT2LMHeadModel.from_pretrained(model_path)
-        self.model.to(self.device)
-        self.model.eval()
+        # The model is shared with every generator for the same path and is
+        # only loaded (memory-mapped) on first use
+        self.handle = get_model(
+            model_path, device=device, quantized=quantized,
+            model_class=GPT2LMHeadModel, tokenizer_class=GPT2Tokenizer
+        )
+        self.device = self.handle.device
+        self.last_stats = None
+        self._prefix_cache = None
         
-        print(f"Model loaded on {self.device}")
+        # Optional draft model for speculative decoding (e.g. 'distilgpt2')
+        self.draft_model_path = draft_model
+        self._draft = None
+        
+        print(f"Model {model_path} will load on {self.device} at first use")
+    
+    @property
+    def model(self):
+        return self.handle.model
+    
+    @property
+    def tokenizer(self):
+        tokenizer = self.handle.tokenizer
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        return tokenizer
+    
+    @property
+    def prefix_cache(self):
+        # Attention state of the "{genre} [SCENE]" preamble, computed once
+        if self._prefix_cache is None:
+            self._prefix_cache = PrefixKVCache(
+                self.model, self.tokenizer,
+                pinned=[genre_prefix(tag) for tag in GENRE_TAGS]
+            )
+        return self._prefix_cache
+    
+    @property
+    def draft(self):
+        if self._draft is None and self.draft_model_path:
+            self._draft = load_draft_model(self.draft_model_path, self.tokenizer, self.device)
+        return self._draft
     
     def generate_story(self, prompt, genre='[SHONEN]', max_length=300, 
-                      temperature=0.8, top_k=50, top_p=0.95):
-        """Generate an anime story"""
+                      temperature=0.8, top_k=50, top_p=0.95, compute_perplexity=True,
+                      preamble=''):
+        """Generate an anime story
+        
+        Perplexity and per-token log-probs come from the logits produced
+        during generation, so no second forward pass is needed. Pass
+        compute_perplexity=False to skip them entirely. Stats for the last
+        call are kept in self.last_stats.
+        
+        Generation starts from the cached attention state of the optional
+        preamble plus the genre and scene tags, so only the prompt itself
+        is prefilled. With a draft model, tokens are proposed by the draft
+        and verified by the main model, and the acceptance stats are added
+        to self.last_stats['speculative'].
+        """
         
         # Add genre tag to prompt
-        full_prompt = f"{genre} [SCENE] {prompt}"
+        prefix = genre_prefix(genre, preamble)
+        full_prompt = f"{prefix} {prompt}"
         
         print(f"\nPrompt: {full_prompt}\n")
         print("Generating story...\n")
         
-        # Tokenize
-        input_ids = self.tokenizer.encode(full_prompt, return_tensors='pt').to(self.device)
+        # Tokenize, reusing the cached prefix state
+        inputs = self.prefix_cache.prepare(prefix, prompt)
+        input_ids = inputs['input_ids']
+        
+        counter = None
+        if self.draft is not None:
+            inputs['assistant_model'] = self.draft
+            counter = AcceptanceCounter(self.model, self.draft)
         
         # Measure inference time
         start_time = time.time()
         
         # Generate
-        with torch.no_grad():
-            output = self.model.generate(
-                input_ids,
-                max_length=max_length,
-                temperature=temperature,
-                top_k=top_k,
-                top_p=top_p,
-                do_sample=True,
-                num_return_sequences=1,
-                pad_token_id=self.tokenizer.eos_token_id,
-                no_repeat_ngram_size=3
-            )
+        try:
+            with torch.no_grad():
+                output = self.model.generate(
+                    **inputs,
+                    max_length=max_length,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    do_sample=True,
+                    num_return_sequences=1,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    no_repeat_ngram_size=3,
+                    return_dict_in_generate=True,
+                    output_logits=compute_perplexity
+                )
+        finally:
+            if counter is not None:
+                counter.remove()
         
         end_time = time.time()
+        sequences = output.sequences
         
-        # Decode
-        generated_text = self.tokenizer.decode(output[0], skip_special_tokens=False)
+        # Decode only the new tokens (and not the closing EOS)
+        new_ids = sequences[0, input_ids.shape[1]:]
+        story_ids = new_ids[:-1] if len(new_ids) and new_ids[-1] == self.tokenizer.eos_token_id else new_ids
+        generated_text = self.tokenizer.decode(story_ids, skip_special_tokens=False)
         
-        # Calculate stats
-        num_tokens = len(output[0])
+        # Calculate stats (only count newly generated tokens)
+        num_tokens = len(new_ids)
         inference_time = end_time - start_time
         tokens_per_sec = num_tokens / inference_time
         
-        # Calculate perplexity (simplified)
-        with torch.no_grad():
-            outputs = self.model(output, labels=output)
-            perplexity = torch.exp(outputs.loss).item()
+        # Perplexity of the generated tokens under the model, from the raw
+        # (unwarped) logits returned by generate
+        token_logprobs = None
+        perplexity = None
+        if compute_perplexity:
+            token_logprobs = self.model.compute_transition_scores(
+                sequences, output.logits, normalize_logits=True
+            )[0]
+            perplexity = torch.exp(-token_logprobs.mean()).item()
+            token_logprobs = token_logprobs.tolist()
+        
+        self.last_stats = {
+            'num_tokens': num_tokens,
+            'inference_time': inference_time,
+            'tokens_per_sec': tokens_per_sec,
+            'perplexity': perplexity,
+            'token_logprobs': token_logprobs,
+            'token_ids': story_ids.tolist(),
+            'speculative': counter.stats(num_tokens) if counter is not None else None
+        }
         
         print("=" * 60)
         print("GENERATED STORY:")
         print("=" * 60)
-        print(generated_text)
+        print(f"{full_prompt}{generated_text}")
         print("\n" + "=" * 60)
         print("PERFORMANCE METRICS:")
         print("=" * 60)
         print(f"Tokens generated: {num_tokens}")
         print(f"Inference time: {inference_time:.2f} seconds")
         print(f"Speed: {tokens_per_sec:.0f} tokens/sec")
-        print(f"Perplexity: {perplexity:.2f}")
+        if perplexity is not None:
+            print(f"Perplexity: {perplexity:.2f}")
+        speculative = self.last_stats['speculative']
+        if speculative is not None and speculative['acceptance_rate'] is not None:
+            print(f"Draft acceptance: {speculative['acceptance_rate']:.0%} "
+                  f"({speculative['tokens_per_main_pass']:.1f} tokens per main forward pass)")
         print("=" * 60)
         
         return generated_text
 
+    def generate_batch(self, prompts, genres='[SHONEN]', max_length=300,
+                       temperature=0.8, top_k=50, top_p=0.95, compute_perplexity=True):
+        """Generate stories for many prompts with a single batched model.generate
+        
+        genres is one tag for every prompt or a list with one tag per prompt.
+        Prompts are left-padded with an attention mask, so each row continues
+        from its own last token. Returns one dict per prompt with the new
+        text, its token ids and its stats.
+        """
+        if isinstance(genres, str):
+            genres = [genres] * len(prompts)
+        if len(genres) != len(prompts):
+            raise ValueError("genres must be a single tag or one tag per prompt")
+        
+        full_prompts = [f"{genre} [SCENE] {prompt}" for prompt, genre in zip(prompts, genres)]
+        # Left-pad so every prompt ends at the same position; padding_side is
+        # passed per call since the tokenizer is shared with other generators
+        inputs = self.tokenizer(full_prompts, return_tensors='pt', padding=True,
+                                padding_side='left').to(self.device)
+        prompt_length = inputs['input_ids'].shape[1]
+        
+        start_time = time.time()
+        
+        with torch.no_grad():
+            output = self.model.generate(
+                **inputs,
+                max_length=max_length,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                do_sample=True,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.pad_token_id,
+                no_repeat_ngram_size=3,
+                return_dict_in_generate=True,
+                output_logits=compute_perplexity
+            )
+        
+        inference_time = time.time() - start_time
+        sequences = output.sequences
+        new_tokens = sequences[:, prompt_length:]
+        
+        token_logprobs = None
+        if compute_perplexity:
+            token_logprobs = self.model.compute_transition_scores(
+                sequences, output.logits, normalize_logits=True
+            )
+        
+        results = []
+        for i, full_prompt in enumerate(full_prompts):
+            # Rows that finish early are padded with EOS; keep up to the first one
+            eos_positions = (new_tokens[i] == self.tokenizer.eos_token_id).nonzero()
+            num_tokens = eos_positions[0].item() + 1 if len(eos_positions) else new_tokens.shape[1]
+            
+            story_ids = new_tokens[i, :num_tokens]
+            if len(story_ids) and story_ids[-1] == self.tokenizer.eos_token_id:
+                story_ids = story_ids[:-1]
+            
+            perplexity = None
+            item_logprobs = None
+            if token_logprobs is not None and num_tokens > 0:
+                item_logprobs = token_logprobs[i, :num_tokens]
+                perplexity = torch.exp(-item_logprobs.mean()).item()
+                item_logprobs = item_logprobs.tolist()
+            
+            results.append({
+                'prompt': full_prompt,
+                'text': self.tokenizer.decode(story_ids, skip_special_tokens=False),
+                'token_ids': story_ids.tolist(),
+                'num_tokens': num_tokens,
+                'inference_time': inference_time,
+                'perplexity': perplexity,
+                'token_logprobs': item_logprobs
+            })
+        
+        total_tokens = sum(result['num_tokens'] for result in results)
+        self.last_stats = {
+            'num_tokens': total_tokens,
+            'inference_time': inference_time,
+            'tokens_per_sec': total_tokens / inference_time,
+            'batch_size': len(results)
+        }
+        
+        return results
+
+    def generate_story_stream(self, prompt, genre='[SHONEN]', max_length=300,
+                              temperature=0.8, top_k=50, top_p=0.95, preamble='', token_ids=None):
+        """Generate an anime story, yielding text as tokens are decoded
+        
+        If token_ids is given (a list), it is filled with the new token ids
+        once the stream ends. self.last_stats is set once the stream ends
+        too; streamed stories have no perplexity.
+        """
+        
+        self.last_stats = None
+        inputs = self.prefix_cache.prepare(genre_prefix(genre, preamble), prompt)
+        
+        streamer = TokenStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=False)
+        generation_kwargs = dict(
+            **inputs,
+            max_length=max_length,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            do_sample=True,
+            num_return_sequences=1,
+            pad_token_id=self.tokenizer.eos_token_id,
+            no_repeat_ngram_size=3,
+            streamer=streamer
+        )
+        if self.draft is not None:
+            generation_kwargs['assistant_model'] = self.draft
+        
+        # model.generate blocks, so run it in a worker thread and read the
+        # decoded text from the streamer as it arrives. The acceptance
+        # counter only sees passes on its own thread, so it is made there.
+        counters = []
+        def run_generation():
+            if self.draft is not None:
+                counters.append(AcceptanceCounter(self.model, self.draft))
+            try:
+                with torch.no_grad():
+                    self.model.generate(**generation_kwargs)
+            finally:
+                if counters:
+                    counters[0].remove()
+        
+        start_time = time.time()
+        thread = Thread(target=run_generation, daemon=True)
+        thread.start()
+        for text in streamer:
+            yield text
+        thread.join()
+        inference_time = time.time() - start_time
+        if token_ids is not None:
+            token_ids.extend(streamer.token_ids)
+        
+        num_tokens = len(streamer.token_ids)
+        self.last_stats = {
+            'num_tokens': num_tokens,
+            'inference_time': inference_time,
+            'tokens_per_sec': num_tokens / inference_time,
+            'perplexity': None,
+            'token_logprobs': None,
+            'token_ids': list(streamer.token_ids),
+            'speculative': counters[0].stats(num_tokens) if counters else None
+        }
+
 def main():
     # Initialize generator
     generator = AnimeStoryGenerator()
@@ -112,16 +351,31 @@ def main():
         if not user_input:
             # Use example prompts
             print("\nGenerating example stories...\n")
-            for example in prompts[:2]:  # Generate 2 examples
-                generator.generate_story(
-                    prompt=example['prompt'],
-                    genre=example['genre'],
-                    max_length=200
-                )
+            results = generator.generate_batch(
+                prompts=[example['prompt'] for example in prompts],
+                genres=[example['genre'] for example in prompts],
+                max_length=200
+            )
+            
+            for result in results:
+                print("=" * 60)
+                print(f"{result['prompt']}{result['text']}")
+                perplexity = result['perplexity']
+                print(f"\nTokens: {result['num_tokens']}  "
+                      f"Perplexity: {'n/a' if perplexity is None else f'{perplexity:.2f}'}")
+            
+            stats = generator.last_stats
+            print("=" * 60)
+            print(f"Batch of {stats['batch_size']}: {stats['num_tokens']} tokens in "
+                  f"{stats['inference_time']:.2f} seconds ({stats['tokens_per_sec']:.0f} tokens/sec)")
+            print("=" * 60)
         else:
             # Get genre
             genre = input("Enter genre (default: [SHONEN]): ").strip() or '[SHONEN]'
-            generator.generate_story(prompt=user_input, genre=genre)
+            print(f"\n{genre} [SCENE] {user_input}", end="", flush=True)
+            for text in generator.generate_story_stream(prompt=user_input, genre=genre):
+                print(text, end="", flush=True)
+            print()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
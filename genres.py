@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Genre Tags
+The genre and scene tags every local prompt starts with, and the mapping
+from the app's genre keys to them. Kept free of torch so the ONNX backend
+can use it too.
+"""
+
+GENRE_TAGS = ["[SHONEN]", "[ISEKAI]", "[MECHA]", "[ROMANCE]", "[SLICE_OF_LIFE]", "[ACTION]"]
+
+# The app's genre keys; unknown genres fall back to shonen
+GENRE_TAG_BY_KEY = {
+    "shonen": "[SHONEN]",
+    "isekai": "[ISEKAI]",
+    "mecha": "[MECHA]",
+    "romance": "[ROMANCE]",
+    "slice": "[SLICE_OF_LIFE]",
+    "action": "[ACTION]"
+}
+
+def genre_tag(genre: str) -> str:
+    """Return the tag for one of the app's genre keys"""
+    return GENRE_TAG_BY_KEY.get(genre, "[SHONEN]")
+
+def genre_prefix(genre_tag: str, preamble: str = "") -> str:
+    """Return the cached part of a prompt: optional preamble, genre and scene tags"""
+    return f"{preamble}{genre_tag} [SCENE]"
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Local Inference Server
+Serves the fine-tuned anime model to many concurrent users from one box.
+Requests wait in a queue and a scheduler thread runs iteration-level
+(continuous) batching: each step decodes one token for every running
+request, and new requests join the batch at the next token boundary
+instead of waiting for the whole batch to finish. Every request owns a KV
+cache slot sized for its prompt plus its token budget, and prefill starts
+from the cached attention state of the genre prefix.
+
+A small HTTP API (POST /generate, GET /health) lets app.py use the server
+as a provider; set LOCAL_MODEL_URL in the Streamlit secrets.
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+import torch
+from transformers import (
+    DynamicCache, LogitsProcessorList, NoRepeatNGramLogitsProcessor,
+    TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+)
+
+from genres import GENRE_TAGS, genre_prefix
+from prefix_cache import PrefixKVCache
+
+MAX_BATCH_SIZE = 8            # requests decoded together in one step
+REQUEST_TIMEOUT_SECONDS = 120.0
+
+class KVSlot:
+    """Per-request KV cache, preallocated for the prompt plus the token budget"""
+
+    def __init__(self, past_key_values, capacity: int):
+        self.length = past_key_values[0][0].shape[2]
+        self.keys = []
+        self.values = []
+        for key, value in past_key_values:
+            heads, _, head_dim = key.shape[1:]
+            self.keys.append(key.new_zeros(heads, capacity, head_dim))
+            self.values.append(value.new_zeros(heads, capacity, head_dim))
+            self.keys[-1][:, :self.length] = key[0]
+            self.values[-1][:, :self.length] = value[0]
+
+@dataclass
+class InferenceRequest:
+    """One generation request and its progress through the scheduler"""
+
+    input_ids: List[int]
+    max_new_tokens: int = 200
+    temperature: float = 0.8
+    top_k: int = 50
+    top_p: float = 0.95
+    output_ids: List[int] = field(default_factory=list)
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=time.time)
+    admitted_at: Optional[float] = None
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+    prefix_past: Optional[tuple] = field(default=None, repr=False)
+    slot: Optional[KVSlot] = field(default=None, repr=False)
+    processors: Optional[LogitsProcessorList] = field(default=None, repr=False)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done.wait(timeout)
+
+class ContinuousBatchingEngine:
+    def __init__(self, model, tokenizer, max_batch_size: int = MAX_BATCH_SIZE,
+                 prefix_cache: Optional[PrefixKVCache] = None):
+        """
+        Initialize the engine around a loaded causal LM
+
+        Args:
+            model: Model returning past_key_values (e.g. GPT2LMHeadModel)
+            tokenizer: Matching tokenizer
+            max_batch_size: Requests decoded together in one step
+            prefix_cache: Cached prompt prefixes (defaults to the genre prefixes)
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache or PrefixKVCache(
+            model, tokenizer, pinned=[genre_prefix(tag) for tag in GENRE_TAGS]
+        )
+        self.device = next(model.parameters()).device
+        self.max_positions = (getattr(model.config, "n_positions", None)
+                              or getattr(model.config, "max_position_embeddings", 1024))
+
+        self._queue = queue.Queue()
+        self._active: List[InferenceRequest] = []
+        self._uses_cache_class = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids: List[int], max_new_tokens: int = 200,
+               temperature: float = 0.8, top_k: int = 50, top_p: float = 0.95,
+               prefix_past: Optional[tuple] = None) -> InferenceRequest:
+        """Queue a request; it joins the running batch at the next step
+
+        prefix_past is the cached state of the first input_ids, so prefill
+        only runs the tokens after it.
+        """
+        if len(input_ids) >= self.max_positions:
+            raise ValueError(f"Prompt is {len(input_ids)} tokens; the model allows {self.max_positions}")
+        request = InferenceRequest(
+            input_ids=list(input_ids),
+            max_new_tokens=min(max_new_tokens, self.max_positions - len(input_ids)),
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            prefix_past=prefix_past
+        )
+        self._queue.put(request)
+        return request
+
+    def generate(self, prompt: str, max_new_tokens: int = 200, temperature: float = 0.8,
+                 top_k: int = 50, top_p: float = 0.95, prefix: Optional[str] = None,
+                 timeout: Optional[float] = REQUEST_TIMEOUT_SECONDS) -> Dict:
+        """Generate a continuation of "{prefix} {prompt}", blocking until it is finished"""
+        prefix_past = None
+        if prefix is None:
+            input_ids = self.tokenizer.encode(prompt)
+        else:
+            prefix_ids, prefix_past = self.prefix_cache.get(prefix)
+            input_ids = prefix_ids + self.tokenizer.encode(f" {prompt}")
+        request = self.submit(input_ids, max_new_tokens, temperature, top_k, top_p, prefix_past)
+        if not request.wait(timeout):
+            raise TimeoutError(f"Generation did not finish within {timeout} seconds")
+        if request.error:
+            raise RuntimeError(request.error)
+
+        output_ids = request.output_ids
+        if output_ids and output_ids[-1] == self.tokenizer.eos_token_id:
+            output_ids = output_ids[:-1]
+        return {
+            "generated_text": self.tokenizer.decode(output_ids, skip_special_tokens=True).strip(),
+            "prompt_tokens": len(request.input_ids),
+            "completion_tokens": len(request.output_ids),
+            "queue_wait": request.admitted_at - request.submitted_at,
+            "time_to_first_token": request.first_token_at - request.submitted_at,
+            "latency": request.finished_at - request.submitted_at
+        }
+
+    def stats(self) -> Dict:
+        """Return the running and queued request counts"""
+        return {
+            "active": len(self._active),
+            "queued": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size
+        }
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._admit()
+                if self._active:
+                    self._step()
+            except Exception as e:
+                # Fail the running batch rather than the scheduler
+                for request in self._active:
+                    self._finish(request, error=str(e))
+                self._active = []
+
+    def _admit(self):
+        """Prefill queued requests into free batch slots"""
+        while len(self._active) < self.max_batch_size:
+            try:
+                # Block only when there is nothing to decode
+                request = self._queue.get(timeout=0.1) if not self._active else self._queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._prefill(request)
+            except Exception as e:
+                self._finish(request, error=str(e))
+
+    def _prefill(self, request: InferenceRequest):
+        request.admitted_at = time.time()
+        request.processors = self._processors(request)
+
+        # Only the tokens after the cached prefix need a forward pass
+        prefix_past = request.prefix_past
+        prefix_length = prefix_past[0][0].shape[2] if prefix_past is not None else 0
+        if prefix_past is not None:
+            prefix_past = self.prefix_cache.as_model_cache(prefix_past)
+        request.prefix_past = None
+
+        input_ids = torch.tensor([request.input_ids[prefix_length:]], device=self.device)
+        with torch.no_grad():
+            output = self.model(input_ids=input_ids, past_key_values=prefix_past, use_cache=True)
+
+        past = output.past_key_values
+        if hasattr(past, "to_legacy_cache"):
+            self._uses_cache_class = True
+            past = past.to_legacy_cache()
+        request.slot = KVSlot(past, len(request.input_ids) + request.max_new_tokens)
+
+        if self._append_token(request, output.logits[0, -1]):
+            self._active.append(request)
+
+    def _step(self):
+        """Decode one token for every running request in a single forward pass"""
+        lengths = [request.slot.length for request in self._active]
+        max_length = max(lengths)
+        batch_size = len(self._active)
+
+        # Gather the slots into one padded cache; the mask hides the padding
+        past = []
+        for layer in range(len(self._active[0].slot.keys)):
+            heads, _, head_dim = self._active[0].slot.keys[layer].shape
+            keys = self._active[0].slot.keys[layer].new_zeros(batch_size, heads, max_length, head_dim)
+            values = torch.zeros_like(keys)
+            for i, request in enumerate(self._active):
+                keys[i, :, :lengths[i]] = request.slot.keys[layer][:, :lengths[i]]
+                values[i, :, :lengths[i]] = request.slot.values[layer][:, :lengths[i]]
+            past.append((keys, values))
+        past = tuple(past)
+        if self._uses_cache_class:
+            past = DynamicCache.from_legacy_cache(past)
+
+        attention_mask = torch.zeros(batch_size, max_length + 1, dtype=torch.long, device=self.device)
+        for i, length in enumerate(lengths):
+            attention_mask[i, :length] = 1
+        attention_mask[:, max_length] = 1
+
+        input_ids = torch.tensor([[request.output_ids[-1]] for request in self._active], device=self.device)
+        position_ids = torch.tensor([[length] for length in lengths], device=self.device)
+
+        with torch.no_grad():
+            output = self.model(
+                input_ids=input_ids,
+                past_key_values=past,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=True
+            )
+
+        present = output.past_key_values
+        if hasattr(present, "to_legacy_cache"):
+            present = present.to_legacy_cache()
+
+        still_active = []
+        for i, request in enumerate(self._active):
+            # Scatter the new token's keys and values back into its slot
+            for layer, (key, value) in enumerate(present):
+                request.slot.keys[layer][:, lengths[i]] = key[i, :, -1]
+                request.slot.values[layer][:, lengths[i]] = value[i, :, -1]
+            request.slot.length += 1
+
+            if self._append_token(request, output.logits[i, -1]):
+                still_active.append(request)
+        self._active = still_active
+
+    def _processors(self, request: InferenceRequest) -> LogitsProcessorList:
+        """Build the same sampling pipeline model.generate uses"""
+        processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(3)])
+        if request.temperature > 0:
+            processors.append(TemperatureLogitsWarper(request.temperature))
+            if request.top_k:
+                processors.append(TopKLogitsWarper(request.top_k))
+            if request.top_p < 1.0:
+                processors.append(TopPLogitsWarper(request.top_p))
+        return processors
+
+    def _append_token(self, request: InferenceRequest, logits: torch.Tensor) -> bool:
+        """Sample the next token; return False once the request is finished"""
+        input_ids = torch.tensor([request.input_ids + request.output_ids], device=self.device)
+        scores = request.processors(input_ids, logits[None].float())
+
+        if request.temperature > 0:
+            token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).item()
+        else:
+            token = scores.argmax(dim=-1).item()
+
+        request.output_ids.append(token)
+        if request.first_token_at is None:
+            request.first_token_at = time.time()
+
+        if token == self.tokenizer.eos_token_id or len(request.output_ids) >= request.max_new_tokens:
+            self._finish(request)
+            return False
+        return True
+
+    def _finish(self, request: InferenceRequest, error: Optional[str] = None):
+        request.error = error
+        request.slot = None
+        request.finished_at = time.time()
+        if request.admitted_at is None:
+            request.admitted_at = request.finished_at
+        if request.first_token_at is None:
+            request.first_token_at = request.finished_at
+        request.done.set()
+
+def make_handler(engine: ContinuousBatchingEngine, prompt_prefix: Callable[[str], str]):
+    """Build the HTTP handler class for an engine"""
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, body: Dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, engine.stats())
+            else:
+                self._send_json(404, {"error": "Not found"})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._send_json(404, {"error": "Not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                result = engine.generate(
+                    payload["prompt"],
+                    prefix=prompt_prefix(payload.get("genre", "shonen")),
+                    max_new_tokens=int(payload.get("max_new_tokens", 200)),
+                    temperature=float(payload.get("temperature", 0.8)),
+                    top_p=float(payload.get("top_p", 0.95))
+                )
+            except (KeyError, ValueError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            except TimeoutError as e:
+                self._send_json(504, {"error": str(e)})
+                return
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+                return
+            self._send_json(200, result)
+
+        def log_message(self, format, *args):
+            # Keep the console for startup messages
+            pass
+
+    return InferenceHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fine-tuned anime model with continuous batching")
+    parser.add_argument("--model_path", type=str, default="./anime_model",
+                       help="Path to the fine-tuned model")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                       help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765,
+                       help="Port for the HTTP API")
+    parser.add_argument("--max_batch_size", type=int, default=MAX_BATCH_SIZE,
+                       help="Requests decoded together in one step")
+    parser.add_argument("--quantized", action="store_true",
+                       help="Quantize the model to int8 for CPU inference")
+    args = parser.parse_args()
+
+    from integrate_finetuned_model import FineTunedAnimeGenerator
+
+    generator = FineTunedAnimeGenerator(args.model_path, quantized=args.quantized)
+    if not generator.is_loaded:
+        raise SystemExit(f"Could not load a model from {args.model_path}")
+
+    engine = ContinuousBatchingEngine(generator.model, generator.tokenizer, args.max_batch_size,
+                                      prefix_cache=generator.prefix_cache)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(engine, generator._genre_prefix))
+    print(f"Serving {args.model_path} at http://{args.host}:{args.port}/generate (Ctrl+C to stop)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.stop()
+
+if __name__ == "__main__":
+    main()
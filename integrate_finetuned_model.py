@@ -5,39 +5,124 @@ Add your custom fine-tuned anime model to the Streamlit app.
 """
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
 import streamlit as st
-from typing import Dict
+from threading import Thread
+from typing import Dict, Iterator, List, Optional
+from lora_adapters import BASE_ADAPTER
+from model_registry import get_model
+from genres import GENRE_TAGS, genre_prefix, genre_tag
+from prefix_cache import PrefixKVCache
+from speculative_decoding import AcceptanceCounter, load_draft_model
+from streaming import TokenStreamer
 
 class FineTunedAnimeGenerator:
-    def __init__(self, model_path: str = "./anime_model"):
+    def __init__(self, model_path: str = "./anime_model", quantized: bool = False,
+                 draft_model: Optional[str] = None, adapters: Optional[Dict[str, str]] = None,
+                 merge_adapters: bool = False):
         """
         Initialize fine-tuned model generator
         
         Args:
-            model_path: Path to your fine-tuned model
+            model_path: Path to your fine-tuned model (or a quantize_model.py artifact),
+                or the base model the LoRA adapters were trained on
+            quantized: Quantize the model to int8 for CPU inference
+            draft_model: Small model sharing the tokenizer (e.g. "distilgpt2")
+                for speculative decoding
+            adapters: LoRA adapters saved by fine_tune_anime_model.py --lora, by genre
+                ("shonen", "mecha", ...; "default" for every other genre). Each
+                request uses its genre's adapter on the shared base model
+            merge_adapters: Merge a single adapter into the weights instead
         """
         self.model_path = model_path
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        
+        # The model is shared with every generator for the same path and is
+        # only loaded (memory-mapped) the first time it is needed
+        self.handle = get_model(model_path, device=device, quantized=quantized,
+                                adapters=adapters, merge_adapters=merge_adapters)
+        self.device = self.handle.device
+        # Adapters chosen per request (merged adapters need no choosing)
+        self.adapters = {} if merge_adapters else dict(adapters or {})
+        self._prefix_caches: Dict[Optional[str], PrefixKVCache] = {}
+        self._load_error: Optional[str] = None
+        self.draft_model_path = draft_model
+        self._draft = None
+
+    @property
+    def is_loaded(self) -> bool:
+        """Load the model on first check; False if it cannot be loaded"""
+        if self.handle.loaded:
+            return True
+        if self._load_error is not None:
+            return False
         
-        # Load model and tokenizer
         try:
-            print(f"Loading fine-tuned model from {model_path}...")
-            self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-            self.model = AutoModelForCausalLM.from_pretrained(model_path)
-            self.model.to(self.device)
-            self.model.eval()
+            print(f"Loading fine-tuned model from {self.model_path}...")
+            self.handle.load()
             
             print(f"Fine-tuned model loaded successfully!")
             print(f"Device: {self.device}")
             print(f"Model parameters: {self.model.num_parameters():,}")
-            
-            self.is_loaded = True
+            return True
             
         except Exception as e:
+            self._load_error = str(e)
             print(f"Failed to load fine-tuned model: {e}")
             print("Falling back to template generation...")
-            self.is_loaded = False
+            return False
+
+    @property
+    def model(self):
+        return self.handle.model
+
+    @property
+    def tokenizer(self):
+        return self.handle.tokenizer
+
+    @property
+    def prefix_cache(self) -> PrefixKVCache:
+        return self._prefix_cache_for(None)
+
+    def _prefix_cache_for(self, adapter: Optional[str]) -> PrefixKVCache:
+        # Attention state of the "{genre} [SCENE]" preamble, computed once
+        # (per adapter, since each adapter changes it)
+        if adapter not in self._prefix_caches:
+            self._prefix_caches[adapter] = PrefixKVCache(
+                self.model, self.tokenizer,
+                pinned=[genre_prefix(tag) for tag in GENRE_TAGS],
+                forward_kwargs={"adapter_names": [adapter]} if adapter else None
+            )
+        return self._prefix_caches[adapter]
+
+    def _adapter_for(self, genre: str) -> Optional[str]:
+        """Return the LoRA adapter a genre is generated with (None without adapters)"""
+        if not self.adapters:
+            return None
+        if genre in self.adapters:
+            return genre
+        return "default" if "default" in self.adapters else BASE_ADAPTER
+
+    def _prepare(self, prompt: str, genre: str) -> Dict:
+        """Build generate inputs from the cached genre prefix, with the genre's adapter"""
+        adapter = self._adapter_for(genre)
+        inputs = self._prefix_cache_for(adapter).prepare(self._genre_prefix(genre), prompt)
+        if adapter:
+            inputs["adapter_names"] = [adapter]
+        return inputs
+
+    @property
+    def draft(self):
+        if self._draft is None and self.draft_model_path:
+            self._draft = load_draft_model(self.draft_model_path, self.tokenizer, self.device)
+        return self._draft
+
+    def _genre_prefix(self, genre: str) -> str:
+        """Return the genre and scene tags that start every prompt"""
+        return genre_prefix(genre_tag(genre))
+
+    def _full_prompt(self, prompt: str, genre: str) -> str:
+        """Prefix the prompt with its genre and scene tags"""
+        return f"{self._genre_prefix(genre)} {prompt}"
 
     def generate_story(self, prompt: str, genre: str, max_length: int = 200) -> Dict:
         """Generate story using fine-tuned model"""
@@ -50,46 +135,51 @@ class FineTunedAnimeGenerator:
             }
         
         try:
-            # Prepare prompt with genre
-            genre_prefix = {
-                "shonen": "[SHONEN]",
-                "isekai": "[ISEKAI]", 
-                "mecha": "[MECHA]",
-                "romance": "[ROMANCE]",
-                "slice": "[SLICE_OF_LIFE]",
-                "action": "[ACTION]"
-            }.get(genre, "[SHONEN]")
-            
-            full_prompt = f"{genre_prefix} [SCENE] {prompt}"
+            # Tokenize, reusing the cached genre prefix state
+            inputs = self._prepare(prompt, genre)
+            input_ids = inputs["input_ids"]
             
-            # Tokenize
-            input_ids = self.tokenizer.encode(full_prompt, return_tensors='pt').to(self.device)
+            # Let the draft model propose tokens for the main model to verify
+            counter = None
+            if self.draft is not None:
+                inputs["assistant_model"] = self.draft
+                counter = AcceptanceCounter(self.model, self.draft)
             
             # Generate
-            with torch.no_grad():
-                output = self.model.generate(
-                    input_ids,
-                    max_length=input_ids.shape[1] + max_length,
-                    temperature=0.8,
-                    top_p=0.95,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    no_repeat_ngram_size=3,
-                    num_return_sequences=1
-                )
-            
-            # Decode
-            generated_text = self.tokenizer.decode(output[0], skip_special_tokens=True)
+            try:
+                with torch.no_grad():
+                    output = self.model.generate(
+                        **inputs,
+                        max_length=input_ids.shape[1] + max_length,
+                        temperature=0.8,
+                        top_p=0.95,
+                        do_sample=True,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        no_repeat_ngram_size=3,
+                        num_return_sequences=1
+                    )
+            finally:
+                if counter is not None:
+                    counter.remove()
             
-            # Extract only the generated part (remove input prompt)
-            if full_prompt in generated_text:
-                generated_text = generated_text.split(full_prompt, 1)[1].strip()
+            # Decode only the new tokens, without the closing EOS
+            new_ids = output[0, input_ids.shape[1]:]
+            completion_tokens = len(new_ids)
+            if len(new_ids) and new_ids[-1] == self.tokenizer.eos_token_id:
+                new_ids = new_ids[:-1]
+            generated_text = self.tokenizer.decode(new_ids, skip_special_tokens=True).strip()
             
-            return {
+            result = {
                 "success": True,
                 "text": generated_text,
-                "provider": "Fine-tuned Anime Model"
+                "token_ids": new_ids.tolist(),
+                "provider": "Fine-tuned Anime Model",
+                "prompt_tokens": input_ids.shape[1],
+                "completion_tokens": completion_tokens
             }
+            if counter is not None:
+                result["speculative"] = counter.stats(completion_tokens)
+            return result
             
         except Exception as e:
             return {
@@ -98,6 +188,48 @@ class FineTunedAnimeGenerator:
                 "provider": "Fine-tuned Model"
             }
 
+    def generate_story_stream(self, prompt: str, genre: str, max_length: int = 200,
+                              token_ids: Optional[List[int]] = None) -> Iterator[str]:
+        """Generate story using fine-tuned model, yielding text as it is decoded
+        
+        If token_ids is given, it is filled with the new token ids once the
+        stream ends.
+        """
+        
+        if not self.is_loaded:
+            raise RuntimeError("Fine-tuned model not loaded")
+        
+        inputs = self._prepare(prompt, genre)
+        input_ids = inputs["input_ids"]
+        
+        streamer = TokenStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generation_kwargs = dict(
+            **inputs,
+            max_length=input_ids.shape[1] + max_length,
+            temperature=0.8,
+            top_p=0.95,
+            do_sample=True,
+            pad_token_id=self.tokenizer.eos_token_id,
+            no_repeat_ngram_size=3,
+            num_return_sequences=1,
+            streamer=streamer
+        )
+        if self.draft is not None:
+            generation_kwargs["assistant_model"] = self.draft
+        
+        # Generate in a worker thread; the streamer hands back decoded text
+        def run_generation():
+            with torch.no_grad():
+                self.model.generate(**generation_kwargs)
+        
+        thread = Thread(target=run_generation, daemon=True)
+        thread.start()
+        for text in streamer:
+            yield text
+        thread.join()
+        if token_ids is not None:
+            token_ids.extend(streamer.token_ids)
+
 def add_finetuned_to_app():
     """Add fine-tuned model option to the main app"""
     
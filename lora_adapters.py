@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+LoRA Adapters
+Parameter-efficient fine-tuning for the story models with peft. Low-rank
+adapters are added to the attention and MLP projections, and of the
+embeddings only the rows of our special tokens ([SCENE], genre tags, ...)
+are trained, so optimizer state and checkpoints cover a small fraction of
+the weights. Each run saves a small adapter directory that is either
+merged into the base model at load time or kept separate and selected per
+request, e.g. one adapter per genre on a single shared base model.
+
+Requires peft>=0.15 (for trainable_token_indices).
+"""
+
+import os
+from typing import Dict, Iterable
+
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+
+# GPT-2 / DialoGPT attention (c_attn, attn.c_proj) and MLP (c_fc, mlp.c_proj) projections
+LORA_TARGET_MODULES = ["c_attn", "c_proj", "c_fc"]
+
+# Adapter name peft uses for "no adapter" in a request's adapter_names
+BASE_ADAPTER = "__base__"
+
+def is_adapter(path: str) -> bool:
+    """Check whether path is a saved LoRA adapter rather than a full model"""
+    return os.path.exists(os.path.join(path, ADAPTER_CONFIG_NAME))
+
+def add_lora(model, trainable_token_ids: Iterable[int], rank: int = 8, alpha: int = 16,
+             dropout: float = 0.05):
+    """Wrap a model for LoRA training; only the adapters and the given embedding rows are trained"""
+    from peft import LoraConfig, get_peft_model
+
+    config = LoraConfig(
+        task_type="CAUSAL_LM",
+        r=rank,
+        lora_alpha=alpha,
+        lora_dropout=dropout,
+        target_modules=LORA_TARGET_MODULES,
+        # GPT-2 style projections are Conv1D, which stores its weight transposed
+        fan_in_fan_out=True,
+        trainable_token_indices=sorted(set(trainable_token_ids)) or None
+    )
+    model = get_peft_model(model, config)
+    model.print_trainable_parameters()
+    return model
+
+def load_adapters(model, adapters: Dict[str, str], tokenizer, merge: bool = False):
+    """Load named LoRA adapters onto a base model
+
+    With merge, the single adapter is folded into the weights and a plain
+    model is returned, so inference costs nothing extra. Otherwise the
+    adapters stay separate and each generate call picks one with
+    adapter_names.
+    """
+    from peft import PeftModel
+
+    if merge and len(adapters) > 1:
+        raise ValueError("Only a single LoRA adapter can be merged into the weights")
+
+    # The adapters were trained with the special tokens added to the vocabulary
+    if model.get_input_embeddings().num_embeddings < len(tokenizer):
+        model.resize_token_embeddings(len(tokenizer))
+
+    names = list(adapters)
+    model = PeftModel.from_pretrained(model, adapters[names[0]], adapter_name=names[0])
+    for name in names[1:]:
+        model.load_adapter(adapters[name], adapter_name=name)
+
+    if merge:
+        model = model.merge_and_unload()
+    model.eval()
+    return model
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Story Generator Metrics
+Prometheus/OpenMetrics instrumentation for the provider chain: calls,
+successes and errors per provider, latency histograms, token counts,
+which provider served each story, template fallbacks and cache hits.
+
+Metrics live in this module (not app.py) so they are registered once per
+process even though Streamlit re-executes app.py on every rerun.
+"""
+
+import argparse
+import time
+from typing import Optional
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, generate_latest,
+    start_http_server, write_to_textfile
+)
+
+REGISTRY = CollectorRegistry()
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+
+PROVIDER_REQUESTS = Counter(
+    "anime_story_provider_requests_total",
+    "Provider calls that reached the network",
+    ["provider"], registry=REGISTRY
+)
+PROVIDER_SUCCESSES = Counter(
+    "anime_story_provider_successes_total",
+    "Provider calls that returned a story",
+    ["provider"], registry=REGISTRY
+)
+PROVIDER_ERRORS = Counter(
+    "anime_story_provider_errors_total",
+    "Provider calls that failed, by HTTP status code ('none' for transport errors)",
+    ["provider", "status_code"], registry=REGISTRY
+)
+PROVIDER_LATENCY = Histogram(
+    "anime_story_provider_latency_seconds",
+    "Latency of individual provider calls",
+    ["provider"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+STORIES_SERVED = Counter(
+    "anime_story_stories_served_total",
+    "Stories returned to users, by the provider that served them",
+    ["provider", "cached"], registry=REGISTRY
+)
+TEMPLATE_FALLBACKS = Counter(
+    "anime_story_template_fallbacks_total",
+    "Stories served by the template fallback because every provider failed",
+    registry=REGISTRY
+)
+STORY_LATENCY = Histogram(
+    "anime_story_latency_seconds",
+    "End-to-end latency of served stories",
+    ["provider"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "anime_story_time_to_first_token_seconds",
+    "Time until the first chunk of a served story",
+    ["provider"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+TOKENS = Counter(
+    "anime_story_tokens_total",
+    "Tokens reported by providers, by kind (prompt or completion)",
+    ["provider", "kind"], registry=REGISTRY
+)
+CACHE_LOOKUPS = Counter(
+    "anime_story_cache_lookups_total",
+    "Story cache lookups, by result (hit or miss)",
+    ["result"], registry=REGISTRY
+)
+
+_server_port = None
+
+def record_provider_call(api_name: str, success: bool, latency: float,
+                         status_code: Optional[int] = None):
+    """Record one provider call that reached the network"""
+    PROVIDER_REQUESTS.labels(provider=api_name).inc()
+    PROVIDER_LATENCY.labels(provider=api_name).observe(latency)
+    if success:
+        PROVIDER_SUCCESSES.labels(provider=api_name).inc()
+    else:
+        PROVIDER_ERRORS.labels(provider=api_name, status_code=str(status_code or "none")).inc()
+
+def record_story(provider: str, cached: bool = False,
+                 latency: Optional[float] = None,
+                 time_to_first_token: Optional[float] = None,
+                 prompt_tokens: Optional[int] = None,
+                 completion_tokens: Optional[int] = None):
+    """Record a story served to a user and the provider that served it"""
+    STORIES_SERVED.labels(provider=provider, cached=str(cached).lower()).inc()
+    if provider == "Template Fallback":
+        TEMPLATE_FALLBACKS.inc()
+    if cached:
+        return
+
+    if latency is not None:
+        STORY_LATENCY.labels(provider=provider).observe(latency)
+    if time_to_first_token is not None:
+        TIME_TO_FIRST_TOKEN.labels(provider=provider).observe(time_to_first_token)
+    if prompt_tokens:
+        TOKENS.labels(provider=provider, kind="prompt").inc(prompt_tokens)
+    if completion_tokens:
+        TOKENS.labels(provider=provider, kind="completion").inc(completion_tokens)
+
+def record_cache_lookup(hit: bool):
+    """Record a story cache lookup"""
+    CACHE_LOOKUPS.labels(result="hit" if hit else "miss").inc()
+
+def start_metrics_server(port: int, addr: str = "0.0.0.0") -> int:
+    """Expose /metrics on a side HTTP port; later calls are no-ops"""
+    global _server_port
+    if _server_port is None:
+        start_http_server(port, addr=addr, registry=REGISTRY)
+        _server_port = port
+    return _server_port
+
+def write_metrics_file(path: str):
+    """Atomically write the current metrics to a scrape file"""
+    write_to_textfile(path, REGISTRY)
+
+def render_metrics() -> str:
+    """Return the current metrics in the Prometheus text format"""
+    return generate_latest(REGISTRY).decode("utf-8")
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve sample story generator metrics locally")
+    parser.add_argument("--port", type=int, default=9464,
+                       help="Port for the /metrics endpoint")
+    args = parser.parse_args()
+
+    # Record a few sample events so the endpoint has something to show
+    record_provider_call("openai", False, 0.4, status_code=429)
+    record_provider_call("anthropic", True, 1.8, status_code=200)
+    record_story("Claude-3.5-Sonnet", latency=2.2, time_to_first_token=0.6,
+                 prompt_tokens=42, completion_tokens=310)
+    record_cache_lookup(False)
+
+    start_metrics_server(args.port)
+    print(f"Serving metrics at http://localhost:{args.port}/metrics (Ctrl+C to stop)")
+    print(render_metrics())
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
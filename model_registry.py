@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Model Registry
+One shared, lazily loaded copy of each local model per process. Weights
+in safetensors format are memory-mapped straight into the model instead
+of being read and copied, so startup is fast and processes on the same
+machine share the weights through the OS page cache. Load times are
+recorded for every model.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers.modeling_utils import no_init_weights
+
+from lora_adapters import load_adapters
+from quantize_model import is_quantized_artifact, load_for_inference
+
+SAFETENSORS_WEIGHTS_NAME = "model.safetensors"
+SAFETENSORS_INDEX_NAME = "model.safetensors.index.json"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool
+}
+
+def safetensors_files(model_path: str) -> List[str]:
+    """Return the safetensors weight files of a checkpoint (empty if there are none)"""
+    single = os.path.join(model_path, SAFETENSORS_WEIGHTS_NAME)
+    if os.path.exists(single):
+        return [single]
+
+    index = os.path.join(model_path, SAFETENSORS_INDEX_NAME)
+    if os.path.exists(index):
+        with open(index) as f:
+            shards = sorted(set(json.load(f)["weight_map"].values()))
+        return [os.path.join(model_path, shard) for shard in shards]
+    return []
+
+def mmap_safetensors(path: str) -> Tuple[Dict[str, torch.Tensor], mmap.mmap]:
+    """Map a safetensors file and return tensors that view the mapping
+
+    The mapping is copy-on-write: pages are shared with every other process
+    mapping the same file until they are written, which inference never does.
+    Returns the tensors and the mapping, which must outlive them.
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    header_length = struct.unpack('<Q', mapped[:8])[0]
+    header = json.loads(mapped[8:8 + header_length])
+    data_start = 8 + header_length
+
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if start == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            mapped, dtype=dtype,
+            count=(end - start) // dtype.itemsize,
+            offset=data_start + start
+        ).view(info["shape"])
+    return tensors, mapped
+
+class ModelHandle:
+    def __init__(self, model_path: str, device: Optional[torch.device] = None, quantized: bool = False,
+                 model_class=AutoModelForCausalLM, tokenizer_class=AutoTokenizer,
+                 adapters: Optional[Dict[str, str]] = None, merge_adapters: bool = False):
+        """
+        Lazily loaded model and tokenizer
+
+        Args:
+            model_path: Local checkpoint directory or Hub model name
+            device: Device for the model (int8 models always run on the CPU)
+            quantized: Quantize the model to int8 on load
+            model_class: Model class used to build the model
+            tokenizer_class: Tokenizer class used to load the tokenizer
+            adapters: Named LoRA adapter directories to load on top of the model
+            merge_adapters: Merge the (single) adapter into the weights
+        """
+        self.model_path = model_path
+        self.device = device or torch.device('cpu')
+        self.quantized = quantized or is_quantized_artifact(model_path)
+        if self.quantized:
+            # Int8 kernels run on the CPU only
+            self.device = torch.device('cpu')
+        if self.quantized and adapters:
+            raise ValueError("LoRA adapters are loaded onto the fp32 model; merge them before quantizing")
+        self.model_class = model_class
+        self.tokenizer_class = tokenizer_class
+        self.adapters = adapters or {}
+        self.merge_adapters = merge_adapters
+
+        self._model = None
+        self._tokenizer = None
+        self._mappings = []
+        self._lock = threading.Lock()
+        self.load_seconds = None
+        self.load_method = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def model(self):
+        self.load()
+        return self._model
+
+    @property
+    def tokenizer(self):
+        self.load()
+        return self._tokenizer
+
+    def load(self):
+        """Load the model and tokenizer on first use; later calls are no-ops"""
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is not None:
+                return
+
+            start_time = time.time()
+            # Adapters are saved with the tokenizer they were trained with (special tokens added)
+            tokenizer_path = next(iter(self.adapters.values()), self.model_path)
+            if not os.path.exists(os.path.join(tokenizer_path, "tokenizer_config.json")):
+                tokenizer_path = self.model_path
+            tokenizer = self.tokenizer_class.from_pretrained(tokenizer_path)
+            if self.quantized:
+                model = load_for_inference(self.model_path, quantized=True)
+                self.load_method = "int8"
+            else:
+                model = self._load_mmap()
+                if model is not None:
+                    self.load_method = "mmap safetensors"
+                else:
+                    model = self.model_class.from_pretrained(self.model_path)
+                    self.load_method = "from_pretrained"
+
+            if self.adapters:
+                model = load_adapters(model, self.adapters, tokenizer, merge=self.merge_adapters)
+                self.load_method += f" + {len(self.adapters)} LoRA adapter(s)"
+                if self.merge_adapters:
+                    self.load_method += " merged"
+
+            model.to(self.device)
+            model.eval()
+            self._tokenizer = tokenizer
+            self._model = model
+            self.load_seconds = time.time() - start_time
+            print(f"Loaded {self.model_path} in {self.load_seconds:.2f}s ({self.load_method})")
+
+    def _load_mmap(self):
+        """Build the model around memory-mapped safetensors weights, or return None"""
+        files = safetensors_files(self.model_path)
+        if not files:
+            return None
+
+        state_dict = {}
+        mappings = []
+        for path in files:
+            tensors, mapped = mmap_safetensors(path)
+            state_dict.update(tensors)
+            mappings.append(mapped)
+
+        # Skip random initialisation; every weight is replaced below
+        config = AutoConfig.from_pretrained(self.model_path)
+        with no_init_weights():
+            if hasattr(self.model_class, "from_config"):
+                model = self.model_class.from_config(config)
+            else:
+                model = self.model_class(config)
+
+        # Base-model checkpoints omit the task model's prefix (e.g. "transformer.")
+        expected = model.state_dict().keys()
+        prefix = model.base_model_prefix
+        state_dict = {
+            (f"{prefix}.{name}" if name not in expected and f"{prefix}.{name}" in expected else name): tensor
+            for name, tensor in state_dict.items()
+        }
+
+        missing, _ = model.load_state_dict(state_dict, strict=False, assign=True)
+        model.tie_weights()
+        tied = set(getattr(model, "_tied_weights_keys", None) or [])
+        if any(name not in tied for name in missing):
+            # Not a plain checkpoint for this class; let from_pretrained handle it
+            return None
+
+        self._mappings = mappings
+        return model
+
+class ModelRegistry:
+    """Process-wide cache of model handles
+
+    A handle is keyed by its path, device, quantization and LoRA adapters,
+    plus the modification time of the weights, so a checkpoint rewritten by
+    fine-tuning is loaded again.
+    """
+
+    def __init__(self):
+        self._handles: Dict[tuple, ModelHandle] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_path: str, device: Optional[torch.device] = None, quantized: bool = False,
+            model_class=AutoModelForCausalLM, tokenizer_class=AutoTokenizer,
+            adapters: Optional[Dict[str, str]] = None, merge_adapters: bool = False) -> ModelHandle:
+        """Return the shared handle for a model; nothing is loaded until it is used"""
+        device = device or torch.device('cpu')
+        weights = safetensors_files(model_path) or [
+            os.path.join(model_path, name) for name in ("pytorch_model.bin", "quantized_model.pt")
+        ]
+        mtime = max((os.path.getmtime(path) for path in weights if os.path.exists(path)), default=None)
+        adapter_key = tuple(sorted((name, os.path.abspath(path)) for name, path in (adapters or {}).items()))
+        key = (os.path.abspath(model_path) if os.path.isdir(model_path) else model_path,
+               str(device), quantized, model_class.__name__, adapter_key, merge_adapters, mtime)
+
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is None:
+                # Forget handles for older weights of the same model
+                for stale in [other for other in self._handles if other[:-1] == key[:-1]]:
+                    del self._handles[stale]
+                handle = ModelHandle(model_path, device, quantized, model_class, tokenizer_class,
+                                     adapters, merge_adapters)
+                self._handles[key] = handle
+            return handle
+
+    def stats(self) -> List[Dict]:
+        """Return the load state and load time of every registered model"""
+        with self._lock:
+            return [
+                {
+                    "model_path": handle.model_path,
+                    "device": str(handle.device),
+                    "quantized": handle.quantized,
+                    "adapters": sorted(handle.adapters),
+                    "loaded": handle.loaded,
+                    "load_seconds": handle.load_seconds,
+                    "load_method": handle.load_method
+                }
+                for handle in self._handles.values()
+            ]
+
+REGISTRY = ModelRegistry()
+
+def get_model(model_path: str, **kwargs) -> ModelHandle:
+    """Return the shared, lazily loaded handle for model_path"""
+    return REGISTRY.get(model_path, **kwargs)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime Backend
+Exports the fine-tuned storyteller (./anime_model) to an ONNX graph with
+KV-cache inputs and outputs, and serves it with ONNX Runtime through
+OnnxAnimeGenerator, a drop-in for FineTunedAnimeGenerator.
+
+Inference needs only onnxruntime, numpy and the tokenizer, so a serving
+image can leave PyTorch out; torch is imported by the export step only.
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import onnxruntime as ort
+from transformers import AutoTokenizer
+
+from genres import genre_prefix, genre_tag
+from streaming import IncrementalDetokenizer
+
+ONNX_MODEL_NAME = "model.onnx"
+ONNX_CONFIG_NAME = "onnx_config.json"
+
+def export_onnx(model_path: str = "./anime_model", output_dir: str = "./anime_model_onnx",
+                opset_version: int = 17) -> str:
+    """Export a GPT-2 style causal LM to ONNX with past/present KV-cache tensors
+
+    The graph takes input_ids, attention_mask, position_ids and
+    past_key_{i}/past_value_{i} for every layer, and returns logits plus
+    present_key_{i}/present_value_{i}. The first step passes an empty
+    (length 0) past.
+    """
+    import inspect
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(model_path, attn_implementation="eager")
+    model.eval()
+    config = model.config
+    num_layers = config.n_layer
+    num_heads = config.n_head
+    head_dim = config.n_embd // config.n_head
+
+    class KVCacheWrapper(torch.nn.Module):
+        """Flatten the legacy past_key_values tuple into graph inputs/outputs"""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, position_ids, *past):
+            past_key_values = tuple((past[2 * i], past[2 * i + 1]) for i in range(num_layers))
+            output = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True
+            )
+            present = output.past_key_values
+            if hasattr(present, "to_legacy_cache"):
+                present = present.to_legacy_cache()
+            return (output.logits,) + tuple(tensor for layer in present for tensor in layer)
+
+    past_names = [name for i in range(num_layers) for name in (f"past_key_{i}", f"past_value_{i}")]
+    present_names = [name for i in range(num_layers) for name in (f"present_key_{i}", f"present_value_{i}")]
+
+    # Trace with a non-empty past so the cache concatenation is kept in the graph
+    batch_size, sequence_length, past_length = 1, 3, 2
+    dummy_inputs = (
+        torch.ones(batch_size, sequence_length, dtype=torch.long),
+        torch.ones(batch_size, past_length + sequence_length, dtype=torch.long),
+        torch.arange(past_length, past_length + sequence_length).unsqueeze(0),
+        *[torch.zeros(batch_size, num_heads, past_length, head_dim) for _ in past_names]
+    )
+
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "total_sequence"},
+        "position_ids": {0: "batch", 1: "sequence"},
+        "logits": {0: "batch", 1: "sequence"},
+        **{name: {0: "batch", 2: "past_sequence"} for name in past_names},
+        **{name: {0: "batch", 2: "total_sequence"} for name in present_names}
+    }
+
+    os.makedirs(output_dir, exist_ok=True)
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # dynamic_axes belongs to the TorchScript exporter
+        export_kwargs["dynamo"] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            KVCacheWrapper(model),
+            dummy_inputs,
+            os.path.join(output_dir, ONNX_MODEL_NAME),
+            input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+            output_names=["logits"] + present_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+            **export_kwargs
+        )
+
+    AutoTokenizer.from_pretrained(model_path).save_pretrained(output_dir)
+    with open(os.path.join(output_dir, ONNX_CONFIG_NAME), 'w') as f:
+        json.dump({
+            "num_layers": num_layers,
+            "num_heads": num_heads,
+            "head_dim": head_dim,
+            "max_positions": config.n_positions,
+            "eos_token_id": config.eos_token_id
+        }, f, indent=2)
+
+    return output_dir
+
+class OnnxAnimeGenerator:
+    def __init__(self, model_path: str = "./anime_model_onnx", num_threads: Optional[int] = None):
+        """
+        Initialize the ONNX Runtime generator
+
+        Args:
+            model_path: Directory written by export_onnx
+            num_threads: Intra-op threads for ONNX Runtime (None lets it decide)
+        """
+        self.model_path = model_path
+
+        try:
+            print(f"Loading ONNX model from {model_path}...")
+            with open(os.path.join(model_path, ONNX_CONFIG_NAME)) as f:
+                self.config = json.load(f)
+            self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(
+                os.path.join(model_path, ONNX_MODEL_NAME), options,
+                providers=["CPUExecutionProvider"]
+            )
+
+            print("ONNX model loaded successfully!")
+            self.is_loaded = True
+
+        except Exception as e:
+            print(f"Failed to load ONNX model: {e}")
+            print("Falling back to template generation...")
+            self.is_loaded = False
+
+    def _genre_prefix(self, genre: str) -> str:
+        """Return the genre and scene tags that start every prompt"""
+        return genre_prefix(genre_tag(genre))
+
+    def _full_prompt(self, prompt: str, genre: str) -> str:
+        """Prefix the prompt with its genre and scene tags"""
+        return f"{self._genre_prefix(genre)} {prompt}"
+
+    def _empty_past(self) -> Dict[str, np.ndarray]:
+        shape = (1, self.config["num_heads"], 0, self.config["head_dim"])
+        past = {}
+        for i in range(self.config["num_layers"]):
+            past[f"past_key_{i}"] = np.zeros(shape, dtype=np.float32)
+            past[f"past_value_{i}"] = np.zeros(shape, dtype=np.float32)
+        return past
+
+    def _sample(self, logits: np.ndarray, token_ids: List[int], temperature: float = 0.8,
+                top_k: int = 50, top_p: float = 0.95, no_repeat_ngram_size: int = 3) -> int:
+        """Pick the next token with the same settings FineTunedAnimeGenerator uses"""
+        logits = logits.astype(np.float64)
+
+        # Ban tokens that would repeat an n-gram already in the sequence
+        if len(token_ids) >= no_repeat_ngram_size:
+            context = tuple(token_ids[-(no_repeat_ngram_size - 1):])
+            for i in range(len(token_ids) - no_repeat_ngram_size + 1):
+                if tuple(token_ids[i:i + no_repeat_ngram_size - 1]) == context:
+                    logits[token_ids[i + no_repeat_ngram_size - 1]] = -np.inf
+
+        logits = logits / temperature
+        if top_k and top_k < logits.shape[0]:
+            kth_largest = np.partition(logits, -top_k)[-top_k]
+            logits[logits < kth_largest] = -np.inf
+
+        probs = np.exp(logits - logits.max())
+        probs /= probs.sum()
+
+        # Keep the smallest set of tokens whose probability reaches top_p
+        order = np.argsort(-probs)
+        cumulative = np.cumsum(probs[order])
+        keep = order[:np.searchsorted(cumulative, top_p) + 1]
+        filtered = np.zeros_like(probs)
+        filtered[keep] = probs[keep]
+        filtered /= filtered.sum()
+
+        return int(np.random.choice(len(filtered), p=filtered))
+
+    def _generate_ids(self, input_ids: List[int], max_length: int) -> Iterator[int]:
+        """Yield new token ids, reusing the KV cache between steps"""
+        past = self._empty_past()
+        token_ids = list(input_ids)
+        step_ids = list(input_ids)
+        max_new_tokens = min(max_length, self.config["max_positions"] - len(input_ids))
+
+        for _ in range(max_new_tokens):
+            past_length = len(token_ids) - len(step_ids)
+            outputs = self.session.run(None, {
+                "input_ids": np.array([step_ids], dtype=np.int64),
+                "attention_mask": np.ones((1, len(token_ids)), dtype=np.int64),
+                "position_ids": np.arange(past_length, len(token_ids), dtype=np.int64)[None],
+                **past
+            })
+
+            logits, presents = outputs[0], outputs[1:]
+            for i in range(self.config["num_layers"]):
+                past[f"past_key_{i}"] = presents[2 * i]
+                past[f"past_value_{i}"] = presents[2 * i + 1]
+
+            token = self._sample(logits[0, -1], token_ids)
+            if token == self.config["eos_token_id"]:
+                return
+            token_ids.append(token)
+            step_ids = [token]
+            yield token
+
+    def generate_story(self, prompt: str, genre: str, max_length: int = 200) -> Dict:
+        """Generate story using the ONNX model"""
+
+        if not self.is_loaded:
+            return {
+                "success": False,
+                "error": "ONNX model not loaded",
+                "provider": "Fine-tuned Model (ONNX)"
+            }
+
+        try:
+            input_ids = self.tokenizer.encode(self._full_prompt(prompt, genre))
+            new_ids = list(self._generate_ids(input_ids, max_length))
+
+            return {
+                "success": True,
+                "text": self.tokenizer.decode(new_ids, skip_special_tokens=True).strip(),
+                "token_ids": new_ids,
+                "provider": "Fine-tuned Anime Model (ONNX)",
+                "prompt_tokens": len(input_ids),
+                "completion_tokens": len(new_ids)
+            }
+
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "provider": "Fine-tuned Model (ONNX)"
+            }
+
+    def generate_story_stream(self, prompt: str, genre: str, max_length: int = 200,
+                              token_ids: Optional[List[int]] = None) -> Iterator[str]:
+        """Generate story using the ONNX model, yielding text as it is decoded
+
+        If token_ids is given, it is filled with the new token ids once the
+        stream ends.
+        """
+
+        if not self.is_loaded:
+            raise RuntimeError("ONNX model not loaded")
+
+        input_ids = self.tokenizer.encode(self._full_prompt(prompt, genre))
+        detokenizer = IncrementalDetokenizer(self.tokenizer, skip_special_tokens=True)
+        for token in self._generate_ids(input_ids, max_length):
+            text = detokenizer.add(token)
+            if text:
+                yield text
+
+        text = detokenizer.flush()
+        if text:
+            yield text
+        if token_ids is not None:
+            token_ids.extend(detokenizer.token_ids)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the fine-tuned anime model to ONNX")
+    parser.add_argument("--model_path", type=str, default="./anime_model",
+                       help="Fine-tuned model to export")
+    parser.add_argument("--output_dir", type=str, default="./anime_model_onnx",
+                       help="Where to save the ONNX model")
+    parser.add_argument("--opset", type=int, default=17,
+                       help="ONNX opset version")
+    args = parser.parse_args()
+
+    print("🎌 Anime Model ONNX Export 🎌")
+    print("=" * 50)
+
+    start_time = time.time()
+    export_onnx(args.model_path, args.output_dir, args.opset)
+    print(f"✅ Exported to {args.output_dir} in {time.time() - start_time:.1f}s")
+
+    generator = OnnxAnimeGenerator(args.output_dir)
+    result = generator.generate_story("A young warrior discovers a legendary sword", "shonen")
+    if result["success"]:
+        print(f"✅ Test generation: {result['text'][:100]}...")
+    else:
+        print(f"❌ Test generation failed: {result['error']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Prompt Prefix KV Cache
+Every local generation starts with the same "{genre} [SCENE]" preamble, so
+its attention state (past_key_values) is computed once and reused instead
+of being prefilled on every call. Genre prefixes are pinned; longer,
+user-defined prefixes (e.g. a system preamble) live in a bounded LRU.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+class PrefixKVCache:
+    def __init__(self, model, tokenizer, max_entries: int = 32,
+                 pinned: Iterable[str] = (), forward_kwargs: Optional[Dict] = None):
+        """
+        Initialize the prefix cache
+
+        Args:
+            model: Causal LM that returns past_key_values
+            tokenizer: Matching tokenizer
+            max_entries: Unpinned prefixes kept before the least recently used is evicted
+            pinned: Prefixes computed up front and never evicted
+            forward_kwargs: Extra model arguments (e.g. the LoRA adapter_names to use)
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.forward_kwargs = forward_kwargs or {}
+
+        self._pinned = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._uses_cache_class = False
+        self.hits = 0
+        self.misses = 0
+
+        for prefix in pinned:
+            self._pinned[prefix] = self._compute(prefix)
+
+    def _device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    def _compute(self, prefix: str) -> Tuple[List[int], tuple]:
+        prefix_ids = self.tokenizer.encode(prefix)
+        with torch.no_grad():
+            output = self.model(torch.tensor([prefix_ids], device=self._device()), use_cache=True,
+                                **self.forward_kwargs)
+
+        # Store the legacy tuple form; it is never modified in place
+        past = output.past_key_values
+        if hasattr(past, "to_legacy_cache"):
+            self._uses_cache_class = True
+            past = past.to_legacy_cache()
+        return prefix_ids, past
+
+    def get(self, prefix: str) -> Tuple[List[int], tuple]:
+        """Return (prefix_ids, legacy past_key_values) for prefix, computing it on a miss"""
+        with self._lock:
+            if prefix in self._pinned:
+                self.hits += 1
+                return self._pinned[prefix]
+            if prefix in self._entries:
+                self._entries.move_to_end(prefix)
+                self.hits += 1
+                return self._entries[prefix]
+            self.misses += 1
+
+        entry = self._compute(prefix)
+        with self._lock:
+            self._entries[prefix] = entry
+            self._entries.move_to_end(prefix)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def as_model_cache(self, past: tuple):
+        """Wrap a stored past in the cache type the model expects
+
+        A fresh DynamicCache is built per call because generation appends to
+        it in place.
+        """
+        if self._uses_cache_class:
+            return DynamicCache.from_legacy_cache(past)
+        return past
+
+    def prepare(self, prefix: str, text: str) -> Dict:
+        """Build model.generate inputs for "{prefix} {text}" starting from the cached prefix"""
+        prefix_ids, past = self.get(prefix)
+        text_ids = self.tokenizer.encode(f" {text}")
+        input_ids = torch.tensor([prefix_ids + text_ids], device=self._device())
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "past_key_values": self.as_model_cache(past)
+        }
+
+    def stats(self) -> Dict:
+        """Return hit/miss counters and cache sizes"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "pinned_entries": len(self._pinned),
+                "entries": len(self._entries)
+            }
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Int8 Quantized CPU Inference
+Dynamic int8 quantization of the GPT-2 / DialoGPT story models for CPU
+servers. Linear weights are stored as int8 and activations are quantized
+on the fly, which cuts the memory footprint and per-token latency.
+
+GPT-2 style models implement their projections as transformers' Conv1D,
+which quantize_dynamic does not recognise, so those are converted to
+nn.Linear first. The quantized model is saved as an artifact directory
+(config, tokenizer and int8 state dict) and checked against fp32 by
+perplexity on evaluation stories, ideally the held-out split that
+fine_tune_anime_model.py saves next to its training data.
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import time
+from typing import Dict, List
+
+import torch
+from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers.pytorch_utils import Conv1D
+
+QUANTIZED_WEIGHTS_NAME = "quantized_model.pt"
+QUANTIZATION_CONFIG_NAME = "quantization_config.json"
+
+# Relative perplexity increase over fp32 that still passes the quality check
+MAX_PERPLEXITY_INCREASE = 0.05
+
+def convert_conv1d_to_linear(model: torch.nn.Module) -> torch.nn.Module:
+    """Replace every transformers Conv1D with an equivalent nn.Linear, in place"""
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                with torch.no_grad():
+                    linear.weight.copy_(child.weight.t())
+                    linear.bias.copy_(child.bias)
+                setattr(module, child_name, linear)
+    return model
+
+def quantize_int8(model: torch.nn.Module, quantize_lm_head: bool = False) -> torch.nn.Module:
+    """Dynamically quantize the model's Linear layers to int8 for CPU inference
+
+    The output projection is tied to the input embeddings and is the most
+    sensitive layer, so it stays fp32 unless quantize_lm_head is set.
+    """
+    model = convert_conv1d_to_linear(model.cpu().eval())
+    qconfig_spec = {
+        name: default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and (quantize_lm_head or name != "lm_head")
+    }
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+def is_quantized_artifact(model_path: str) -> bool:
+    """Return True if model_path holds a model saved by save_quantized"""
+    return os.path.exists(os.path.join(model_path, QUANTIZATION_CONFIG_NAME))
+
+def save_quantized(model: torch.nn.Module, tokenizer, output_dir: str, quantize_lm_head: bool = False):
+    """Save a quantized model with its config and tokenizer"""
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    torch.save(model.state_dict(), os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME))
+    with open(os.path.join(output_dir, QUANTIZATION_CONFIG_NAME), 'w') as f:
+        json.dump({
+            "method": "dynamic_int8",
+            "quantize_lm_head": quantize_lm_head,
+            "torch_version": torch.__version__
+        }, f, indent=2)
+
+def load_quantized(model_path: str) -> torch.nn.Module:
+    """Load a model saved by save_quantized (CPU only)"""
+    with open(os.path.join(model_path, QUANTIZATION_CONFIG_NAME)) as f:
+        quantization_config = json.load(f)
+
+    # Rebuild the quantized module structure, then load the int8 weights into it
+    config = AutoConfig.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_config(config)
+    model = quantize_int8(model, quantize_lm_head=quantization_config["quantize_lm_head"])
+    state_dict = torch.load(os.path.join(model_path, QUANTIZED_WEIGHTS_NAME), map_location="cpu")
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+def load_for_inference(model_path: str, quantized: bool = False) -> torch.nn.Module:
+    """Load a causal LM, quantizing it to int8 when requested
+
+    A saved quantized artifact is loaded as is; a regular checkpoint is
+    quantized after loading.
+    """
+    if is_quantized_artifact(model_path):
+        return load_quantized(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+    if quantized:
+        model = quantize_int8(model)
+    return model
+
+def model_size_mb(model: torch.nn.Module) -> float:
+    """Serialized size of the model's weights in MB"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 ** 2
+
+def evaluate_perplexity(model: torch.nn.Module, tokenizer, texts: List[str], max_length: int = 512) -> float:
+    """Token-weighted perplexity of the model over texts"""
+    total_loss = 0.0
+    total_tokens = 0
+    device = next(model.parameters(), torch.empty(0)).device
+    for text in texts:
+        input_ids = tokenizer.encode(text, return_tensors='pt')[:, :max_length].to(device)
+        if input_ids.shape[1] < 2:
+            continue
+        with torch.no_grad():
+            loss = model(input_ids, labels=input_ids).loss
+        total_loss += loss.item() * (input_ids.shape[1] - 1)
+        total_tokens += input_ids.shape[1] - 1
+    return math.exp(total_loss / total_tokens)
+
+def time_per_token(model: torch.nn.Module, tokenizer, prompt: str, new_tokens: int = 32) -> float:
+    """Average seconds per generated token for greedy decoding"""
+    input_ids = tokenizer.encode(prompt, return_tensors='pt')
+    generation_kwargs = dict(
+        attention_mask=torch.ones_like(input_ids),
+        min_new_tokens=new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id
+    )
+    with torch.no_grad():
+        # Warm up so one-time setup is not counted
+        model.generate(input_ids, max_new_tokens=2, **{**generation_kwargs, "min_new_tokens": 2})
+        start_time = time.time()
+        output = model.generate(input_ids, max_new_tokens=new_tokens, **generation_kwargs)
+    return (time.time() - start_time) / (output.shape[1] - input_ids.shape[1])
+
+def load_eval_texts(data_path: str, max_texts: int = 20) -> List[str]:
+    """Load evaluation stories from the fine-tuning JSON format or a text file
+
+    The first max_texts stories are used. Stories the model was trained on
+    understate the perplexity increase, so pass the held-out split.
+    """
+    with open(data_path, 'r', encoding='utf-8') as f:
+        if data_path.endswith('.json'):
+            texts = [
+                f"{story['genre']} [SCENE] {story['prompt']} {story['story']}"
+                for story in json.load(f)
+            ]
+        else:
+            texts = [line.strip() for line in f if line.strip()]
+    return texts[:max_texts]
+
+def compare_with_fp32(fp32_model: torch.nn.Module, int8_model: torch.nn.Module, tokenizer,
+                      texts: List[str], max_increase: float = MAX_PERPLEXITY_INCREASE) -> Dict:
+    """Quality check: perplexity, size and per-token latency of int8 against fp32"""
+    fp32_model = fp32_model.cpu().eval()
+    prompt = texts[0][:100]
+
+    report = {
+        "fp32_perplexity": evaluate_perplexity(fp32_model, tokenizer, texts),
+        "int8_perplexity": evaluate_perplexity(int8_model, tokenizer, texts),
+        "fp32_size_mb": model_size_mb(fp32_model),
+        "int8_size_mb": model_size_mb(int8_model),
+        "fp32_seconds_per_token": time_per_token(fp32_model, tokenizer, prompt),
+        "int8_seconds_per_token": time_per_token(int8_model, tokenizer, prompt)
+    }
+    report["perplexity_increase"] = report["int8_perplexity"] / report["fp32_perplexity"] - 1
+    report["passed"] = report["perplexity_increase"] <= max_increase
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize an anime story model to int8 for CPU inference")
+    parser.add_argument("--model_path", type=str, default="./anime_model",
+                       help="Fine-tuned (fp32) model to quantize")
+    parser.add_argument("--output_dir", type=str, default="./anime_model_int8",
+                       help="Where to save the quantized model")
+    parser.add_argument("--eval_file", "--eval_data", dest="eval_file", type=str,
+                       default="data/anime_stories_eval.json",
+                       help="Evaluation stories (.json in the fine-tuning format, or one story per line); "
+                            "by default the held-out split saved by fine_tune_anime_model.py")
+    parser.add_argument("--max_texts", type=int, default=20,
+                       help="Number of evaluation stories for the quality check")
+    parser.add_argument("--quantize_lm_head", action="store_true",
+                       help="Also quantize the output projection")
+    parser.add_argument("--max_increase", type=float, default=MAX_PERPLEXITY_INCREASE,
+                       help="Allowed relative perplexity increase over fp32")
+    args = parser.parse_args()
+    if not os.path.exists(args.eval_file):
+        parser.error(f"{args.eval_file} not found; run fine_tune_anime_model.py with --eval_fraction "
+                     "or pass --eval_file")
+
+    print("🎌 Anime Model Int8 Quantization 🎌")
+    print("=" * 50)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    fp32_model = AutoModelForCausalLM.from_pretrained(args.model_path)
+    # quantize_int8 converts modules in place, so keep the fp32 model intact
+    int8_model = quantize_int8(AutoModelForCausalLM.from_pretrained(args.model_path),
+                               quantize_lm_head=args.quantize_lm_head)
+
+    save_quantized(int8_model, tokenizer, args.output_dir, quantize_lm_head=args.quantize_lm_head)
+    print(f"✅ Quantized model saved to {args.output_dir}")
+
+    texts = load_eval_texts(args.eval_file, args.max_texts)
+    report = compare_with_fp32(fp32_model, int8_model, tokenizer, texts, args.max_increase)
+
+    print(f"Perplexity: fp32 {report['fp32_perplexity']:.2f} -> int8 {report['int8_perplexity']:.2f} "
+          f"({report['perplexity_increase']:+.1%})")
+    print(f"Size: {report['fp32_size_mb']:.0f} MB -> {report['int8_size_mb']:.0f} MB")
+    print(f"Latency: {report['fp32_seconds_per_token'] * 1000:.1f} ms/token -> "
+          f"{report['int8_seconds_per_token'] * 1000:.1f} ms/token")
+
+    if report["passed"]:
+        print("✅ Quality check passed")
+    else:
+        print(f"❌ Perplexity increased by more than {args.max_increase:.0%}")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
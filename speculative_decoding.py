@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Speculative Decoding
+Assisted generation for the local story models: a small draft model
+(distilgpt2, or a shrunken copy of our own fine-tune) proposes a few
+tokens and the main model verifies them all in one forward pass. Greedy
+output is identical and sampled output keeps the main model's
+distribution, while long stories need far fewer full forward passes.
+
+The draft must use the main model's tokenizer; a draft with a smaller
+vocabulary (e.g. distilgpt2 without our genre tokens) is resized to it.
+"""
+
+import argparse
+import copy
+import threading
+import weakref
+from typing import Dict
+
+import torch
+
+from model_registry import get_model
+
+DRAFT_MODEL = "distilgpt2"
+
+# Models are shared across sessions, so their counting hooks stay installed
+# and credit each forward pass to the counter of the thread that ran it
+_hooked_models = weakref.WeakSet()
+_hook_lock = threading.Lock()
+_active = threading.local()
+
+# Drafts resized to a main tokenizer, by (draft path, device, vocab size);
+# the registry's copy is left as loaded for everyone else sharing it
+_resized_drafts: Dict[tuple, torch.nn.Module] = {}
+_resize_lock = threading.Lock()
+
+def _count_forward(module, *args):
+    counter = getattr(_active, "counter", None)
+    if counter is None:
+        return
+    if module is counter.model:
+        counter.main_passes += 1
+    elif module is counter.draft:
+        counter.draft_passes += 1
+
+def _install_hook(module):
+    with _hook_lock:
+        if module not in _hooked_models:
+            module.register_forward_hook(_count_forward)
+            _hooked_models.add(module)
+
+def load_draft_model(draft_path: str, tokenizer, device: torch.device):
+    """Load a draft model from the registry and match it to the main tokenizer"""
+    draft = get_model(draft_path, device=device).model
+    if draft.get_input_embeddings().num_embeddings >= len(tokenizer):
+        return draft
+
+    key = (draft_path, str(device), len(tokenizer))
+    with _resize_lock:
+        if key not in _resized_drafts:
+            # New special tokens get fresh embeddings; they are rarely
+            # proposed correctly, which only lowers the acceptance rate
+            resized = copy.deepcopy(draft)
+            resized.resize_token_embeddings(len(tokenizer))
+            _resized_drafts[key] = resized
+        return _resized_drafts[key]
+
+def shrink_model(model_path: str, output_dir: str, num_layers: int = 6) -> str:
+    """Save a draft model made of the first num_layers blocks of a fine-tuned GPT-2
+
+    This is how distilgpt2 was initialised; the shrunken copy shares the
+    fine-tune's tokenizer and special tokens, so it needs no resizing.
+    """
+    handle = get_model(model_path)
+    model = copy.deepcopy(handle.model).cpu()
+    model.transformer.h = model.transformer.h[:num_layers]
+    model.config.n_layer = num_layers
+    model.save_pretrained(output_dir)
+    handle.tokenizer.save_pretrained(output_dir)
+    return output_dir
+
+class AcceptanceCounter:
+    """Count forward passes of the main and draft models during one generation
+
+    Every verification pass of the main model yields the accepted draft
+    tokens plus one token of its own, and every draft pass proposes one
+    token, so acceptance = (new tokens - main passes) / draft passes.
+
+    The counter only sees passes run on the thread that created it, so
+    concurrent sessions generating with the same shared models each count
+    their own generation. Call remove() once the generation is done.
+    """
+
+    def __init__(self, model, draft):
+        # A peft model generates through its base model, so count passes there
+        if hasattr(model, "get_base_model"):
+            model = model.get_base_model()
+        self.model = model
+        self.draft = draft
+        self.main_passes = 0
+        self.draft_passes = 0
+        _install_hook(model)
+        _install_hook(draft)
+        _active.counter = self
+
+    def remove(self):
+        if getattr(_active, "counter", None) is self:
+            _active.counter = None
+
+    def stats(self, new_tokens: int) -> Dict:
+        accepted = max(new_tokens - self.main_passes, 0)
+        return {
+            "draft_tokens": self.draft_passes,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / self.draft_passes if self.draft_passes else None,
+            "main_forward_passes": self.main_passes,
+            "tokens_per_main_pass": new_tokens / self.main_passes if self.main_passes else None
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a draft model for speculative decoding")
+    parser.add_argument("--model_path", type=str, default="./anime_model",
+                       help="Fine-tuned model to shrink")
+    parser.add_argument("--output_dir", type=str, default="./anime_model_draft",
+                       help="Where to save the draft model")
+    parser.add_argument("--num_layers", type=int, default=6,
+                       help="Transformer blocks kept in the draft")
+    args = parser.parse_args()
+
+    shrink_model(args.model_path, args.output_dir, args.num_layers)
+    print(f"✅ Draft model with {args.num_layers} layers saved to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Story Response Cache
+Content-addressed cache for generated stories, so identical requests skip
+the paid providers. A bounded in-memory LRU tier sits in front of an
+optional on-disk SQLite tier; both honour a TTL and a size limit.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+class StoryCache:
+    def __init__(self,
+                 max_entries: int = 256,
+                 ttl: Optional[float] = 3600.0,
+                 disk_path: Optional[str] = None,
+                 max_disk_entries: int = 10000):
+        """
+        Initialize the story cache
+
+        Args:
+            max_entries: Stories kept in the in-memory LRU tier
+            ttl: Seconds a story stays valid (None keeps it until evicted)
+            disk_path: SQLite file for the on-disk tier (None disables it)
+            max_disk_entries: Stories kept in the on-disk tier
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = None
+        if disk_path:
+            directory = os.path.dirname(disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS stories ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS stories_accessed ON stories (accessed)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(**params) -> str:
+        """Hash the request parameters into a stable cache key"""
+        canonical = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the cached story for key, or None on a miss"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return dict(value)
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM stories WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created = json.loads(row[0]), row[1]
+                    if not self._expired(created):
+                        self._db.execute(
+                            "UPDATE stories SET accessed = ? WHERE key = ?", (time.time(), key)
+                        )
+                        self._db.commit()
+                        # Promote to the memory tier
+                        self._put_memory(key, created, value)
+                        self.hits += 1
+                        return dict(value)
+                    self._db.execute("DELETE FROM stories WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Dict):
+        """Store a story under key in every tier"""
+        created = time.time()
+        with self._lock:
+            self._put_memory(key, created, dict(value))
+
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO stories (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), created, created)
+                )
+                # Evict the least recently used stories beyond the size limit
+                self._db.execute(
+                    "DELETE FROM stories WHERE key IN ("
+                    "SELECT key FROM stories ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,)
+                )
+                self._db.commit()
+
+    def _put_memory(self, key: str, created: float, value: Dict):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached story"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM stories")
+                self._db.commit()
+
+    def stats(self) -> Dict:
+        """Return hit/miss counters and tier sizes"""
+        with self._lock:
+            disk_entries = None
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM stories").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries
+            }
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Token Streaming
+Incremental detokenization for the local generators. Each new token only
+re-decodes a short window of recent tokens instead of the whole story,
+and text is held back while it ends in an incomplete multi-byte
+character. TokenStreamer plugs this into model.generate and also keeps
+the generated token ids.
+"""
+
+from queue import Queue
+from typing import List, Optional
+
+from transformers.generation.streamers import BaseStreamer
+
+class IncrementalDetokenizer:
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        """
+        Turn a growing list of token ids into text deltas
+
+        Args:
+            tokenizer: Tokenizer used to decode
+            skip_special_tokens: Drop genre tags, EOS and other special tokens
+        """
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        # Tokens before prefix_offset are final; those from prefix_offset to
+        # read_offset give the context needed to decode the next ones
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_id: int) -> str:
+        """Append a token and return the text it completes (possibly empty)"""
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+
+        # Wait for the rest of a character split across tokens
+        if len(new_text) <= len(prefix_text) or new_text.endswith("�"):
+            return ""
+
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+    def flush(self) -> str:
+        """Return any text still held back"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+class TokenStreamer(BaseStreamer):
+    """Iterator streamer for model.generate built on IncrementalDetokenizer
+
+    Like TextIteratorStreamer, generate runs in another thread and the
+    caller iterates over text chunks. The new token ids (without EOS) are
+    collected in token_ids.
+    """
+
+    def __init__(self, tokenizer, skip_prompt: bool = True, skip_special_tokens: bool = True,
+                 timeout: Optional[float] = None):
+        self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.skip_prompt = skip_prompt
+        self.timeout = timeout
+        self.token_ids: List[int] = []
+        self.text_queue = Queue()
+        self.stop_signal = None
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if value.dim() > 1:
+            value = value[0]
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        for token_id in value.tolist():
+            if token_id == self.eos_token_id:
+                continue
+            self.token_ids.append(token_id)
+            text = self.detokenizer.add(token_id)
+            if text:
+                self.text_queue.put(text, timeout=self.timeout)
+
+    def end(self):
+        text = self.detokenizer.flush()
+        if text:
+            self.text_queue.put(text, timeout=self.timeout)
+        self.next_tokens_are_prompt = True
+        self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        value = self.text_queue.get(timeout=self.timeout)
+        if value is self.stop_signal:
+            raise StopIteration()
+        return value
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Tests for resumable training checkpoints"""
+
+import os
+
+import pytest
+import torch
+from datasets import Dataset
+from transformers import GPT2LMHeadModel, TrainerCallback, TrainingArguments
+
+from checkpointing import AsyncCheckpointTrainer, is_valid_checkpoint, latest_checkpoint
+from fine_tune_anime_model import CausalLMCollator
+
+class Preempted(Exception):
+    pass
+
+class StepCounter(TrainerCallback):
+    def __init__(self):
+        self.steps = 0
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.steps += 1
+
+class PreemptAt(TrainerCallback):
+    """Stop training abruptly after a given step, like a preempted job"""
+
+    def __init__(self, step: int):
+        self.step = step
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step == self.step:
+            raise Preempted()
+
+@pytest.fixture
+def train_dataset(tokenizer):
+    texts = [f"[SHONEN] [SCENE] Kenji trains for the exam, day {day}." for day in range(24)]
+    return Dataset.from_dict({"input_ids": [tokenizer(text)["input_ids"] for text in texts],
+                              "attention_mask": [tokenizer(text)["attention_mask"] for text in texts]})
+
+def train(output_dir, tiny_model_dir, tokenizer, dataset, callback=None, resume=False):
+    """Train the tiny model for two epochs of 6 steps, checkpointing every 3"""
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel.from_pretrained(tiny_model_dir)
+    args = TrainingArguments(
+        output_dir=str(output_dir),
+        num_train_epochs=2,
+        per_device_train_batch_size=4,
+        save_steps=3,
+        save_total_limit=2,
+        learning_rate=1e-3,
+        warmup_steps=2,
+        logging_steps=100,
+        report_to="none",
+        use_cpu=True
+    )
+    trainer = AsyncCheckpointTrainer(
+        model=model,
+        args=args,
+        data_collator=CausalLMCollator(tokenizer),
+        train_dataset=dataset,
+        callbacks=[callback] if callback else None
+    )
+    checkpoint = latest_checkpoint(str(output_dir)) if resume else None
+    try:
+        trainer.train(resume_from_checkpoint=checkpoint)
+    except Preempted:
+        trainer.wait_for_checkpoint()
+    return model
+
+def test_latest_checkpoint_skips_incomplete_ones(tmp_path):
+    complete = tmp_path / "checkpoint-3"
+    complete.mkdir()
+    for name in ("model.safetensors", "optimizer.pt"):
+        (complete / name).write_bytes(b"")
+    (complete / "trainer_state.json").write_text("{}")
+
+    # Killed while writing: the trainer state is cut short
+    partial = tmp_path / "checkpoint-6"
+    partial.mkdir()
+    (partial / "model.safetensors").write_bytes(b"")
+    (partial / "optimizer.pt").write_bytes(b"")
+    (partial / "trainer_state.json").write_text("{")
+
+    assert is_valid_checkpoint(str(complete))
+    assert not is_valid_checkpoint(str(partial))
+    assert latest_checkpoint(str(tmp_path)) == str(complete)
+    assert latest_checkpoint(str(tmp_path / "missing")) is None
+
+def test_resume_matches_uninterrupted_training(tmp_path, tiny_model_dir, tokenizer, train_dataset):
+    expected = train(tmp_path / "straight", tiny_model_dir, tokenizer, train_dataset)
+
+    train(tmp_path / "preempted", tiny_model_dir, tokenizer, train_dataset, callback=PreemptAt(7))
+    checkpoints = sorted(name for name in os.listdir(tmp_path / "preempted") if not name.startswith("."))
+    assert checkpoints == ["checkpoint-3", "checkpoint-6"]
+
+    counter = StepCounter()
+    resumed = train(tmp_path / "preempted", tiny_model_dir, tokenizer, train_dataset,
+                    callback=counter, resume=True)
+    assert counter.steps == 6
+    for name, tensor in expected.state_dict().items():
+        assert torch.allclose(tensor, resumed.state_dict()[name], atol=1e-6), name
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Tests for the CPU worker pool: serving, load failures and worker deaths"""
+
+import os
+import signal
+
+import pytest
+
+from cpu_runtime import CPUInferenceRuntime
+
+@pytest.fixture
+def runtime(tiny_model_dir):
+    runtime = CPUInferenceRuntime(tiny_model_dir, num_workers=1, threads_per_worker=1).start(timeout=120)
+    yield runtime
+    runtime.stop()
+
+def test_worker_serves_a_story(runtime):
+    result = runtime.generate_story("A hero appears", "shonen", max_length=8)
+    assert result["worker"] == 0 and "text" in result
+
+def test_model_that_fails_to_load_fails_start(tmp_path):
+    runtime = CPUInferenceRuntime(str(tmp_path / "missing_model"), num_workers=1, threads_per_worker=1)
+    with pytest.raises(RuntimeError, match="Worker 0 failed to load the model"):
+        runtime.start(timeout=120)
+    with pytest.raises(RuntimeError):
+        runtime.submit("A hero appears", "shonen")
+
+def test_dead_worker_fails_its_requests(runtime):
+    os.kill(runtime._workers[0].pid, signal.SIGKILL)
+    future = runtime.submit("A hero appears", "shonen", max_length=8)
+    with pytest.raises(RuntimeError, match="exited"):
+        future.result(timeout=30)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Tests for the fine-tuning data pipeline: packing, batching and the held-out split"""
+
+import json
+
+import pytest
+
+from fine_tune_anime_model import AnimeModelFineTuner, CausalLMCollator
+
+@pytest.fixture(scope="module")
+def fine_tuner(tiny_model_dir):
+    return AnimeModelFineTuner(tiny_model_dir)
+
+@pytest.fixture
+def dataset(fine_tuner, tmp_path):
+    # Builds the sample dataset on first use
+    return fine_tuner.create_anime_dataset(str(tmp_path / "data" / "anime_stories.json"))
+
+def test_packed_blocks_are_full(fine_tuner, dataset):
+    packed = fine_tuner.prepare_dataset_for_training(dataset, packing=True, max_length=64)
+    tokenizer = fine_tuner.tokenizer
+
+    expected = [token for text in dataset["text"] for token in tokenizer(text)["input_ids"] + [tokenizer.eos_token_id]]
+    assert len(packed) == len(expected) // 64
+    assert all(len(block) == 64 for block in packed["input_ids"])
+    assert [token for block in packed["input_ids"] for token in block] == expected[:len(packed) * 64]
+
+def test_unpacked_stories_keep_their_length(fine_tuner, dataset):
+    unpacked = fine_tuner.prepare_dataset_for_training(dataset, packing=False, max_length=64)
+    assert len(unpacked) == len(dataset)
+    assert unpacked["length"] == [len(ids) for ids in unpacked["input_ids"]]
+
+def test_collator_keeps_eos_and_masks_padding(fine_tuner):
+    tokenizer = fine_tuner.tokenizer
+    features = [
+        {"input_ids": [5, 6, tokenizer.eos_token_id], "attention_mask": [1, 1, 1]},
+        {"input_ids": [7], "attention_mask": [1]}
+    ]
+    batch = CausalLMCollator(tokenizer)(features)
+    assert batch["labels"][0].tolist() == [5, 6, tokenizer.eos_token_id]
+    assert (batch["labels"][1] == -100).sum().item() == 2
+
+def test_held_out_stories_are_not_trained_on(fine_tuner, tmp_path):
+    data_path = tmp_path / "stories.json"
+    stories = [{"genre": "[SHONEN]", "prompt": f"Hero {i}", "story": f"Story number {i}."} for i in range(20)]
+    data_path.write_text(json.dumps(stories))
+
+    train = fine_tuner.create_anime_dataset(str(data_path), eval_fraction=0.25)
+    held_out = json.loads((tmp_path / "stories_eval.json").read_text())
+
+    assert len(held_out) == 5 and len(train) == 15
+    held_out_texts = {f"{story['genre']} [SCENE] {story['prompt']} {story['story']}" for story in held_out}
+    assert not held_out_texts & set(train["text"])
+
+    # The split is seeded, so a rerun holds out the same stories
+    fine_tuner.create_anime_dataset(str(data_path), eval_fraction=0.25)
+    assert json.loads((tmp_path / "stories_eval.json").read_text()) == held_out
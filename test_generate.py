@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Tests for the local generator: perplexity, batched and streamed generation"""
+
+import pytest
+import torch
+
+from generate import AnimeStoryGenerator
+from genres import genre_prefix
+from speculative_decoding import shrink_model
+
+@pytest.fixture
+def generator(tiny_model_dir):
+    return AnimeStoryGenerator(tiny_model_dir)
+
+def test_perplexity_matches_a_forward_pass(generator):
+    torch.manual_seed(0)
+    generator.generate_story("A hero appears", '[SHONEN]', max_length=40)
+    stats = generator.last_stats
+
+    prompt_ids = generator.prefix_cache.prepare(genre_prefix('[SHONEN]'), "A hero appears")['input_ids'][0].tolist()
+    new_ids = stats['token_ids'] + [generator.tokenizer.eos_token_id] * (stats['num_tokens'] - len(stats['token_ids']))
+    with torch.no_grad():
+        logits = generator.model(torch.tensor([prompt_ids + new_ids])).logits[0]
+    logprobs = torch.log_softmax(logits[len(prompt_ids) - 1:-1], dim=-1)
+    expected = logprobs.gather(1, torch.tensor(new_ids)[:, None])[:, 0]
+
+    assert torch.allclose(torch.tensor(stats['token_logprobs']), expected, atol=1e-4)
+    assert stats['perplexity'] == pytest.approx(torch.exp(-expected.mean()).item(), rel=1e-4)
+
+def test_batch_returns_one_story_per_prompt(generator):
+    results = generator.generate_batch(["A hero appears", "Robots rise"], genres=["[SHONEN]", "[MECHA]"],
+                                       max_length=40)
+    assert [result['prompt'] for result in results] == ["[SHONEN] [SCENE] A hero appears",
+                                                        "[MECHA] [SCENE] Robots rise"]
+    for result in results:
+        assert len(result['token_logprobs']) == result['num_tokens']
+        assert result['text'] == generator.tokenizer.decode(result['token_ids'], skip_special_tokens=False)
+    assert generator.last_stats['batch_size'] == 2
+    assert generator.last_stats['num_tokens'] == sum(result['num_tokens'] for result in results)
+
+def test_batch_rejects_mismatched_genres(generator):
+    with pytest.raises(ValueError):
+        generator.generate_batch(["A hero appears", "Robots rise"], genres=["[SHONEN]"])
+
+def test_stream_sets_last_stats(generator):
+    generator.generate_batch(["A hero appears"], max_length=30)
+
+    token_ids = []
+    text = "".join(generator.generate_story_stream("A hero appears", max_length=40, token_ids=token_ids))
+    stats = generator.last_stats
+    assert stats['token_ids'] == token_ids and stats['num_tokens'] == len(token_ids)
+    assert stats['perplexity'] is None and stats['speculative'] is None
+    assert text == generator.tokenizer.decode(token_ids, skip_special_tokens=False)
+
+def test_stream_reports_speculative_stats(tiny_model_dir, tmp_path):
+    draft_path = shrink_model(tiny_model_dir, str(tmp_path / "draft"), num_layers=1)
+    generator = AnimeStoryGenerator(tiny_model_dir, draft_model=draft_path)
+
+    "".join(generator.generate_story_stream("A hero appears", max_length=40))
+    speculative = generator.last_stats['speculative']
+    assert speculative['main_forward_passes'] > 0 and speculative['draft_tokens'] > 0
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Tests for the continuous-batching engine: batched output matches model.generate"""
+
+import pytest
+import torch
+
+from genres import genre_prefix
+from inference_server import ContinuousBatchingEngine
+
+PROMPTS = [
+    ("[SHONEN]", "A young warrior discovers a legendary sword", 24),
+    ("[MECHA]", "Pilots defend Earth", 10),
+    ("[ISEKAI]", "Hana wakes up in another world, far from home", 32)
+]
+
+@pytest.fixture
+def engine(model, tokenizer):
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=2)
+    yield engine
+    engine.stop()
+
+def reference_ids(model, tokenizer, input_ids, max_new_tokens):
+    input_ids = torch.tensor([input_ids])
+    with torch.no_grad():
+        output = model.generate(
+            input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=max_new_tokens, do_sample=False,
+            no_repeat_ngram_size=3, pad_token_id=tokenizer.eos_token_id
+        )
+    return output[0, input_ids.shape[1]:].tolist()
+
+def test_greedy_batch_matches_generate(engine, model, tokenizer):
+    # Three requests on two batch slots: the last one joins when a slot frees up
+    requests = []
+    for genre, prompt, max_new_tokens in PROMPTS:
+        prefix_ids, prefix_past = engine.prefix_cache.get(genre_prefix(genre))
+        input_ids = prefix_ids + tokenizer.encode(f" {prompt}")
+        requests.append((input_ids, engine.submit(input_ids, max_new_tokens, temperature=0, prefix_past=prefix_past)))
+
+    for (input_ids, request), (_, _, max_new_tokens) in zip(requests, PROMPTS):
+        assert request.wait(60) and request.error is None
+        assert request.output_ids == reference_ids(model, tokenizer, input_ids, max_new_tokens)
+
+def test_generate_reports_usage_and_timing(engine):
+    result = engine.generate("A hero appears", max_new_tokens=8, temperature=0, prefix=genre_prefix("[SHONEN]"))
+    assert 0 < result["completion_tokens"] <= 8
+    assert result["queue_wait"] <= result["time_to_first_token"] <= result["latency"]
+
+def test_overlong_prompt_is_rejected(engine):
+    with pytest.raises(ValueError):
+        engine.submit([0] * engine.max_positions)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Tests for LoRA adapters: trainable parameters, merging and per-request adapters"""
+
+import pytest
+import torch
+from transformers import GPT2LMHeadModel
+
+pytest.importorskip("peft")
+
+from lora_adapters import BASE_ADAPTER, add_lora, is_adapter, load_adapters
+
+@pytest.fixture
+def adapter_dir(tiny_model_dir, tokenizer, tmp_path):
+    """A saved adapter with non-zero weights, so it changes the logits"""
+    model = add_lora(GPT2LMHeadModel.from_pretrained(tiny_model_dir), tokenizer.additional_special_tokens_ids)
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for name, parameter in model.named_parameters():
+            if "lora_B" in name:
+                parameter.normal_(std=0.1)
+    model.save_pretrained(tmp_path / "adapter")
+    return str(tmp_path / "adapter")
+
+def logits(model, **kwargs):
+    with torch.no_grad():
+        return model(torch.tensor([[5, 6, 7, 8]]), **kwargs).logits
+
+def test_only_adapters_and_special_token_rows_train(tiny_model_dir, tokenizer):
+    model = add_lora(GPT2LMHeadModel.from_pretrained(tiny_model_dir), tokenizer.additional_special_tokens_ids)
+    trainable, total = model.get_nb_trainable_parameters()
+    assert 0 < trainable < total / 2
+    trained = [name for name, parameter in model.named_parameters() if parameter.requires_grad]
+    assert all("lora_" in name or "trainable_tokens" in name for name in trained)
+
+def test_merged_adapter_matches_the_unmerged_one(tiny_model_dir, tokenizer, adapter_dir):
+    assert is_adapter(adapter_dir)
+    base = GPT2LMHeadModel.from_pretrained(tiny_model_dir).eval()
+    unmerged = load_adapters(GPT2LMHeadModel.from_pretrained(tiny_model_dir), {"shonen": adapter_dir}, tokenizer)
+    merged = load_adapters(GPT2LMHeadModel.from_pretrained(tiny_model_dir), {"shonen": adapter_dir}, tokenizer,
+                           merge=True)
+
+    assert not torch.allclose(logits(unmerged), logits(base))
+    assert torch.allclose(logits(merged), logits(unmerged), atol=1e-5)
+
+def test_requests_pick_their_adapter(tiny_model_dir, tokenizer, adapter_dir):
+    base = GPT2LMHeadModel.from_pretrained(tiny_model_dir).eval()
+    model = load_adapters(GPT2LMHeadModel.from_pretrained(tiny_model_dir), {"shonen": adapter_dir}, tokenizer)
+
+    assert torch.allclose(logits(model, adapter_names=[BASE_ADAPTER]), logits(base), atol=1e-5)
+    assert torch.allclose(logits(model, adapter_names=["shonen"]), logits(model), atol=1e-5)
+
+def test_only_one_adapter_can_be_merged(tiny_model_dir, tokenizer, adapter_dir):
+    with pytest.raises(ValueError):
+        load_adapters(GPT2LMHeadModel.from_pretrained(tiny_model_dir),
+                      {"shonen": adapter_dir, "mecha": adapter_dir}, tokenizer, merge=True)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Tests for the Prometheus metrics recorded for providers and stories"""
+
+import metrics
+
+def sample(name, **labels):
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0.0
+
+def test_provider_calls_are_counted_by_outcome():
+    requests_before = sample("anime_story_provider_requests_total", provider="replicate")
+    errors_before = sample("anime_story_provider_errors_total", provider="replicate", status_code="503")
+    transport_errors_before = sample("anime_story_provider_errors_total", provider="replicate", status_code="none")
+
+    metrics.record_provider_call("replicate", True, 0.2, status_code=200)
+    metrics.record_provider_call("replicate", False, 0.1, status_code=503)
+    metrics.record_provider_call("replicate", False, 0.1)
+
+    assert sample("anime_story_provider_requests_total", provider="replicate") == requests_before + 3
+    assert sample("anime_story_provider_errors_total", provider="replicate", status_code="503") == errors_before + 1
+    assert sample("anime_story_provider_errors_total", provider="replicate",
+                  status_code="none") == transport_errors_before + 1
+
+def test_cached_stories_skip_latency_and_tokens():
+    latency_before = sample("anime_story_latency_seconds_count", provider="Llama-2")
+    tokens_before = sample("anime_story_tokens_total", provider="Llama-2", kind="completion")
+
+    metrics.record_story("Llama-2", latency=1.5, completion_tokens=40)
+    metrics.record_story("Llama-2", cached=True, latency=0.001, completion_tokens=40)
+
+    assert sample("anime_story_latency_seconds_count", provider="Llama-2") == latency_before + 1
+    assert sample("anime_story_tokens_total", provider="Llama-2", kind="completion") == tokens_before + 40
+    assert sample("anime_story_stories_served_total", provider="Llama-2", cached="true") >= 1
+
+def test_template_fallbacks_are_counted():
+    before = sample("anime_story_template_fallbacks_total")
+    metrics.record_story("Template Fallback")
+    assert sample("anime_story_template_fallbacks_total") == before + 1
+
+def test_metrics_file_holds_the_exposition(tmp_path):
+    metrics.record_cache_lookup(True)
+    path = tmp_path / "anime_story.prom"
+    metrics.write_metrics_file(str(path))
+    assert 'anime_story_cache_lookups_total{result="hit"}' in path.read_text()
+    assert "anime_story_provider_latency_seconds_bucket" in metrics.render_metrics()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Tests for the model registry: lazy shared handles and memory-mapped loading"""
+
+import ctypes
+import os
+import shutil
+
+import torch
+
+from model_registry import ModelRegistry, mmap_safetensors, safetensors_files
+
+def test_handles_are_shared_and_lazy(tiny_model_dir):
+    registry = ModelRegistry()
+    handle = registry.get(tiny_model_dir)
+    assert registry.get(tiny_model_dir) is handle
+    assert not handle.loaded and registry.stats()[0]["load_seconds"] is None
+
+def test_mmap_load_matches_from_pretrained(tiny_model_dir, model):
+    handle = ModelRegistry().get(tiny_model_dir)
+    assert handle.model is not None and handle.load_method == "mmap safetensors"
+
+    input_ids = torch.tensor([[5, 6, 7, 8]])
+    with torch.no_grad():
+        assert torch.allclose(handle.model(input_ids).logits, model(input_ids).logits)
+
+def test_tensors_view_the_mapping(tiny_model_dir):
+    tensors, mapped = mmap_safetensors(safetensors_files(tiny_model_dir)[0])
+    start = ctypes.addressof(ctypes.c_char.from_buffer(mapped))
+    for tensor in tensors.values():
+        if tensor.numel():
+            assert start <= tensor.data_ptr() < start + len(mapped)
+
+def test_rewritten_weights_get_a_new_handle(tiny_model_dir, tmp_path):
+    model_path = shutil.copytree(tiny_model_dir, tmp_path / "model")
+    registry = ModelRegistry()
+    handle = registry.get(str(model_path))
+
+    weights = safetensors_files(str(model_path))[0]
+    os.utime(weights, (os.path.getatime(weights), os.path.getmtime(weights) + 10))
+    assert registry.get(str(model_path)) is not handle
+    assert len(registry.stats()) == 1
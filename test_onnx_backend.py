@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Tests for the ONNX export: logits parity with PyTorch, with and without the KV cache"""
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from onnx_backend import OnnxAnimeGenerator, export_onnx
+
+@pytest.fixture(scope="module")
+def onnx_generator(tiny_model_dir, tmp_path_factory):
+    output_dir = export_onnx(tiny_model_dir, str(tmp_path_factory.mktemp("onnx")))
+    generator = OnnxAnimeGenerator(output_dir, num_threads=1)
+    assert generator.is_loaded
+    return generator
+
+def run(generator, token_ids, step_ids, past):
+    past_length = len(token_ids) - len(step_ids)
+    outputs = generator.session.run(None, {
+        "input_ids": np.array([step_ids], dtype=np.int64),
+        "attention_mask": np.ones((1, len(token_ids)), dtype=np.int64),
+        "position_ids": np.arange(past_length, len(token_ids), dtype=np.int64)[None],
+        **past
+    })
+    presents = outputs[1:]
+    next_past = {}
+    for i in range(generator.config["num_layers"]):
+        next_past[f"past_key_{i}"] = presents[2 * i]
+        next_past[f"past_value_{i}"] = presents[2 * i + 1]
+    return outputs[0], next_past
+
+def test_logits_match_pytorch(onnx_generator, model, tokenizer):
+    token_ids = tokenizer("[SHONEN] [SCENE] A hero appears")["input_ids"]
+    with torch.no_grad():
+        expected = model(torch.tensor([token_ids])).logits.numpy()
+
+    # Prefill all but the last token, then feed it on its own through the cache
+    _, past = run(onnx_generator, token_ids[:-1], token_ids[:-1], onnx_generator._empty_past())
+    step_logits, _ = run(onnx_generator, token_ids, token_ids[-1:], past)
+    prefill_logits, _ = run(onnx_generator, token_ids, token_ids, onnx_generator._empty_past())
+
+    np.testing.assert_allclose(prefill_logits, expected, atol=1e-4)
+    np.testing.assert_allclose(step_logits[0, -1], expected[0, -1], atol=1e-4)
+
+def test_stream_matches_the_full_story(onnx_generator):
+    np.random.seed(0)
+    result = onnx_generator.generate_story("A hero appears", "shonen", max_length=20)
+    assert result["success"] and result["completion_tokens"] == len(result["token_ids"]) <= 20
+
+    np.random.seed(0)
+    token_ids = []
+    text = "".join(onnx_generator.generate_story_stream("A hero appears", "shonen", max_length=20, token_ids=token_ids))
+    assert token_ids == result["token_ids"]
+    assert text.strip() == result["text"]
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Tests for the genre prefix KV cache"""
+
+import torch
+
+from genres import GENRE_TAGS, genre_prefix
+from prefix_cache import PrefixKVCache
+
+def greedy(model, tokenizer, **inputs):
+    with torch.no_grad():
+        return model.generate(**inputs, max_new_tokens=12, do_sample=False,
+                              pad_token_id=tokenizer.eos_token_id)
+
+def test_cached_prefix_gives_the_same_tokens(model, tokenizer):
+    cache = PrefixKVCache(model, tokenizer, pinned=[genre_prefix(tag) for tag in GENRE_TAGS])
+    prefix = genre_prefix("[MECHA]")
+    inputs = cache.prepare(prefix, "The hangar doors opened")
+
+    expected = greedy(model, tokenizer, input_ids=inputs["input_ids"],
+                      attention_mask=inputs["attention_mask"])
+    assert torch.equal(greedy(model, tokenizer, **inputs), expected)
+
+    # Generation extends its cache in place; the stored prefix must stay intact
+    assert torch.equal(greedy(model, tokenizer, **cache.prepare(prefix, "The hangar doors opened")), expected)
+
+def test_pinned_prefixes_are_hits(model, tokenizer):
+    cache = PrefixKVCache(model, tokenizer, pinned=[genre_prefix("[SHONEN]")])
+    cache.get(genre_prefix("[SHONEN]"))
+    assert cache.stats() == {"hits": 1, "misses": 0, "pinned_entries": 1, "entries": 0}
+
+def test_unpinned_prefixes_are_evicted_least_recently_used_first(model, tokenizer):
+    cache = PrefixKVCache(model, tokenizer, max_entries=2)
+    for preamble in ("A. ", "B. ", "A. ", "C. "):
+        cache.get(genre_prefix("[ISEKAI]", preamble))
+
+    stats = cache.stats()
+    assert stats["misses"] == 3 and stats["hits"] == 1 and stats["entries"] == 2
+    cache.get(genre_prefix("[ISEKAI]", "A. "))
+    assert cache.stats()["hits"] == 2
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Tests for the provider chain: circuit breaker, hedging, retries and caching
+
+Provider calls go through an httpx mock transport, so no request leaves
+the machine. app.py runs in Streamlit's bare mode here.
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+import requests
+
+import app
+from story_cache import StoryCache
+
+OPENAI_HOST = "api.openai.com"
+ANTHROPIC_HOST = "api.anthropic.com"
+
+def claude_response(text="Kenji drew the sword."):
+    return httpx.Response(200, json={"content": [{"text": text}]})
+
+@pytest.fixture
+def generator():
+    """Generator with every provider configured and no real HTTP
+
+    Tests map a host to an async handler in generator.routes; every
+    other provider answers 500. Hosts called are listed in generator.calls.
+    """
+    generator = app.AnimeStoryGenerator(hedge_delay=None)
+    generator.health = app.ProviderHealthRegistry()
+    generator.cache = StoryCache()
+    for config in generator.api_configs.values():
+        config["headers"]["Authorization"] = "Bearer test"
+    generator.routes = {}
+    generator.calls = []
+
+    async def handle(request):
+        generator.calls.append(request.url.host)
+        route = generator.routes.get(request.url.host)
+        return await route(request) if route else httpx.Response(500)
+
+    async def use_mock_client():
+        generator.runtime._client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+
+    generator.runtime.run(use_mock_client())
+    yield generator
+    generator.runtime._client = None
+
+def test_circuit_opens_at_the_error_threshold():
+    health = app.ProviderHealthRegistry(window_size=4, min_calls=2, error_threshold=0.5, cooldown=60)
+    health.record("openai", True, 0.1)
+    assert health.allow_request("openai")
+    health.record("openai", False, 0.1, status_code=500, error="API Error: 500")
+    assert health.snapshot()["openai"]["state"] == health.OPEN
+    assert not health.allow_request("openai")
+
+def test_half_open_lets_one_probe_through():
+    health = app.ProviderHealthRegistry(window_size=4, min_calls=1, error_threshold=0.5, cooldown=0.05)
+    health.record("openai", False, 0.1)
+    time.sleep(0.1)
+    assert health.allow_request("openai")
+    assert not health.allow_request("openai")
+
+    # A released probe frees the slot without deciding the state
+    health.release("openai")
+    assert health.allow_request("openai")
+    health.record("openai", True, 0.1)
+    assert health.snapshot()["openai"]["state"] == health.CLOSED
+
+def test_failed_probe_reopens_the_circuit():
+    health = app.ProviderHealthRegistry(window_size=4, min_calls=1, error_threshold=0.5, cooldown=0.05)
+    health.record("openai", False, 0.1)
+    time.sleep(0.1)
+    assert health.allow_request("openai")
+    health.record("openai", False, 0.1)
+    assert not health.allow_request("openai")
+
+def test_open_circuit_skips_the_provider(generator):
+    generator.routes[ANTHROPIC_HOST] = lambda request: asyncio.sleep(0, claude_response())
+    for _ in range(app.CIRCUIT_MIN_CALLS):
+        generator.health.record("openai", False, 0.1)
+
+    result = generator.generate_story("A hero appears", "shonen", use_cache=False)
+    assert result.provider == "Claude-3.5-Sonnet"
+    assert OPENAI_HOST not in generator.calls
+
+def test_status_retry_with_retry_after(generator):
+    responses = [httpx.Response(503, headers={"Retry-After": "0"}), claude_response()]
+    generator.routes[ANTHROPIC_HOST] = lambda request: asyncio.sleep(0, responses.pop(0))
+
+    result = generator.generate_story("A hero appears", "shonen", use_cache=False)
+    assert result.success and result.provider == "Claude-3.5-Sonnet"
+    assert generator.calls.count(ANTHROPIC_HOST) == 2
+    assert generator.health.snapshot()["anthropic"]["error_rate"] == 0.0
+
+def test_hedge_starts_the_next_provider_and_cancels_the_slow_one(generator):
+    async def slow(request):
+        await asyncio.sleep(5)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "Too late."}}]})
+
+    generator.routes[OPENAI_HOST] = slow
+    generator.routes[ANTHROPIC_HOST] = lambda request: asyncio.sleep(0, claude_response())
+
+    start_time = time.time()
+    result = generator.generate_story("A hero appears", "shonen", hedge_delay=0.1, use_cache=False)
+    assert result.provider == "Claude-3.5-Sonnet"
+    assert time.time() - start_time < 2
+
+    # Losing the race is not a failure: the loser is released unrecorded
+    openai = generator.health.snapshot()["openai"]
+    assert openai["calls"] == 0 and openai["state"] == generator.health.CLOSED
+    assert generator.health.allow_request("openai")
+
+def test_result_reports_provider_usage_and_timing(generator):
+    generator.routes[OPENAI_HOST] = lambda request: asyncio.sleep(0, httpx.Response(200, json={
+        "choices": [{"message": {"content": "Kenji drew the sword."}}],
+        "usage": {"prompt_tokens": 42, "completion_tokens": 7}
+    }))
+
+    result = generator.generate_story("A hero appears", "shonen", use_cache=False)
+    assert result.provider == "OpenAI GPT-4o-mini" and result.status_code == 200
+    assert (result.prompt_tokens, result.completion_tokens) == (42, 7)
+    assert result.latency > 0 and result.tokens_per_sec == 7 / result.latency
+
+def test_repeated_request_is_served_from_the_cache(generator):
+    generator.routes[OPENAI_HOST] = lambda request: asyncio.sleep(0, httpx.Response(
+        200, json={"choices": [{"message": {"content": "Hana opened her eyes."}}]}))
+
+    first = generator.generate_story("A hero appears", "isekai")
+    second = generator.generate_story("A hero appears", "isekai")
+    assert not first.cached and second.cached
+    assert second.text == first.text
+    assert generator.calls == [OPENAI_HOST]
+
+def test_hedge_waits_for_the_observed_p95_latency(generator):
+    async def answer_after(request):
+        await asyncio.sleep(0.3)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "Kenji drew the sword."}}]})
+
+    generator.routes[OPENAI_HOST] = answer_after
+    generator.routes[ANTHROPIC_HOST] = lambda request: asyncio.sleep(0, claude_response())
+
+    # OpenAI usually takes a second, so a 0.3s answer is not worth hedging
+    for _ in range(app.CIRCUIT_MIN_CALLS):
+        generator.health.record("openai", True, 1.0)
+    assert generator.health.latency_percentile("openai", app.HEDGE_LATENCY_PERCENTILE) == 1.0
+
+    result = generator.generate_story("A hero appears", "shonen", hedge_delay=0.05, use_cache=False)
+    assert result.provider == "OpenAI GPT-4o-mini"
+    assert ANTHROPIC_HOST not in generator.calls
+
+def test_template_fallback_when_every_provider_fails(generator):
+    result = generator.generate_story("A hero appears", "mecha", use_cache=False)
+    assert result.success and result.provider == "Template Fallback"
+    assert generator.cache.stats()["memory_entries"] == 0
+
+def test_stream_fallback_skips_the_streaming_providers(generator, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise app.ProviderError("Service unavailable", 503)
+        yield
+
+    monkeypatch.setattr(generator, "stream_with_openai", unavailable)
+    monkeypatch.setattr(generator, "stream_with_claude", unavailable)
+
+    result = app.GenerationResult()
+    text = "".join(generator.generate_story_stream("A hero appears", "shonen", result=result, use_cache=False))
+    assert text and result.provider == "Template Fallback"
+    assert OPENAI_HOST not in generator.calls and ANTHROPIC_HOST not in generator.calls
+
+def test_stalled_stream_moves_on_without_retrying(generator, monkeypatch):
+    posts = []
+
+    class StalledSession:
+        def post(self, url, **kwargs):
+            posts.append((url, kwargs["timeout"]))
+            raise requests.ReadTimeout("No first chunk")
+
+    monkeypatch.setattr(generator, "session", StalledSession())
+
+    result = app.GenerationResult()
+    "".join(generator.generate_story_stream("A hero appears", "shonen", result=result, use_cache=False))
+    assert result.provider == "Template Fallback"
+
+    # One bounded attempt per streaming provider
+    timeout = (app.STREAM_CONNECT_TIMEOUT_SECONDS, app.STREAM_READ_TIMEOUT_SECONDS)
+    assert posts == [
+        (generator.api_configs["openai"]["url"], timeout),
+        (generator.api_configs["anthropic"]["url"], timeout)
+    ]
+    assert app.get_http_session().get_adapter("https://api.openai.com").max_retries.total == 0
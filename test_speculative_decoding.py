@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Tests for speculative decoding: draft loading, output parity and acceptance counts"""
+
+import os
+import threading
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
+
+from model_registry import get_model
+from speculative_decoding import AcceptanceCounter, load_draft_model, shrink_model
+
+def test_draft_is_resized_without_touching_the_shared_model(tiny_model_dir, tokenizer, tmp_path):
+    # A draft that knows the byte vocabulary but not our special tokens
+    draft_path = str(tmp_path / "draft")
+    base_tokenizer = GPT2Tokenizer(os.path.join(tiny_model_dir, "vocab.json"), os.path.join(tiny_model_dir, "merges.txt"))
+    base_tokenizer.save_pretrained(draft_path)
+    config = GPT2Config(vocab_size=len(base_tokenizer), n_positions=256, n_embd=32, n_layer=1, n_head=2)
+    GPT2LMHeadModel(config).save_pretrained(draft_path)
+    device = torch.device("cpu")
+
+    draft = load_draft_model(draft_path, tokenizer, device)
+    assert draft.get_input_embeddings().num_embeddings == len(tokenizer)
+    assert get_model(draft_path, device=device).model.get_input_embeddings().num_embeddings == len(base_tokenizer)
+    assert load_draft_model(draft_path, tokenizer, device) is draft
+
+def test_greedy_output_matches_without_a_draft(tiny_model_dir, tokenizer, model, tmp_path):
+    draft = GPT2LMHeadModel.from_pretrained(shrink_model(tiny_model_dir, str(tmp_path / "draft"), num_layers=1)).eval()
+    inputs = tokenizer("[SHONEN] [SCENE] A hero appears", return_tensors="pt")
+    kwargs = dict(max_new_tokens=12, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+
+    with torch.inference_mode():
+        plain = model.generate(**inputs, **kwargs)
+        assisted = model.generate(**inputs, assistant_model=draft, **kwargs)
+    assert torch.equal(plain, assisted)
+
+def test_acceptance_counts_stay_per_thread(model, tokenizer):
+    draft = GPT2LMHeadModel(model.config).eval()
+    input_ids = tokenizer("A hero appears", return_tensors="pt")["input_ids"]
+    barrier = threading.Barrier(2)
+    counts = {}
+
+    def run(passes):
+        counter = AcceptanceCounter(model, draft)
+        barrier.wait()
+        with torch.inference_mode():
+            for _ in range(passes):
+                model(input_ids)
+                draft(input_ids)
+        barrier.wait()
+        counts[passes] = (counter.main_passes, counter.draft_passes)
+        counter.remove()
+
+    threads = [threading.Thread(target=run, args=(passes,)) for passes in (2, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counts == {2: (2, 2), 5: (5, 5)}
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Tests for the two-tier story cache"""
+
+import time
+
+from story_cache import StoryCache
+
+STORY = {"success": True, "text": "Kenji drew the sword.", "provider": "Claude-3.5-Sonnet"}
+
+def test_key_ignores_parameter_order():
+    assert StoryCache.make_key(prompt="a", genre="shonen") == StoryCache.make_key(genre="shonen", prompt="a")
+    assert StoryCache.make_key(prompt="a", genre="shonen") != StoryCache.make_key(prompt="a", genre="mecha")
+
+def test_hit_and_miss():
+    cache = StoryCache()
+    assert cache.get("key") is None
+    cache.set("key", STORY)
+    assert cache.get("key") == STORY
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_returned_story_is_a_copy():
+    cache = StoryCache()
+    cache.set("key", STORY)
+    cache.get("key")["text"] = "changed"
+    assert cache.get("key")["text"] == STORY["text"]
+
+def test_least_recently_used_is_evicted():
+    cache = StoryCache(max_entries=2)
+    cache.set("a", STORY)
+    cache.set("b", STORY)
+    cache.get("a")
+    cache.set("c", STORY)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+def test_expired_story_is_a_miss():
+    cache = StoryCache(ttl=0.05)
+    cache.set("key", STORY)
+    time.sleep(0.1)
+    assert cache.get("key") is None
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    disk_path = str(tmp_path / "cache" / "stories.db")
+    StoryCache(disk_path=disk_path).set("key", STORY)
+    assert StoryCache(disk_path=disk_path).get("key") == STORY
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = StoryCache(max_entries=1, disk_path=str(tmp_path / "stories.db"), max_disk_entries=2)
+    for key in ("a", "b", "c"):
+        cache.set(key, STORY)
+    assert cache.stats()["disk_entries"] == 2
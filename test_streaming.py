@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""Tests for incremental detokenization and the token streamer"""
+
+import torch
+
+from streaming import IncrementalDetokenizer, TokenStreamer
+
+TEXT = "[SHONEN] [SCENE] Kenji said \"お前はもう死んでいる\" and smiled 🎌 at the sky."
+
+def test_deltas_add_up_to_the_full_decode(tokenizer):
+    token_ids = tokenizer.encode(TEXT)
+    detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=False)
+    chunks = [detokenizer.add(token_id) for token_id in token_ids] + [detokenizer.flush()]
+
+    assert "".join(chunks) == tokenizer.decode(token_ids, skip_special_tokens=False)
+    # Multi-byte characters are held back until they are complete
+    assert not any("�" in chunk for chunk in chunks)
+
+def test_special_tokens_can_be_skipped(tokenizer):
+    token_ids = tokenizer.encode(TEXT)
+    detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=True)
+    text = "".join(detokenizer.add(token_id) for token_id in token_ids) + detokenizer.flush()
+    assert text == tokenizer.decode(token_ids, skip_special_tokens=True)
+
+def test_streamer_skips_the_prompt_and_eos(tokenizer):
+    prompt_ids = tokenizer.encode("[MECHA] [SCENE]")
+    story_ids = tokenizer.encode(" The hangar doors opened ✨")
+    streamer = TokenStreamer(tokenizer, skip_prompt=True, skip_special_tokens=False)
+
+    streamer.put(torch.tensor([prompt_ids]))
+    for token_id in story_ids + [tokenizer.eos_token_id]:
+        streamer.put(torch.tensor([token_id]))
+    streamer.end()
+
+    assert "".join(streamer) == tokenizer.decode(story_ids)
+    assert streamer.token_ids == story_ids
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Tests for token shards and block packing"""
+
+import json
+
+import pytest
+from datasets import Dataset
+
+from token_shards import TokenShardDataset, pack_blocks, write_shards
+
+STORIES = [
+    {"genre": "[SHONEN]", "prompt": "A young warrior", "story": "Kenji pulled the blade from the stone."},
+    {"genre": "[MECHA]", "prompt": "Pilots defend Earth", "story": "The hangar doors opened on a starlit sky."},
+    {"text": "[ISEKAI] [SCENE] Hana woke up in a medieval fantasy world."}
+]
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = tmp_path / "stories.jsonl"
+    path.write_text("\n".join(json.dumps(story) for story in STORIES * 10))
+    return str(path)
+
+def story_ids(tokenizer, story):
+    text = story.get("text") or f"{story['genre']} [SCENE] {story['prompt']} {story['story']}"
+    return tokenizer(text)["input_ids"] + [tokenizer.eos_token_id]
+
+def test_stories_round_trip(corpus, tokenizer, tmp_path):
+    metadata = write_shards([corpus], str(tmp_path / "shards"), tokenizer, shard_tokens=256)
+    assert len(metadata["shards"]) > 1
+    assert metadata["num_stories"] == 30
+
+    dataset = TokenShardDataset(str(tmp_path / "shards"), tokenizer=tokenizer)
+    assert len(dataset) == 30
+    for index, story in enumerate(STORIES * 10):
+        assert dataset[index]["input_ids"].tolist() == story_ids(tokenizer, story)
+
+def test_blocks_are_full(corpus, tokenizer, tmp_path):
+    write_shards([corpus], str(tmp_path / "shards"), tokenizer)
+    dataset = TokenShardDataset(str(tmp_path / "shards"), block_size=32)
+
+    all_ids = [token for story in STORIES * 10 for token in story_ids(tokenizer, story)]
+    assert len(dataset) == len(all_ids) // 32
+    assert dataset[-1]["input_ids"].tolist() == all_ids[(len(dataset) - 1) * 32:len(dataset) * 32]
+    assert dataset.num_tokens == len(dataset) * 32
+
+def test_story_max_length(corpus, tokenizer, tmp_path):
+    write_shards([corpus], str(tmp_path / "shards"), tokenizer)
+    dataset = TokenShardDataset(str(tmp_path / "shards"), max_length=8)
+    assert all(len(dataset[index]["input_ids"]) == 8 for index in range(len(dataset)))
+
+def test_other_tokenizer_is_rejected(corpus, tokenizer, tmp_path):
+    write_shards([corpus], str(tmp_path / "shards"), tokenizer)
+    tokenizer.add_tokens(["[NEW_GENRE]"])
+    with pytest.raises(ValueError):
+        TokenShardDataset(str(tmp_path / "shards"), tokenizer=tokenizer)
+
+def test_pack_blocks_runs_across_rows():
+    rows = [list(range(start, start + 5)) for start in range(0, 50, 5)]
+    dataset = Dataset.from_dict({"input_ids": rows})
+    packed = pack_blocks(dataset, 8, attention_mask=True)
+
+    # 50 tokens make 6 full blocks; only the last 2 tokens are dropped
+    assert packed["input_ids"] == [list(range(start, start + 8)) for start in range(0, 48, 8)]
+    assert packed["attention_mask"] == [[1] * 8] * 6
+
+def test_pack_blocks_across_map_batches():
+    # A mapped dataset is stored in several Arrow chunks
+    dataset = Dataset.from_dict({"n": list(range(30))}).map(
+        lambda batch: {"input_ids": [[n] * 3 for n in batch["n"]]},
+        batched=True, batch_size=7, remove_columns=["n"]
+    )
+    packed = pack_blocks(dataset, 4)
+    assert len(packed) == 90 // 4
+    assert [token for block in packed["input_ids"] for token in block] == [n for n in range(30) for _ in range(3)][:88]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Tests for the pretraining data pipeline: cached and streamed token blocks"""
+
+import os
+
+import pytest
+
+from train import AnimeGPT2Trainer
+
+LINES = [
+    "[SHONEN] [SCENE] The sun rose over Tokyo as Kenji prepared for his entrance exam.",
+    "",
+    "[MECHA] [SCENE] Pilots defend Earth from the invaders 🎌",
+    "[ISEKAI] [SCENE] Hana woke up in a medieval fantasy world."
+]
+
+@pytest.fixture
+def trainer(tokenizer):
+    # Only the data pipeline is exercised, so skip loading gpt2-medium
+    trainer = AnimeGPT2Trainer.__new__(AnimeGPT2Trainer)
+    trainer.tokenizer = tokenizer
+    return trainer
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = tmp_path / "stories.txt"
+    path.write_text("\n".join(LINES * 20), encoding="utf-8")
+    return str(path)
+
+def expected_blocks(tokenizer, corpus, block_size):
+    # The byte-level test tokenizer has no merges, so line-by-line
+    # tokenization equals tokenizing the whole corpus at once
+    with open(corpus, encoding="utf-8") as f:
+        token_ids = tokenizer(f.read())["input_ids"]
+    return [token_ids[start:start + block_size] for start in range(0, len(token_ids) - block_size + 1, block_size)]
+
+def test_blocks_match_the_contiguous_corpus(trainer, tokenizer, corpus, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    dataset, _ = trainer.prepare_dataset(corpus, block_size=64, num_proc=1, cache_dir=cache_dir)
+    assert [block.tolist() for block in dataset["input_ids"]] == expected_blocks(tokenizer, corpus, 64)
+
+    # The second run reads the cache instead of tokenizing again
+    assert os.listdir(cache_dir) == [os.path.basename(trainer._cache_path(corpus, 64, cache_dir))]
+    cached, _ = trainer.prepare_dataset(corpus, block_size=64, num_proc=1, cache_dir=cache_dir)
+    assert cached.cache_files[0]["filename"].startswith(cache_dir)
+    assert len(cached) == len(dataset)
+
+def test_streamed_blocks_match_the_cached_ones(trainer, tokenizer, corpus, tmp_path):
+    dataset, _ = trainer.prepare_dataset(corpus, block_size=64, streaming=True)
+    assert [example["input_ids"].tolist() for example in dataset] == expected_blocks(tokenizer, corpus, 64)
+
+def test_cache_key_follows_the_block_size(trainer, corpus, tmp_path):
+    assert trainer._cache_path(corpus, 64, str(tmp_path)) != trainer._cache_path(corpus, 128, str(tmp_path))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Token Shards
+Preprocesses anime story corpora into fixed-size binary token shards so
+training never has to hold the corpus in memory. Each shard is a flat
+uint16 array of token ids (every story ends with EOS) with an index of
+the offsets where its stories start. TokenShardDataset reads the shards
+through np.memmap, so opening a multi-GB corpus is instant and only the
+pages a batch touches are read.
+
+Corpora are read as a stream: .jsonl (one story per line), .txt (stories
+separated by blank lines) or a .json array in the fine-tuning format.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, Iterator, List, Optional
+
+import datasets
+import numpy as np
+import pyarrow as pa
+import torch
+from torch.utils.data import Dataset
+from transformers import AutoTokenizer
+
+SHARD_METADATA_NAME = "metadata.json"
+# 2**26 tokens = 128 MB per shard
+DEFAULT_SHARD_TOKENS = 2 ** 26
+# uint16 ids need a vocabulary below 65536, which covers GPT-2 and DialoGPT
+MAX_VOCAB_SIZE = np.iinfo(np.uint16).max + 1
+
+# Special tokens for anime storytelling, shared by every training script
+# so shards and checkpoints agree on the vocabulary
+SPECIAL_TOKENS = [
+    '[SCENE]', '[CHARACTER]', '[DIALOGUE]', '[ACTION]',
+    '[SHONEN]', '[SHOJO]', '[ISEKAI]', '[MECHA]',
+    '[SLICE_OF_LIFE]', '[ROMANCE]'
+]
+
+def tokenizer_hash(tokenizer) -> str:
+    """Short hash of a tokenizer vocabulary, added special tokens included"""
+    vocab = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return hashlib.sha256(vocab.encode('utf-8')).hexdigest()[:16]
+
+def format_story(story: Dict) -> str:
+    """Format a story record the way the fine-tuning dataset does"""
+    if "text" in story:
+        return story["text"]
+    return f"{story['genre']} [SCENE] {story['prompt']} {story['story']}"
+
+def iter_stories(data_path: str) -> Iterator[str]:
+    """Yield the stories of a corpus file one at a time"""
+    with open(data_path, 'r', encoding='utf-8') as f:
+        if data_path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield format_story(json.loads(line))
+        elif data_path.endswith('.json'):
+            # A JSON array can only be parsed whole; use .jsonl for large corpora
+            for story in json.load(f):
+                yield format_story(story)
+        else:
+            paragraph = []
+            for line in f:
+                if line.strip():
+                    paragraph.append(line.strip())
+                elif paragraph:
+                    yield " ".join(paragraph)
+                    paragraph = []
+            if paragraph:
+                yield " ".join(paragraph)
+
+def pack_blocks(tokenized: datasets.Dataset, block_size: int,
+                attention_mask: bool = False) -> datasets.Dataset:
+    """Concatenate the input_ids of a tokenized dataset and cut them into block_size blocks
+
+    Blocks run on across example boundaries and only the final partial
+    block is dropped, so every block is full. The tokens are regrouped in
+    Arrow, without copying them into Python lists.
+    """
+    column = tokenized.data.column('input_ids')
+    token_ids = column.combine_chunks().flatten() if column.num_chunks else pa.array([], type=pa.int32())
+    total_length = len(token_ids) // block_size * block_size
+    offsets = pa.array(np.arange(0, total_length + 1, block_size, dtype=np.int32))
+    columns = {'input_ids': pa.ListArray.from_arrays(offsets, token_ids.slice(0, total_length))}
+    if attention_mask:
+        columns['attention_mask'] = pa.ListArray.from_arrays(offsets, pa.array(np.ones(total_length, dtype=np.int8)))
+    return datasets.Dataset(pa.table(columns))
+
+class ShardWriter:
+    def __init__(self, output_dir: str, shard_tokens: int = DEFAULT_SHARD_TOKENS):
+        """
+        Write token ids into fixed-size shards
+
+        Args:
+            output_dir: Directory for the shards and their metadata
+            shard_tokens: Tokens per shard; a story never spans two shards
+        """
+        self.output_dir = output_dir
+        self.shard_tokens = shard_tokens
+        self.shards: List[Dict] = []
+        self._buffer = np.empty(shard_tokens, dtype=np.uint16)
+        self._offsets = [0]
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, token_ids: List[int]):
+        """Append one story (already terminated with EOS)"""
+        if self._offsets[-1] + len(token_ids) > self.shard_tokens:
+            self._flush()
+        if len(token_ids) > self.shard_tokens:
+            # A story longer than a shard gets a shard of its own
+            self._buffer = np.empty(len(token_ids), dtype=np.uint16)
+        end = self._offsets[-1] + len(token_ids)
+        self._buffer[self._offsets[-1]:end] = token_ids
+        self._offsets.append(end)
+
+    def _flush(self):
+        num_tokens = self._offsets[-1]
+        if not num_tokens:
+            return
+        name = f"shard_{len(self.shards):05d}"
+        self._buffer[:num_tokens].tofile(os.path.join(self.output_dir, f"{name}.bin"))
+        np.save(os.path.join(self.output_dir, f"{name}.idx.npy"), np.array(self._offsets, dtype=np.int64))
+        self.shards.append({"name": name, "num_tokens": num_tokens, "num_stories": len(self._offsets) - 1})
+        if len(self._buffer) != self.shard_tokens:
+            self._buffer = np.empty(self.shard_tokens, dtype=np.uint16)
+        self._offsets = [0]
+
+    def close(self, metadata: Dict) -> Dict:
+        """Write the last shard and the metadata file; returns the metadata"""
+        self._flush()
+        metadata = {
+            **metadata,
+            "dtype": "uint16",
+            "shard_tokens": self.shard_tokens,
+            "num_tokens": sum(shard["num_tokens"] for shard in self.shards),
+            "num_stories": sum(shard["num_stories"] for shard in self.shards),
+            "shards": self.shards
+        }
+        # Metadata goes last, so a directory without it is an incomplete run
+        tmp_path = os.path.join(self.output_dir, f"{SHARD_METADATA_NAME}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.output_dir, SHARD_METADATA_NAME))
+        return metadata
+
+def write_shards(data_paths: List[str], output_dir: str, tokenizer,
+                 shard_tokens: int = DEFAULT_SHARD_TOKENS, batch_size: int = 1000) -> Dict:
+    """Tokenize corpus files into token shards and return their metadata"""
+    if len(tokenizer) > MAX_VOCAB_SIZE:
+        raise ValueError(f"Vocabulary of {len(tokenizer)} tokens does not fit in uint16")
+
+    writer = ShardWriter(output_dir, shard_tokens)
+    eos_token_id = tokenizer.eos_token_id
+
+    def write_batch(texts):
+        for token_ids in tokenizer(texts)["input_ids"]:
+            writer.add(token_ids + [eos_token_id])
+
+    for data_path in data_paths:
+        batch = []
+        for story in iter_stories(data_path):
+            batch.append(story)
+            if len(batch) == batch_size:
+                write_batch(batch)
+                batch = []
+        if batch:
+            write_batch(batch)
+
+    return writer.close({
+        "sources": [os.path.abspath(path) for path in data_paths],
+        "tokenizer": tokenizer.name_or_path,
+        "tokenizer_hash": tokenizer_hash(tokenizer),
+        "vocab_size": len(tokenizer),
+        "eos_token_id": eos_token_id
+    })
+
+class TokenShardDataset(Dataset):
+    """Random-access training examples read from token shards through np.memmap
+
+    With block_size, examples are consecutive block_size-token windows of
+    each shard (stories packed back to back, the tail of a shard dropped).
+    Without it, each example is one story, cut to max_length tokens.
+    """
+
+    def __init__(self, shards_dir: str, block_size: Optional[int] = None,
+                 max_length: Optional[int] = None, tokenizer=None):
+        with open(os.path.join(shards_dir, SHARD_METADATA_NAME)) as f:
+            self.metadata = json.load(f)
+        if tokenizer is not None and tokenizer_hash(tokenizer) != self.metadata["tokenizer_hash"]:
+            raise ValueError(f"Shards in {shards_dir} were written with a different tokenizer "
+                             f"({self.metadata['tokenizer']})")
+
+        self.block_size = block_size
+        self.max_length = max_length
+        self.tokens = []
+        self.offsets = []
+        counts = []
+        for shard in self.metadata["shards"]:
+            self.tokens.append(np.memmap(os.path.join(shards_dir, f"{shard['name']}.bin"),
+                                         dtype=np.uint16, mode='r', shape=(shard["num_tokens"],)))
+            offsets = np.load(os.path.join(shards_dir, f"{shard['name']}.idx.npy"), mmap_mode='r')
+            self.offsets.append(offsets)
+            counts.append(shard["num_tokens"] // block_size if block_size else shard["num_stories"])
+        self._starts = np.cumsum([0] + counts)
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    @property
+    def num_tokens(self) -> int:
+        """Tokens the examples cover, for throughput reporting"""
+        if self.block_size:
+            return len(self) * self.block_size
+        lengths = np.concatenate([np.diff(offsets) for offsets in self.offsets])
+        return int(np.minimum(lengths, self.max_length).sum()) if self.max_length else int(lengths.sum())
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        shard = int(np.searchsorted(self._starts, index, side='right')) - 1
+        local_index = index - int(self._starts[shard])
+        if self.block_size:
+            start = local_index * self.block_size
+            end = start + self.block_size
+        else:
+            start, end = int(self.offsets[shard][local_index]), int(self.offsets[shard][local_index + 1])
+            if self.max_length:
+                end = min(end, start + self.max_length)
+
+        input_ids = torch.from_numpy(self.tokens[shard][start:end].astype(np.int64))
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess anime story corpora into uint16 token shards")
+    parser.add_argument("inputs", nargs="+",
+                       help="Corpus files (.jsonl, .json or .txt with blank-line separated stories)")
+    parser.add_argument("--output_dir", type=str, default="data/shards",
+                       help="Where to write the shards")
+    parser.add_argument("--tokenizer", type=str, default="microsoft/DialoGPT-medium",
+                       help="Tokenizer to use (a base model, or the tokenizer saved by a training run)")
+    parser.add_argument("--add_special_tokens", action="store_true",
+                       help="Add the special tokens the training scripts add")
+    parser.add_argument("--shard_tokens", type=int, default=DEFAULT_SHARD_TOKENS,
+                       help="Tokens per shard")
+    args = parser.parse_args()
+
+    print("🎌 Anime Corpus Token Shards 🎌")
+    print("=" * 50)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    if args.add_special_tokens:
+        tokenizer.add_special_tokens({'additional_special_tokens': SPECIAL_TOKENS})
+
+    metadata = write_shards(args.inputs, args.output_dir, tokenizer, args.shard_tokens)
+    print(f"✅ Wrote {metadata['num_stories']:,} stories ({metadata['num_tokens']:,} tokens) "
+          f"in {len(metadata['shards'])} shards to {args.output_dir}")
+    print(f"Tokenizer hash: {metadata['tokenizer_hash']}")
+
+if __name__ == "__main__":
+    main()
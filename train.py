@@ -1,9 +1,34 @@
 import torch
 from transformers import GPT2LMHeadModel, GPT2Tokenizer, GPT2Config
-from transformers import TextDataset, DataCollatorForLanguageModeling
-from transformers import Trainer, TrainingArguments
-from datasets import load_dataset
+from transformers import DataCollatorForLanguageModeling
+from transformers import TrainingArguments
+from datasets import IterableDataset, load_dataset, load_from_disk
+from token_shards import SPECIAL_TOKENS, TokenShardDataset, pack_blocks, tokenizer_hash
+from checkpointing import AsyncCheckpointTrainer, latest_checkpoint
+from lora_adapters import add_lora
+import hashlib
 import os
+import shutil
+
+# Each tokenizer worker is a separate process with its own copy of the
+# tokenizer, so more workers mostly cost memory
+DEFAULT_NUM_PROC = min(4, os.cpu_count() or 1)
+
+def tokenize_lines(examples, tokenizer):
+    """Tokenize a batch of corpus lines (module level, so workers only get the tokenizer)"""
+    return {'input_ids': tokenizer(examples['text'])['input_ids']}
+
+def iter_blocks(tokenized, block_size):
+    """Yield block_size token blocks from a streamed corpus, carrying the
+    remainder of each line over to the next block"""
+    buffer = []
+    for example in tokenized:
+        buffer.extend(example['input_ids'])
+        start = 0
+        while len(buffer) - start >= block_size:
+            yield {'input_ids': buffer[start:start + block_size]}
+            start += block_size
+        del buffer[:start]
 
 class AnimeGPT2Trainer:
     def __init__(self, model_name='gpt2-medium', output_dir='./models'):
@@ -27,32 +52,82 @@ class AnimeGPT2Trainer:
         self.model.to(self.device)
         
         # Add special tokens for anime storytelling
-        special_tokens = {
-            'additional_special_tokens': [
-                '[SCENE]', '[CHARACTER]', '[DIALOGUE]', '[ACTION]',
-                '[SHONEN]', '[SHOJO]', '[ISEKAI]', '[MECHA]', '[SLICE_OF_LIFE]'
-            ]
-        }
-        self.tokenizer.add_special_tokens(special_tokens)
+        self.tokenizer.add_special_tokens({'additional_special_tokens': SPECIAL_TOKENS})
         self.model.resize_token_embeddings(len(self.tokenizer))
         
-    def prepare_dataset(self, data_path='data/anime_stories.txt'):
-        """Prepare dataset for training"""
+    def tokenizer_hash(self):
+        """Short hash of the tokenizer vocabulary, added special tokens included"""
+        return tokenizer_hash(self.tokenizer)
+    
+    def _cache_path(self, data_path, block_size, cache_dir):
+        """Cache directory for a corpus, its tokenizer and block size"""
+        stat = os.stat(data_path)
+        key = hashlib.sha256(
+            f"{os.path.abspath(data_path)}:{stat.st_size}:{stat.st_mtime_ns}:"
+            f"{self.tokenizer_hash()}:{block_size}".encode('utf-8')
+        ).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(data_path))[0]
+        return os.path.join(cache_dir, f"{name}-{block_size}-{key}")
+    
+    def _tokenize_corpus(self, data_path, block_size, num_proc=None, streaming=False):
+        """Tokenize a text corpus and cut it into block_size token blocks"""
+        raw_dataset = load_dataset('text', data_files=data_path, split='train',
+                                   keep_linebreaks=True, streaming=streaming)
+        
+        map_kwargs = {} if streaming else {'num_proc': num_proc}
+        tokenized = raw_dataset.map(tokenize_lines, batched=True, remove_columns=['text'],
+                                    fn_kwargs={'tokenizer': self.tokenizer}, **map_kwargs)
+        if streaming:
+            return IterableDataset.from_generator(iter_blocks, gen_kwargs={'tokenized': tokenized,
+                                                                           'block_size': block_size})
+        # Like TextDataset, blocks run on across lines and only the final partial block is dropped
+        return pack_blocks(tokenized, block_size)
+    
+    def prepare_dataset(self, data_path='data/anime_stories.txt', block_size=128, num_proc=None,
+                        streaming=False, cache_dir='data/cache', shards_dir=None):
+        """Prepare dataset for training
+        
+        The corpus is tokenized once, in num_proc processes (default: up to
+        DEFAULT_NUM_PROC), and saved as Arrow under cache_dir, keyed by the corpus,
+        the tokenizer hash and block_size. Later runs memory-map the cache
+        and skip tokenization. With streaming, the corpus is read and
+        tokenized lazily while training instead, for corpora too large to
+        tokenize up front. With shards_dir, training reads the token shards
+        written by token_shards.py through memory maps and data_path is not used.
+        """
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=self.tokenizer,
+            mlm=False
+        )
+        
+        if shards_dir:
+            dataset = TokenShardDataset(shards_dir, block_size=block_size, tokenizer=self.tokenizer)
+            print(f"{len(dataset)} blocks of {block_size} tokens from {shards_dir}")
+            return dataset, data_collator
+        
         if not os.path.exists(data_path):
             print(f"Data file not found at {data_path}")
             print("Creating sample dataset...")
             self._create_sample_data(data_path)
         
-        dataset = TextDataset(
-            tokenizer=self.tokenizer,
-            file_path=data_path,
-            block_size=128
-        )
-        
-        data_collator = DataCollatorForLanguageModeling(
-            tokenizer=self.tokenizer,
-            mlm=False
-        )
+        if streaming:
+            dataset = self._tokenize_corpus(data_path, block_size, streaming=True)
+        else:
+            cache_path = self._cache_path(data_path, block_size, cache_dir)
+            if os.path.exists(cache_path):
+                print(f"Using cached tokens from {cache_path}")
+            else:
+                print(f"Tokenizing {data_path}...")
+                dataset = self._tokenize_corpus(data_path, block_size, num_proc or DEFAULT_NUM_PROC)
+                # Write to a temporary directory first so an interrupted run leaves no partial cache
+                tmp_path = f"{cache_path}.tmp"
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                dataset.save_to_disk(tmp_path)
+                os.replace(tmp_path, cache_path)
+            dataset = load_from_disk(cache_path)
+            print(f"{len(dataset)} blocks of {block_size} tokens")
+        
+        dataset = dataset.with_format('torch')
         
         return dataset, data_collator
     
@@ -71,14 +146,25 @@ class AnimeGPT2Trainer:
         
         print(f"Sample data created at {data_path}")
     
-    def train(self, epochs=3, batch_size=4, learning_rate=5e-5):
-        """Train the model"""
-        dataset, data_collator = self.prepare_dataset()
+    def train(self, epochs=3, batch_size=4, learning_rate=5e-5, streaming=False, max_steps=-1,
+              shards_dir=None, resume=True, lora=False, lora_rank=8):
+        """Train the model (a streamed corpus has no length, so it needs max_steps)
+        
+        With resume, training continues from the newest complete checkpoint
+        in output_dir, if there is one. With lora, only LoRA adapters and the
+        special token embeddings are trained and saved.
+        """
+        if lora:
+            self.model = add_lora(self.model, self.tokenizer.additional_special_tokens_ids, rank=lora_rank)
+        if streaming and max_steps <= 0:
+            raise ValueError("max_steps is required when streaming the corpus")
+        dataset, data_collator = self.prepare_dataset(streaming=streaming, shards_dir=shards_dir)
         
         training_args = TrainingArguments(
             output_dir=self.output_dir,
             overwrite_output_dir=True,
             num_train_epochs=epochs,
+            max_steps=max_steps,
             per_device_train_batch_size=batch_size,
             save_steps=500,
             save_total_limit=2,
@@ -89,15 +175,19 @@ class AnimeGPT2Trainer:
             report_to='none'
         )
         
-        trainer = Trainer(
+        trainer = AsyncCheckpointTrainer(
             model=self.model,
             args=training_args,
             data_collator=data_collator,
             train_dataset=dataset
         )
         
-        print("Starting training...")
-        trainer.train()
+        checkpoint = latest_checkpoint(self.output_dir) if resume else None
+        if checkpoint:
+            print(f"Resuming training from {checkpoint}")
+        else:
+            print("Starting training...")
+        trainer.train(resume_from_checkpoint=checkpoint)
         
         # Save model
         self.model.save_pretrained(self.output_dir)